@@ -0,0 +1,66 @@
+"""
+Read acknowledgement throughput of a client that scrolls through a chat history and acks every message
+one request at a time: applied directly versus merged by AckCoalescer.
+
+Run from the project root: python -m benchmarks.ack_coalescing [messages]
+"""
+import asyncio
+import sys
+from time import perf_counter
+from uuid import uuid4
+
+from models import Customer, CustomerStatusEnum, Message, MessageStatusEnum, MessageTypeEnum
+from services.acks import AckCoalescer
+from services.chats import chat_store
+from services.inbox import notify_acknowledged
+
+
+def customer() -> Customer:
+    return Customer(customer_id=uuid4(), username="user", avatar_url="", display_name="",
+                    status=CustomerStatusEnum.ONLINE, country=None)
+
+
+def chat_with_history(count: int):
+    reader, author = customer(), customer()
+    record = chat_store.create(reader, author)
+    for i in range(count):
+        chat_store.post_message(record, Message(external_request_id=None, message_id=uuid4(),
+                                                create_time=record.messages.next_create_time(), text="message %d" % i,
+                                                author_id=author.customer_id, is_mine=True,
+                                                status=MessageStatusEnum.SENT, type=MessageTypeEnum.MESSAGE,
+                                                parameters=None, update_time=None, offer_hash=None, trade_hash=None,
+                                                attachments=None, prev_message_id=None))
+    return record, reader.customer_id
+
+
+async def direct(record, reader_id) -> int:
+    writes = 0
+    for message in list(record.messages.page(None, len(record.messages))[0]):
+        context_changed, updated = chat_store.mark_read(record, reader_id, [message])
+        notify_acknowledged(record, reader_id, context_changed, updated)
+        writes += context_changed
+    return writes
+
+
+async def coalesced(record, reader_id) -> int:
+    coalescer = AckCoalescer(flush_interval=0.05)
+    for message in list(record.messages.page(None, len(record.messages))[0]):
+        coalescer.acknowledge(record, reader_id, [message], MessageStatusEnum.READ)
+    await coalescer.flush()
+    return coalescer.context_writes
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print("%10s %12s %14s" % ("mode", "acks/s", "context writes"))
+    for name, run in (("direct", direct), ("coalesced", coalesced)):
+        record, reader_id = chat_with_history(count)
+        started = perf_counter()
+        writes = await run(record, reader_id)
+        elapsed = perf_counter() - started
+        assert record.contexts[reader_id].unread_count == 0
+        print("%10s %12.0f %14d" % (name, count / elapsed, writes))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""
+Chat list latency for a customer with many chats: p50 / p99 of building a page of Chat entries from the
+per-customer activity index against sorting all chats of the customer per request. A message is posted to a
+random chat between requests, so the index is also exercised while chats move to the top.
+
+Run from the project root: python -m benchmarks.chat_list [chats]
+"""
+import gc
+import random
+import sys
+from datetime import datetime, timezone
+from statistics import quantiles
+from time import perf_counter
+from uuid import uuid4
+
+from models import ChatContextStatusEnum, Message, MessageStatusEnum, MessageTypeEnum
+from services.chats import ChatStore, chat_key
+from services.customers import customer_directory
+
+LIMIT = 20
+REQUESTS = 500
+
+
+def new_message(author_id):
+    return Message(external_request_id=None, message_id=uuid4(), create_time=datetime.now(timezone.utc), text="hello",
+                   author_id=author_id, is_mine=True, status=MessageStatusEnum.SENT, type=MessageTypeEnum.MESSAGE,
+                   parameters=None, update_time=None, offer_hash=None, trade_hash=None, attachments=None,
+                   prev_message_id=None)
+
+
+def naive_page(store, customer_id, after, matches):
+    records = sorted(store.chats_of(customer_id), key=lambda record: chat_key(record, customer_id), reverse=True)
+    if after is not None:
+        records = [record for record in records if chat_key(record, customer_id) < after]
+    return [record for record in records if matches is None or matches(record)][:LIMIT]
+
+
+def indexed_page(store, customer_id, after, matches):
+    return store.chat_index(customer_id).page(after, LIMIT, True, matches)[0]
+
+
+def measure(store, customer_id, page, after, matches):
+    records = store.chats_of(customer_id)
+    timings = []
+    gc.collect()
+    for _ in range(REQUESTS):
+        record = random.choice(records)
+        store.post_message(record, new_message(record.partner_of(customer_id)))
+        started = perf_counter()
+        [store.summary(record, customer_id) for record in page(store, customer_id, after, matches)]
+        timings.append((perf_counter() - started) * 1e6)
+    cuts = quantiles(timings, n=100)
+    return cuts[49], cuts[98]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    store = ChatStore()
+    me = customer_directory.get(uuid4())
+    for _ in range(count):
+        store.create(me, customer_directory.get(uuid4()))
+    customer_id = me.customer_id
+    for record in random.sample(list(store.chats_of(customer_id)), count // 10):
+        store.block(record, customer_id)
+    middle = chat_key(store.chat_index(customer_id).records()[count // 2], customer_id)
+
+    def blocked(record):
+        return record.contexts[customer_id].status == ChatContextStatusEnum.BLOCKED
+
+    print("chats=%d limit=%d requests=%d" % (count, LIMIT, REQUESTS))
+    print("%-22s %12s %12s %12s %12s" % ("page", "naive p50", "naive p99", "index p50", "index p99"))
+    for name, after, matches in (("first", None, None), ("middle", middle, None),
+                                 ("first, BLOCKED only", None, blocked)):
+        print("%-22s %12.1f %12.1f %12.1f %12.1f" % (name, *measure(store, customer_id, naive_page, after, matches),
+                                                     *measure(store, customer_id, indexed_page, after, matches)))
+    print("(microseconds)")
+
+
+if __name__ == "__main__":
+    main()
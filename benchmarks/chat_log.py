@@ -0,0 +1,201 @@
+"""
+Chat log: group commit and restart time.
+
+Group commit: writers append a message-sized record and wait for it to be on disk, as send_message does, for a
+few seconds at each concurrency. Reports the commits per second, the fsyncs they took and the commit latency.
+
+Restart: writes a log of the given number of messages spread over the given number of chats, snapshots it,
+appends a tail of messages and chats after the snapshot, drops the files from the page cache and starts a fresh
+process that restores the chats. Reports the time from process start to ready and the time of the restore
+itself against RESTART_TARGET, then the first access to a chat, which reads its messages from the log.
+
+Run from the project root: python -m benchmarks.chat_log [messages] [chats]
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from uuid import UUID, uuid4
+
+from pydantic import TypeAdapter
+
+from models import Customer, CustomerStatusEnum, Message, MessageStatusEnum, MessageTypeEnum
+from services.chat_log import MESSAGE, ChatLog
+from services.chats import chat_store
+from services.shards import chat_shards
+from services.wal import WriteAheadLog
+
+COMMIT_SECONDS = 3
+CONCURRENCY = (1, 16, 256)
+TAIL_MESSAGES = 10_000
+TAIL_CHATS = 1_000
+# Seconds from starting a process on the log of 10M messages in 100k chats to serving requests, on one core
+RESTART_TARGET = 10.0
+READ = bytes([list(MessageStatusEnum).index(MessageStatusEnum.READ)])
+TEXT = "Sure, I can send the payment in an hour, please confirm the details once more"
+
+
+async def group_commit(directory: str, concurrency: int) -> None:
+    wal = WriteAheadLog(directory)
+    wal.open()
+    payload = os.urandom(16) + b"x" * 320
+    latencies = []
+    deadline = perf_counter() + COMMIT_SECONDS
+
+    async def writer() -> None:
+        while perf_counter() < deadline:
+            started = perf_counter()
+            wal.append(MESSAGE, payload)
+            await wal.commit()
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    await asyncio.gather(*(writer() for _ in range(concurrency)))
+    elapsed = perf_counter() - started
+    await wal.close()
+    latencies.sort()
+    print("concurrency %3d: %7.0f commits/s, %6d fsyncs, %6.1f commits per fsync, latency p50 %6.2f ms, "
+          "p99 %6.2f ms" % (concurrency, len(latencies) / elapsed, wal.syncs, len(latencies) / wal.syncs,
+                            latencies[len(latencies) // 2] * 1e3, latencies[len(latencies) * 99 // 100] * 1e3))
+
+
+def customer(customer_id: UUID) -> Customer:
+    return Customer(customer_id=customer_id, username=customer_id.hex[:12], avatar_url="",
+                    display_name="Customer %s" % customer_id.hex[:6], status=CustomerStatusEnum.ONLINE, country=None)
+
+
+def message_template() -> bytes:
+    """Message JSON as the log holds it, with the id, creation time and author left to fill in."""
+    message = Message(external_request_id=None, message_id=UUID(int=1), text=TEXT, author_id=UUID(int=2),
+                      create_time=datetime(2000, 1, 1, tzinfo=timezone.utc), is_mine=True,
+                      status=MessageStatusEnum.SENT, type=MessageTypeEnum.MESSAGE, parameters=None, update_time=None,
+                      offer_hash=None, trade_hash=None, attachments=None, prev_message_id=None)
+    data = Message.__pydantic_serializer__.to_json(message).replace(b"%", b"%%")
+    for value in (str(UUID(int=1)).encode(), b"2000-01-01T00:00:00Z", str(UUID(int=2)).encode()):
+        data = data.replace(value, b"%b", 1)
+    return data
+
+
+def write_messages(log: ChatLog, record, template: bytes, times, count: int) -> None:
+    """Append messages to a chat the way ChatLog.posted does, without building them."""
+    entry = chat_shards.shard(record.chat_id).logs[record.chat_id]
+    chat_id = record.chat_id.bytes
+    authors = [str(member_id).encode() for member_id in record.members]
+    message_id = None
+    for number in range(count):
+        message_id = uuid4()
+        entry.position = log.wal.append(
+            MESSAGE, chat_id + template % (str(message_id).encode(), times[number], authors[number % 2]))
+        entry.locations.append(entry.position)
+    entry.statuses.extend(READ * count)
+    for context in record.contexts.values():
+        context.read_message_id = message_id
+
+
+async def generate(directory: str, messages: int, chats: int) -> None:
+    log = ChatLog(directory, snapshot_interval=3600)
+    log.open()
+    template = message_template()
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    per_chat = messages // chats
+    times = [TypeAdapter(datetime).dump_json(base + timedelta(seconds=number))[1:-1]
+             for number in range(per_chat + TAIL_MESSAGES)]
+    started = perf_counter()
+    records = []
+    for number in range(chats):
+        record = chat_store.create(customer(uuid4()), customer(uuid4()))
+        write_messages(log, record, template, times, per_chat)
+        records.append(record)
+        if number % 1000 == 999:
+            await log.commit()
+    await log.commit()
+    print("wrote %d messages in %d chats in %.1f s, %.0f MB of log" % (
+        per_chat * chats, chats, perf_counter() - started, log.wal.position / 1e6))
+    started = perf_counter()
+    path = await log.snapshot()
+    print("snapshot %.0f MB in %.1f s" % (os.path.getsize(path) / 1e6, perf_counter() - started))
+    for number in range(TAIL_MESSAGES):
+        write_messages(log, random.choice(records), template, times[per_chat + number:], 1)
+    for number in range(TAIL_CHATS):
+        chat_store.create(customer(uuid4()), customer(uuid4()))
+    await log.close()
+    print("tail after the snapshot: %d messages, %d chats" % (TAIL_MESSAGES, TAIL_CHATS))
+
+
+def drop_page_cache(directory: str) -> None:
+    for root, _, names in os.walk(directory):
+        for name in names:
+            descriptor = os.open(os.path.join(root, name), os.O_RDONLY)
+            os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(descriptor)
+
+
+async def restore(directory: str) -> dict:
+    started = perf_counter()
+    log = ChatLog(directory, snapshot_interval=3600)
+    log.open()
+    opened = perf_counter() - started
+    ready = time.time()
+    records = [record for shard in chat_shards.shards() for record in shard.records.values()]
+    chats = len(records)
+    messages = sum(len(entry.locations) for shard in chat_shards.shards() for entry in shard.logs.values())
+    record = next(record for record in records if chat_shards.shard(record.chat_id).logs[record.chat_id].locations)
+    started = perf_counter()
+    assert record.last_message is not None
+    last = perf_counter() - started
+    started = perf_counter()
+    history = len(record.messages)
+    first = perf_counter() - started
+    await log.close()
+    return dict(ready=ready, opened=opened, chats=chats, messages=messages, last=last, history=history, first=first,
+                rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def generate_in_process(directory: str, messages: int, chats: int) -> None:
+    asyncio.run(generate(directory, messages, chats))
+
+
+def restart(directory: str, results) -> None:
+    results.put(asyncio.run(restore(directory)))
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    print("messages=%d chats=%d" % (messages, chats))
+    directory = tempfile.mkdtemp(prefix="chat-log-benchmark-")
+    try:
+        for concurrency in CONCURRENCY:
+            asyncio.run(group_commit(os.path.join(directory, "commit-%d" % concurrency), concurrency))
+
+        context = multiprocessing.get_context("spawn")
+        log_directory = os.path.join(directory, "log")
+        process = context.Process(target=generate_in_process, args=(log_directory, messages, chats))
+        process.start()
+        process.join()
+        drop_page_cache(log_directory)
+        results = context.Queue()
+        started = time.time()
+        process = context.Process(target=restart, args=(log_directory, results))
+        process.start()
+        outcome = results.get()
+        process.join()
+        restart_time = outcome["ready"] - started
+        print("restart: %d chats, %d messages, ready %.2f s after process start (restore %.2f s), target %.1f s: %s"
+              % (outcome["chats"], outcome["messages"], restart_time, outcome["opened"], RESTART_TARGET,
+                 "met" if restart_time < RESTART_TARGET else "MISSED"))
+        print("first access: last message %.2f ms, history of %d messages %.2f ms; peak RSS %.0f MB" % (
+            outcome["last"] * 1e3, outcome["history"], outcome["first"] * 1e3, outcome["rss"]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
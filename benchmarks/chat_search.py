@@ -0,0 +1,71 @@
+"""
+Chat name search for a customer with many chats: the first page of `list_chats?q=` served from the trigram
+index against a substring scan over every chat name, for type-ahead queries of growing length. Queries under
+three characters are word-prefix matches in the index, so their hit counts differ from the scan.
+
+Run from the project root: python -m benchmarks.chat_search [chats]
+"""
+import gc
+import random
+import string
+import sys
+from time import perf_counter
+from uuid import uuid4
+
+from models import Customer, CustomerStatusEnum
+from services.chats import ChatStore
+
+LIMIT = 20
+REPEAT = 50
+
+
+def username(rng: random.Random) -> str:
+    syllables = ["".join(rng.choice(string.ascii_lowercase) for _ in range(2)) for _ in range(rng.randint(2, 4))]
+    return "".join(syllables).capitalize() + str(rng.randint(0, 999))
+
+
+def naive_page(store, customer_id, query):
+    query = query.casefold()
+    hits = [record for record in reversed(store.chat_index(customer_id).records())
+            if query in record.contexts[customer_id].chat_name.casefold()]
+    return hits[:LIMIT]
+
+
+def indexed_page(store, customer_id, query):
+    hits = store.search_chats(customer_id, query)
+    return store.chat_index(customer_id).page_among(hits, None, LIMIT)[0]
+
+
+def measure(func, *args) -> float:
+    gc.collect()
+    started = perf_counter()
+    for _ in range(REPEAT):
+        func(*args)
+    return (perf_counter() - started) / REPEAT * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rng = random.Random(1)
+    store = ChatStore()
+    me = Customer(customer_id=uuid4(), username="me", avatar_url="", display_name="", status=CustomerStatusEnum.ONLINE,
+                  country=None)
+    partners = [Customer(customer_id=uuid4(), username=username(rng), avatar_url="", display_name="",
+                         status=CustomerStatusEnum.ONLINE, country=None) for _ in range(count)]
+    started = perf_counter()
+    for partner in partners:
+        store.create(me, partner)
+    print("chats=%d limit=%d, created and indexed in %.1f s" % (count, LIMIT, perf_counter() - started))
+
+    target = partners[count // 2].username
+    print("%-16s %8s %12s %12s" % ("query", "hits", "scan, us", "index, us"))
+    for query in (target[:1], target[:2], target[:3], target[:5], target, "zzzzq"):
+        hits = len(store.search_chats(me.customer_id, query))
+        if len(query) >= 3:
+            assert naive_page(store, me.customer_id, query) == indexed_page(store, me.customer_id, query)
+        print("%-16s %8d %12.1f %12.1f" % (query, hits, measure(naive_page, store, me.customer_id, query),
+                                           measure(indexed_page, store, me.customer_id, query)))
+
+
+if __name__ == "__main__":
+    main()
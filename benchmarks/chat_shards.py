@@ -0,0 +1,62 @@
+"""
+Chat sharding on the consistent hash ring: the cost of routing a chat id to its shard next to a plain dict
+lookup, how evenly the chats spread over the shards, and rebalancing when the shard count changes. For each
+change the chats moved by the ring are compared with the chats key % shards would move.
+
+Run from the project root: python -m benchmarks.chat_shards [chats] [shards]
+"""
+import sys
+from time import perf_counter
+from uuid import uuid4
+
+from services.shards import ChatShards, chat_hash
+
+LOOKUPS = 200_000
+
+
+def moved_by_modulo(keys, before: int, after: int) -> int:
+    return sum(1 for key in keys if key % before != key % after)
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    chat_ids = [uuid4() for _ in range(chats)]
+    print("chats=%d shards=%d" % (chats, shards))
+
+    plain = {chat_id: chat_id for chat_id in chat_ids}
+    sharded = ChatShards(shards)
+    for chat_id in chat_ids:
+        sharded.shard(chat_id).records[chat_id] = chat_id
+        sharded.shard(chat_id).messages[chat_id] = chat_id
+    stream = [chat_ids[i * 7919 % chats] for i in range(LOOKUPS)]
+    started = perf_counter()
+    for chat_id in stream:
+        plain.get(chat_id)
+    dict_lookup = (perf_counter() - started) / LOOKUPS
+    started = perf_counter()
+    for chat_id in stream:
+        sharded.shard(chat_id).records.get(chat_id)
+    shard_lookup = (perf_counter() - started) / LOOKUPS
+    print("lookup: dict %.2f us, shard + dict %.2f us" % (dict_lookup * 1e6, shard_lookup * 1e6))
+    sizes = [len(shard) for shard in sharded.shards()]
+    print("shard sizes: min %d, max %d, mean %d" % (min(sizes), max(sizes), chats // shards))
+
+    keys = [chat_hash(chat_id) for chat_id in chat_ids]
+    for count in (shards + 1, shards + shards // 4, shards * 2, shards - shards // 4, shards // 2):
+        sharded = ChatShards(shards)
+        for chat_id in chat_ids:
+            sharded.shard(chat_id).records[chat_id] = chat_id
+            sharded.shard(chat_id).messages[chat_id] = chat_id
+        started = perf_counter()
+        moved = sharded.resize(count)
+        elapsed = perf_counter() - started
+        assert sum(len(shard) for shard in sharded.shards()) == chats
+        assert all(chat_id in sharded.shard(chat_id).messages for chat_id in chat_ids[:1000])
+        print("%2d -> %2d shards: moved %6d chats (%5.1f%%) in %6.1f ms, key %% shards would move %5.1f%%" % (
+            shards, count, moved, moved / chats * 100, elapsed * 1e3,
+            moved_by_modulo(keys, shards, count) / chats * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+check_responders resolution cost at 10, 100 and 1000 ids per call: a per-id validated lookup against
+PresenceIndex.resolve, cold (memo empty) and warm (memoized).
+
+Run from the project root: python -m benchmarks.check_responders
+"""
+import gc
+from time import perf_counter
+from uuid import uuid4
+
+from models import CustomerStatusEnum, ProfileBaseWithChatId
+from services.customers import customer_directory
+from services.presence import PresenceIndex
+
+CALLS = 200
+
+
+def naive(index: PresenceIndex, customer_ids):
+    return [ProfileBaseWithChatId(customer_id=customer_id,
+                                  status=CustomerStatusEnum.ONLINE if index.is_online(customer_id)
+                                  else CustomerStatusEnum.OFFLINE,
+                                  accept_chat_messages=customer_directory.accept_chat_messages(customer_id),
+                                  chat_id=None)
+            for customer_id in customer_ids]
+
+
+def measure(func, batches) -> float:
+    gc.collect()
+    started = perf_counter()
+    for batch in batches:
+        func(batch)
+    return (perf_counter() - started) / len(batches) * 1e6
+
+
+def main():
+    print("%8s %12s %12s %12s" % ("ids", "naive, us", "cold, us", "warm, us"))
+    for size in (10, 100, 1000):
+        index = PresenceIndex()
+        population = [uuid4() for _ in range(size * 10)]
+        for customer_id in population[::3]:
+            index.connected(customer_id)
+        batches = [population[i % 10 * size:(i % 10 + 1) * size] for i in range(CALLS)]
+        cold = [[uuid4() for _ in range(size)] for _ in range(CALLS)]
+        print("%8d %12.1f %12.1f %12.1f" % (size, measure(lambda batch: naive(index, batch), batches),
+                                            measure(index.resolve, cold), measure(index.resolve, batches)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Inbox events across worker processes on the Unix socket event bus: every worker subscribes to its own share of
+the channels and publishes the same number of events round-robin over all of them, so with N workers (N-1)/N of
+the events cross to another process. Reports the events published and delivered per second of the whole run and
+checks that every subscriber saw the events of each publisher in order. The total number of events published is
+the same for every worker count; on one core the workers take turns, so the figures show the cost of the bus
+rather than how it scales.
+
+Run from the project root: python -m benchmarks.event_bus [events] [workers,...]
+"""
+import asyncio
+import multiprocessing
+import shutil
+import sys
+import tempfile
+from time import monotonic
+
+from services.event_bus import UnixSocketEventBus
+from services.inbox import InboxHub
+
+CHANNELS = 32
+PUBLISH_BATCH = 64
+TIMEOUT = 120
+
+
+async def run_worker(index: int, workers: int, directory: str, published: int, barrier, results) -> None:
+    loop = asyncio.get_running_loop()
+    hub = InboxHub(UnixSocketEventBus(directory))
+    channels = ["inbox.%d.%d" % (worker, channel) for worker in range(workers) for channel in range(CHANNELS)]
+    subscriptions = [hub.subscribe(channel) for channel in channels[index * CHANNELS:(index + 1) * CHANNELS]]
+    while len(hub.bus.channels()) < (workers - 1) * CHANNELS:
+        await asyncio.sleep(0.01)
+    expected = published // len(channels) * workers * CHANNELS
+    received = out_of_order = 0
+    done = asyncio.Event()
+
+    async def consume(subscription) -> None:
+        nonlocal received, out_of_order
+        last = {}
+        while (batch := await subscription.next_batch()) is not None:
+            for event in batch:
+                publisher, _, number = event.partition(":")
+                if int(number) <= last.get(publisher, -1):
+                    out_of_order += 1
+                last[publisher] = int(number)
+            received += len(batch)
+            if received >= expected:
+                done.set()
+
+    await loop.run_in_executor(None, barrier.wait)
+    consumers = [asyncio.ensure_future(consume(subscription)) for subscription in subscriptions]
+    started = monotonic()
+    for number in range(published):
+        hub.publish(channels[number % len(channels)], "%d:%d" % (index, number))
+        if number % PUBLISH_BATCH == PUBLISH_BATCH - 1:
+            await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(done.wait(), TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    finished = monotonic()
+    results.put((started, finished, received, expected, out_of_order, hub.shed_count))
+    await loop.run_in_executor(None, barrier.wait)
+    for consumer in consumers:
+        consumer.cancel()
+    hub.bus.close()
+
+
+def worker(*args) -> None:
+    asyncio.run(run_worker(*args))
+
+
+def run(workers: int, events: int) -> None:
+    directory = tempfile.mkdtemp(prefix="event-bus-benchmark-")
+    published = events // workers // (workers * CHANNELS) * (workers * CHANNELS)
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(index, workers, directory, published, barrier, results))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    shutil.rmtree(directory)
+
+    elapsed = max(outcome[1] for outcome in outcomes) - min(outcome[0] for outcome in outcomes)
+    received = sum(outcome[2] for outcome in outcomes)
+    expected = sum(outcome[3] for outcome in outcomes)
+    print("%2d workers: %7d published %9.0f/s, %7d of %7d delivered %9.0f/s (%3.0f%% remote), "
+          "out of order %d, shed %d" % (
+              workers, published * workers, published * workers / elapsed, received, expected, received / elapsed,
+              (workers - 1) / workers * 100, sum(outcome[4] for outcome in outcomes),
+              sum(outcome[5] for outcome in outcomes)))
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    counts = [int(count) for count in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 4, 16]
+    print("events=%d channels per worker=%d" % (events, CHANNELS))
+    for workers in counts:
+        run(workers, events)
+
+
+if __name__ == "__main__":
+    main()
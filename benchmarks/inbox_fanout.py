@@ -0,0 +1,62 @@
+"""
+Inbox hub load test: idle and active subscribers in one process, each drained by its own task the way the
+WebSocket / SSE endpoints drain them. Socket writes are not included, so the numbers are the hub's own cost.
+
+Every active channel gets its events in bursts of BURST, published back to back.
+
+Run from the project root: python -m benchmarks.inbox_fanout [idle] [active] [events per active channel]
+"""
+import asyncio
+import resource
+import sys
+from time import perf_counter
+
+from services.inbox import InboxHub
+
+BURST = 5
+
+
+async def drain(subscription, stats):
+    while (batch := await subscription.next_batch()) is not None:
+        stats["events"] += len(batch)
+        stats["batches"] += 1
+
+
+async def main():
+    idle = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    active = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    per_channel = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    hub = InboxHub()
+    stats = {"events": 0, "batches": 0}
+
+    started = perf_counter()
+    tasks = [asyncio.ensure_future(drain(hub.subscribe("inbox.%d" % i), stats)) for i in range(idle + active)]
+    await asyncio.sleep(0)
+    print("subscribers=%d (idle=%d active=%d) subscribed in %.2fs, max RSS %.0f MB"
+          % (idle + active, idle, active, perf_counter() - started,
+             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    event = '{"type":"message","chat_id":null,"data":{"text":"%s"}}' % ("x" * 200)
+    channels = ["inbox.%d" % i for i in range(idle, idle + active)]
+    total = active * per_channel
+    started = perf_counter()
+    for _ in range(per_channel // BURST):
+        for channel in channels:
+            for _ in range(BURST):
+                hub.publish(channel, event)
+        await asyncio.sleep(0)
+    published = perf_counter() - started
+    while stats["events"] < total and hub.shed_count == 0:
+        await asyncio.sleep(0)
+    delivered = perf_counter() - started
+    print("published %d events in %.2fs (%.0f/s), delivered in %.2fs (%.0f/s), %.1f events per batch, shed=%d"
+          % (total, published, total / published, delivered, total / delivered,
+             stats["events"] / max(stats["batches"], 1), hub.shed_count))
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Activating a marketing broadcast for a large audience: the shared timeline with per-customer read pointers
+against copying one inbox row per customer. Half of the customers have read an earlier broadcast, so they have
+a read pointer; the other half are first seen by the count, which starts their pointer at the end of the
+timeline. Customers are plain ints to keep the run within memory.
+
+Run from the project root: python -m benchmarks.marketing_broadcast [customers]
+"""
+import asyncio
+import gc
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from models import MarketingMessage, MarketingMessageStatusEnum
+from services.marketing import MarketingStore
+
+
+def broadcast(start_time):
+    return MarketingMessage(external_request_id=None, marketing_id=uuid4(), text="New feature", title=None,
+                            status=MarketingMessageStatusEnum.PENDING, link=None, link_text=None,
+                            create_time=datetime.now(timezone.utc), update_time=None, start_time=start_time,
+                            author="marketing@example.com")
+
+
+async def main():
+    customers = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    store = MarketingStore()
+    store.create(broadcast(None))
+    for customer_id in range(0, customers, 2):
+        store.read_all(customer_id)
+    print("customers=%d, read pointers=%d" % (customers, (customers + 1) // 2))
+
+    start_time = datetime.now(timezone.utc) + timedelta(hours=1)
+    started = perf_counter()
+    store.create(broadcast(start_time))
+    scheduled = perf_counter() - started
+    gc.collect()
+    started = perf_counter()
+    store.activate_due(start_time.timestamp() + 1)
+    activated = perf_counter() - started
+    started = perf_counter()
+    unread = sum(store.unread_count(customer_id) for customer_id in range(customers))
+    counted = perf_counter() - started
+    assert unread == (customers + 1) // 2
+
+    inboxes = [[] for _ in range(customers)]
+    row = (uuid4(), time.time())
+    gc.collect()
+    started = perf_counter()
+    for inbox in inboxes:
+        inbox.append(row)
+    copied = perf_counter() - started
+
+    print("%-46s %12.1f us" % ("timeline: schedule into the timer wheel", scheduled * 1e6))
+    print("%-46s %12.1f us" % ("timeline: activate on the wheel tick", activated * 1e6))
+    print("%-46s %12.3f us" % ("timeline: marketing_unread_count per customer", counted / customers * 1e6))
+    print("%-46s %12.1f ms (%d rows)" % ("copy: one inbox row per customer", copied * 1e3, customers))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
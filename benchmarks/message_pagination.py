@@ -0,0 +1,64 @@
+"""
+Deep-page latency of the indexed message store against a naive list scan.
+
+Run from the project root: python -m benchmarks.message_pagination [messages]
+"""
+import sys
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from models import Message, MessageStatusEnum, MessageTypeEnum
+from services.messages import ChatMessages, message_key
+
+LIMIT = 20
+REPEAT = 20
+
+
+def build_history(count: int):
+    author_id = uuid4()
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    history = ChatMessages()
+    naive = []
+    for i in range(count):
+        message = Message.model_construct(external_request_id=None, message_id=uuid4(),
+                                          create_time=start + timedelta(microseconds=i), text="message %d" % i,
+                                          author_id=author_id, is_mine=True, status=MessageStatusEnum.SENT,
+                                          type=MessageTypeEnum.MESSAGE, parameters=None, update_time=None,
+                                          offer_hash=None, trade_hash=None, attachments=None, prev_message_id=None)
+        history.add(message)
+        naive.append(message)
+    return history, naive
+
+
+def naive_page(messages, cursor_id, limit):
+    for position, message in enumerate(messages):
+        if message.message_id == cursor_id:
+            return messages[position + 1:position + 1 + limit]
+    return []
+
+
+def indexed_page(history, cursor_id, limit):
+    return history.page(message_key(history.get(cursor_id)), limit)[0]
+
+
+def measure(func, *args) -> float:
+    started = perf_counter()
+    for _ in range(REPEAT):
+        func(*args)
+    return (perf_counter() - started) / REPEAT * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    history, naive = build_history(count)
+    print("messages=%d limit=%d" % (count, LIMIT))
+    print("%12s %14s %14s" % ("depth", "naive, us", "indexed, us"))
+    for depth in (0, count // 100, count // 10, count // 2, count - LIMIT - 1):
+        cursor_id = naive[depth].message_id
+        print("%12d %14.1f %14.1f" % (depth, measure(naive_page, naive, cursor_id, LIMIT),
+                                      measure(indexed_page, history, cursor_id, LIMIT)))
+
+
+if __name__ == "__main__":
+    main()
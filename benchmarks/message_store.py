@@ -0,0 +1,129 @@
+"""
+Message history memory and list throughput: the columnar ChatMessages against a history of Message objects, the
+way histories were kept before. The messages are validated from JSON as the chat log reads them back, about one
+in ten of them a system message with parameters or one with an attachment.
+
+Memory is the heap traced while the history is built, per message. Throughput is list_messages pages of LIMIT
+messages at random depths, seeked by the page token key and serialized to JSON, and lookups by message id.
+
+Run from the project root: python -m benchmarks.message_store [messages]
+"""
+import random
+import sys
+import tracemalloc
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from models import Message, MessageAttachment, MessageListResponse, MessageStatusEnum, MessageTypeEnum, \
+    SystemMessageParameters
+from services.messages import ChatMessages, message_key
+
+LIMIT = 20
+PAGES = 5_000
+LOOKUPS = 50_000
+TEXTS = ("ok", "Sure, I can send the payment in an hour, please confirm the details once more",
+         "Thanks! Received it", "What bank do you use?")
+
+
+class ObjectHistory:
+    """The history as Message objects with the key list and the id index."""
+
+    def __init__(self):
+        self._keys = []
+        self._messages = []
+        self._by_id = {}
+
+    def add(self, message: Message) -> None:
+        self._keys.append(message_key(message))
+        self._messages.append(message)
+        self._by_id[message.message_id] = message
+
+    def get(self, message_id):
+        return self._by_id.get(message_id)
+
+    def page(self, after, limit, descending=False):
+        if descending:
+            end = bisect_left(self._keys, after) if after is not None else len(self._keys)
+            start = max(0, end - limit)
+            return self._messages[start:end][::-1], start > 0
+        start = bisect_right(self._keys, after) if after is not None else 0
+        return self._messages[start:start + limit], start + limit < len(self._messages)
+
+
+def message_json(number: int, authors, previous) -> bytes:
+    kind = MessageTypeEnum.SYSTEM if number % 10 == 0 else MessageTypeEnum.MESSAGE
+    message = Message(
+        external_request_id=None, message_id=uuid4(),
+        create_time=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=number),
+        text="Trade started" if kind == MessageTypeEnum.SYSTEM else TEXTS[number % len(TEXTS)],
+        author_id=authors[number % 2], is_mine=True, status=MessageStatusEnum.READ, type=kind,
+        parameters=SystemMessageParameters(type="trade_started_receiver", link="https://example.com/t",
+                                           link_text="view trade", message="Trade started", title=None,
+                                           chat_id=None, message_placeholders=None)
+        if kind == MessageTypeEnum.SYSTEM else None,
+        update_time=None, offer_hash=None, trade_hash=None,
+        attachments=[MessageAttachment(filename="image.png", uri="https://example.com/image.png",
+                                       thumbnail_uri="https://example.com/small_image.png")]
+        if number % 10 == 5 else None,
+        prev_message_id=previous)
+    return Message.__pydantic_serializer__.to_json(message)
+
+
+def build(history_class, documents):
+    """The history built from the documents and the bytes it took."""
+    tracemalloc.start()
+    history = history_class()
+    for document in documents:
+        history.add(Message.model_validate_json(document))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return history, size
+
+
+def list_pages(history, keys) -> float:
+    started = perf_counter()
+    for key, descending in keys:
+        items, _ = history.page(key, LIMIT, descending)
+        MessageListResponse.__pydantic_serializer__.to_json(MessageListResponse(
+            limit=LIMIT, next_page_token=None, prev_page_token=None, items=items))
+    return len(keys) / (perf_counter() - started)
+
+
+def lookups(history, message_ids) -> float:
+    started = perf_counter()
+    for message_id in message_ids:
+        history.get(message_id)
+    return len(message_ids) / (perf_counter() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    authors = (uuid4(), uuid4())
+    documents = []
+    previous = None
+    for number in range(count):
+        documents.append(message_json(number, authors, previous))
+        previous = Message.model_validate_json(documents[-1]).message_id
+    print("messages=%d limit=%d" % (count, LIMIT))
+    print("%10s %14s %12s %14s %12s" % ("store", "bytes/message", "build, s", "list pages/s", "lookups/s"))
+    rows = {}
+    for name, history_class in (("objects", ObjectHistory), ("columns", ChatMessages)):
+        started = perf_counter()
+        history, size = build(history_class, documents)
+        built = perf_counter() - started
+        assert history.page(None, count)[0][-1].model_dump() == Message.model_validate_json(documents[-1]).model_dump()
+        messages = history.page(None, count)[0]
+        random.seed(1)
+        keys = [(message_key(random.choice(messages)), random.random() < 0.5) for _ in range(PAGES)]
+        message_ids = [random.choice(messages).message_id for _ in range(LOOKUPS)]
+        del messages
+        rows[name] = size / count, list_pages(history, keys), lookups(history, message_ids)
+        print("%10s %14.0f %12.2f %14.0f %12.0f" % (name, rows[name][0], built, rows[name][1], rows[name][2]))
+    print("columns take %.1fx less memory, list at %.2fx the speed" % (
+        rows["objects"][0] / rows["columns"][0], rows["columns"][1] / rows["objects"][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Decoding message lists: validating mixed-type messages with parameters dispatched on the message type against
+the plain union, which tries the parameter models in turn. The union model is Message rebuilt from the same
+fields without the dispatching validator.
+
+Run from the project root: python -m benchmarks.message_validation [messages]
+"""
+import gc
+import json
+import sys
+from time import perf_counter
+from typing import List
+from uuid import uuid4
+
+from pydantic import TypeAdapter, create_model
+
+from models import Message, MessageTypeEnum
+
+REPEATS = 5
+
+TRADE = {"offer_type": "sell", "crypto_currency": "BTC", "fiat_currency": "USD", "fiat_price_per_crypto": "19900",
+         "crypto_amount_requested": "0.005", "crypto_amount_total": "0.0051", "fee_percentage": "2",
+         "fee_crypto_amount": "0.0001", "fiat_amount_requested": "100", "payment_method_name": "Amazon Gift Card",
+         "payment_method_slug": "amazon-gift-card", "margin": "19900", "crypto_to_fiat_amount": "99.5",
+         "fee_crypto_to_fiat_amount": "2.5", "crypto_to_fiat_amount_total": "100.5", "offer_terms": "offer terms",
+         "trade_status": "Active funded", "offer_owner_id": str(uuid4())}
+OFFER = {"offer_type": "buy", "crypto_currency": "BTC", "fiat_currency": "USD", "fiat_price_per_crypto": "19900",
+         "crypto_amount": "0.005", "fee_percentage": "2", "fiat_amount": "100",
+         "payment_method_name": "Amazon Gift Card", "payment_method_slug": "amazon-gift-card", "margin": "19900",
+         "crypto_to_fiat_amount": "99.5", "fee_crypto_amount": "0.0001", "fee_crypto_to_fiat_amount": "2.5",
+         "crypto_amount_total": "0.0051", "crypto_to_fiat_amount_total": "100.5", "active": True,
+         "offer_owner_id": str(uuid4()), "offer_accepted": False, "offer_terms": "offer terms"}
+TRANSFER = {"id": str(uuid4()), "status": "success", "crypto_currency": "BTC", "fiat_currency": "USD",
+            "crypto_amount": "0.005", "fiat_amount": "100", "sender_customer_id": str(uuid4()),
+            "crypto_total_amount": None, "crypto_fee": None, "fiat_total_amount": None, "fiat_fee": None}
+SYSTEM = {"type": "trade_started_receiver", "link": "/trade/F8Mc6Jejy9G", "link_text": "view trade",
+          "message": "Trade started", "title": None, "chat_id": None, "message_placeholders": {"hash": "F8Mc6Jejy9G"}}
+MIX = ((MessageTypeEnum.MESSAGE, None), (MessageTypeEnum.SPECIAL_TRADE, TRADE), (MessageTypeEnum.SPECIAL_OFFER, OFFER),
+       (MessageTypeEnum.INTERNAL_TRANSFER, TRANSFER), (MessageTypeEnum.SYSTEM, SYSTEM))
+
+
+def messages(count: int):
+    items = []
+    for i in range(count):
+        message_type, parameters = MIX[i % len(MIX)]
+        items.append({"external_request_id": None, "message_id": str(uuid4()), "create_time": "2021-04-01T10:34:15Z",
+                      "text": "Message %d" % i, "author_id": str(uuid4()), "is_mine": False, "status": "READ",
+                      "type": message_type.value, "parameters": parameters, "update_time": None,
+                      "offer_hash": None, "trade_hash": None, "attachments": None, "prev_message_id": None})
+    return items
+
+
+def best(validate, data) -> float:
+    """Fastest of the repeats, with the cyclic collector kept out of the timings."""
+    timings = []
+    for _ in range(REPEATS):
+        gc.collect()
+        gc.disable()
+        started = perf_counter()
+        validate(data)
+        timings.append(perf_counter() - started)
+        gc.enable()
+    return min(timings)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    union_message = create_model("UnionMessage", **{name: (field.annotation, field)
+                                                    for name, field in Message.model_fields.items()})
+    items = messages(count)
+    document = json.dumps(items)
+    print("messages=%d, %d of each type" % (count, count // len(MIX)))
+    for name, model in (("union", union_message), ("by type", Message)):
+        adapter = TypeAdapter(List[model])
+        validated = adapter.validate_python(items)
+        assert [type(message.parameters).__name__ for message in validated[:len(MIX)]] == \
+               ["NoneType", "SpecialTradeParameters", "SpecialOfferParameters", "InternalTransferParameters",
+                "SystemMessageParameters"]
+        python = best(adapter.validate_python, items)
+        from_json = best(adapter.validate_json, document)
+        print("%-8s python %8.1f ms (%5.2f us/msg)   json %8.1f ms (%5.2f us/msg)" % (
+            name, python * 1e3, python / count * 1e6, from_json * 1e3, from_json / count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Building the messages and chat contexts the stores unpack: services.packing.construct against
+Model.model_construct for the same values, after checking both build equal models with the same fields set.
+
+Run from the project root: python -m benchmarks.packing [models]
+"""
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from models import ChatContext, ChatContextStatusEnum, Message, MessageStatusEnum, MessageTypeEnum
+from services.packing import construct
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def message_values() -> dict:
+    return {"external_request_id": None, "message_id": uuid4(), "create_time": NOW, "text": "Thanks! Received it",
+            "author_id": uuid4(), "is_mine": True, "status": MessageStatusEnum.SENT, "type": MessageTypeEnum.MESSAGE,
+            "parameters": None, "update_time": None, "offer_hash": None, "trade_hash": None, "attachments": None,
+            "prev_message_id": None}
+
+
+def context_values() -> dict:
+    return {"chat_name": "partner", "delivered_message_id": uuid4(), "read_message_id": None,
+            "status": ChatContextStatusEnum.ACTIVE, "unread_count": 3, "update_time": NOW, "activity_time": NOW,
+            "blocked_by_me": False}
+
+
+def main():
+    models = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    print("models=%d" % models)
+    for model, values in ((Message, message_values), (ChatContext, context_values)):
+        sample = values()
+        built, expected = construct(model, dict(sample)), model.model_construct(**sample)
+        assert built == expected and built.model_fields_set == expected.model_fields_set
+        batch = [values() for _ in range(models)]
+
+        started = perf_counter()
+        for item in batch:
+            model.model_construct(**item)
+        slow = perf_counter() - started
+
+        started = perf_counter()
+        for item in batch:
+            construct(model, item)
+        fast = perf_counter() - started
+
+        print("%-12s model_construct %6.2f us, construct %6.2f us, %.1fx" % (
+            model.__name__, slow / models * 1e6, fast / models * 1e6, slow / fast))
+
+
+if __name__ == "__main__":
+    main()
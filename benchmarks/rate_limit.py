@@ -0,0 +1,85 @@
+"""
+Rate limiting with token buckets in shared memory: the cost of one check, and how closely a limit holds when 8
+worker processes admit requests of the same customers at once. Every worker attaches to the same segment and
+checks random customers of the pool for the given seconds against the route and scope buckets; the admitted
+requests are compared with what the buckets allow over that time.
+
+Run from the project root: python -m benchmarks.rate_limit [workers] [seconds]
+"""
+import multiprocessing
+import os
+import random
+import sys
+from multiprocessing import shared_memory
+from time import perf_counter, perf_counter_ns
+from uuid import uuid4
+
+from services.rate_limits import RateLimit, SharedBuckets
+
+CUSTOMERS = 200
+ROUTE = RateLimit("send_message", 50, 1)
+SCOPE = RateLimit("chats:write", 80, 1)
+CHECKS = 200_000
+
+
+def check_cost(buckets: SharedBuckets, limits) -> float:
+    customers = [uuid4() for _ in range(1000)]
+    stream = [random.choice(customers) for _ in range(CHECKS)]
+    acquire = buckets.acquire
+    started = perf_counter_ns()
+    for customer_id in stream:
+        acquire(customer_id, limits)
+    return (perf_counter_ns() - started) / CHECKS
+
+
+def worker(segment: str, customers, seconds: float, results) -> None:
+    buckets = SharedBuckets(segment)
+    admitted = checks = 0
+    limits = [ROUTE, SCOPE]
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        for _ in range(1000):
+            checks += 1
+            if not buckets.acquire(random.choice(customers), limits):
+                admitted += 1
+    buckets.close()
+    results.put((admitted, checks))
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    segment = "rate-limit-benchmark-%d" % os.getpid()
+
+    print("check cost, one process, random customers")
+    print("  %-34s %8.0f ns" % ("route bucket, private memory", check_cost(SharedBuckets(None), [ROUTE])))
+    print("  %-34s %8.0f ns" % ("route + scope, private memory", check_cost(SharedBuckets(None), [ROUTE, SCOPE])))
+    shared = SharedBuckets(segment)
+    print("  %-34s %8.0f ns" % ("route + scope, shared memory", check_cost(shared, [ROUTE, SCOPE])))
+    shared.close()
+    shared_memory.SharedMemory(segment).unlink()
+
+    segment += "-workers"
+    SharedBuckets(segment).close()
+    customers = [uuid4() for _ in range(CUSTOMERS)]
+    results = multiprocessing.Queue()
+    started = perf_counter()
+    processes = [multiprocessing.Process(target=worker, args=(segment, customers, seconds, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = perf_counter() - started
+    shared_memory.SharedMemory(segment).unlink()
+
+    admitted = sum(outcome[0] for outcome in outcomes)
+    checks = sum(outcome[1] for outcome in outcomes)
+    allowed = CUSTOMERS * (ROUTE.requests + ROUTE.requests / ROUTE.seconds * elapsed)
+    print("%d workers, %d customers, %.1f s: %d checks (%.0f/s), admitted %d of at most %.0f (%+.2f%%)" % (
+        workers, CUSTOMERS, elapsed, checks, checks / elapsed, admitted, allowed, (admitted / allowed - 1) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Response serialization: FastAPI's response_model path (validate the returned object against the response field,
+dump it to Python objects, json.dumps) against ModelResponse, which serializes the model straight to JSON bytes
+with pydantic-core. Lists are measured at several sizes; ChatDetails and Message are single objects.
+
+Run from the project root: python -m benchmarks.response_serialization [repeats]
+"""
+import asyncio
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from dependencies import ModelResponse
+from models import Chat, ChatContext, ChatDetails, ChatListResponse, Customer, CustomerStatusEnum, Message, \
+    MessageAttachment, MessageListResponse, MessageStatusEnum, MessageTypeEnum, SystemMessageParameters
+
+SIZES = (1, 20, 100)
+
+
+def customer(name):
+    return Customer(customer_id=uuid4(), username=name, avatar_url="https://example.com/avatar/%s.png" % name,
+                    display_name=name.title(), status=CustomerStatusEnum.ONLINE, country="RU")
+
+
+def message(i):
+    now = datetime.now(timezone.utc)
+    system = i % 5 == 0
+    return Message(external_request_id=str(uuid4()), message_id=uuid4(), create_time=now,
+                   text="Message number %d with some text" % i, author_id=uuid4(), is_mine=bool(i % 2),
+                   status=MessageStatusEnum.READ, type=MessageTypeEnum.SYSTEM if system else MessageTypeEnum.MESSAGE,
+                   parameters=SystemMessageParameters(type="trade_started_receiver", link="https://example.com/t",
+                                                      link_text="view trade", message="Trade started", title=None,
+                                                      chat_id=None, message_placeholders=None)
+                   if system else None,
+                   update_time=now, offer_hash=None, trade_hash=None,
+                   attachments=[MessageAttachment(filename="image.png", uri="https://example.com/image.png",
+                                                  thumbnail_uri="https://example.com/small_image.png")]
+                   if i % 3 == 0 else None,
+                   prev_message_id=uuid4())
+
+
+def context():
+    now = datetime.now(timezone.utc)
+    return ChatContext(chat_name="Chat with John", delivered_message_id=uuid4(), read_message_id=uuid4(),
+                       unread_count=3, update_time=now, activity_time=now, blocked_by_me=False)
+
+
+def chat(i):
+    return Chat(chat_id=uuid4(), partner=customer("partner%d" % i), last_message=message(i), context=context())
+
+
+def cases():
+    for size in SIZES:
+        yield "MessageListResponse", size, MessageListResponse(
+            limit=size, next_page_token="5498da1bf83a61f58ef6c6d4", prev_page_token=None,
+            items=[message(i) for i in range(size)])
+    for size in SIZES:
+        yield "ChatListResponse", size, ChatListResponse(
+            limit=size, next_page_token="5498da1bf83a61f58ef6c6d4", prev_page_token=None,
+            items=[chat(i) for i in range(size)])
+    yield "ChatDetails", 1, ChatDetails(chat_id=uuid4(), partner=customer("partner"), last_message=message(1),
+                                        context=context(), moderator=None, me=customer("me"), is_started_by_me=True)
+    yield "Message", 1, message(3)
+
+
+async def response_model_path(field, model) -> bytes:
+    return JSONResponse(await serialize_response(field=field, response_content=model)).body
+
+
+async def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("%-20s %5s %14s %14s %8s" % ("model", "items", "response_model", "ModelResponse", "speedup"))
+    for name, size, model in cases():
+        field = create_response_field(name="Response_%s" % name, type_=type(model))
+        assert await response_model_path(field, model) == ModelResponse(model).body
+
+        started = perf_counter()
+        for _ in range(repeats):
+            await response_model_path(field, model)
+        generic = (perf_counter() - started) / repeats
+        started = perf_counter()
+        for _ in range(repeats):
+            ModelResponse(model)
+        fast = (perf_counter() - started) / repeats
+        print("%-20s %5d %11.1f us %11.1f us %7.1fx" % (name, size, generic * 1e6, fast * 1e6, generic / fast))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
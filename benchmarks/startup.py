@@ -0,0 +1,58 @@
+"""
+Cold start of a new process: time to import the app, to start it up (the lifespan, which includes the routers
+unless they were included at import), to serve the first /openapi.json and to serve the first API request, with
+the routers included at import and a generated OpenAPI document against routers included at startup and the
+frozen document. Every run is a fresh interpreter; medians are reported.
+
+Run from the project root: python -m benchmarks.startup [runs]
+"""
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+
+CHILD = """
+import json
+from time import perf_counter
+started = perf_counter()
+import main
+imported = perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(main.app)
+client.__enter__()
+ready = perf_counter()
+client.get("/openapi.json")
+openapi = perf_counter()
+client.get("/api/v3/chats", headers={"Authorization": "Bearer startup"})
+request = perf_counter()
+client.get("/api/v3/chats", headers={"Authorization": "Bearer startup"})
+print(json.dumps({"import": imported - started, "startup": ready - imported, "openapi": openapi - ready,
+                  "first_request": request - openapi, "second_request": perf_counter() - request}))
+client.__exit__(None, None, None)
+"""
+
+CONFIGS = (("at import, generated openapi", {"LAZY_ROUTERS": "0", "OPENAPI_FILE": ""}),
+           ("at startup, frozen openapi", {"LAZY_ROUTERS": "1"}))
+
+
+def run(env):
+    output = subprocess.run([sys.executable, "-c", CHILD], env={**os.environ, **env}, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    run({})
+    print("%-28s %10s %10s %10s %14s %15s" % ("routers", "import", "startup", "openapi", "first request",
+                                              "second request"))
+    for name, env in CONFIGS:
+        results = [run(env) for _ in range(runs)]
+        print("%-28s %7.0f ms %7.0f ms %7.0f ms %11.1f ms %12.2f ms" % (
+            name, *(median(result[phase] for result in results) * 1e3
+                    for phase in ("import", "startup", "openapi", "first_request", "second_request"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+System message ingestion: how long an internal request waits for its submission, and the end-to-end throughput
+of the batched queue against writing every message on its own (post, message notification and context
+notification per message). Events go round-robin over the customers, so with fewer customers a batch holds more
+messages per customer and the grouped writes pay off more.
+
+Run from the project root: python -m benchmarks.system_ingestion [messages] [customers]
+"""
+import asyncio
+import gc
+import statistics
+import sys
+from time import perf_counter
+from uuid import uuid4
+
+from models import SystemMessage
+from services.chats import chat_store
+from services.inbox import notify_context, notify_message
+from services.system_messages import SystemMessageQueue, system_message
+
+REQUEST_SIZE = 1000
+
+
+def events(count: int, customers: int):
+    customer_ids = [uuid4() for _ in range(customers)]
+    return [SystemMessage(customer_id=customer_ids[i % customers], text="New trade %d for Gift Card" % i,
+                          parameters={"type": "trade_started_receiver", "link": "https://example.com/trade/%d" % i,
+                                      "link_text": "view trade"})
+            for i in range(count)]
+
+
+def one_by_one(messages) -> None:
+    for message in messages:
+        record = chat_store.system_chat(message.customer_id)
+        sent = chat_store.post_message(record, system_message(message))
+        notify_message(record, sent)
+        notify_context(record, message.customer_id)
+
+
+async def queued(messages) -> float:
+    queue = SystemMessageQueue()
+    submits = []
+    for start in range(0, len(messages), REQUEST_SIZE):
+        started = perf_counter()
+        queue.submit(messages[start:start + REQUEST_SIZE])
+        submits.append(perf_counter() - started)
+        await asyncio.sleep(0)
+    await queue.join()
+    return statistics.median(submits)
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    customers = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    print("messages=%d customers=%d request=%d" % (count, customers, REQUEST_SIZE))
+
+    messages = events(count, customers)
+    gc.collect()
+    started = perf_counter()
+    one_by_one(messages)
+    elapsed = perf_counter() - started
+    print("%-12s %12.0f msg/s" % ("one by one", count / elapsed))
+
+    messages = events(count, customers)
+    gc.collect()
+    started = perf_counter()
+    submit = await queued(messages)
+    elapsed = perf_counter() - started
+    print("%-12s %12.0f msg/s, median submit of %d: %.1f ms" % ("queued", count / elapsed, REQUEST_SIZE,
+                                                               submit * 1e3))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,21 @@
+import os
+from enum import Enum
+from typing import Dict, List, Optional, Type, TypeVar, Union
+from uuid import UUID, uuid5, NAMESPACE_OID
+
+from fastapi.responses import Response
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from fastapi import status
+from pydantic import BaseModel
 
 from models import ValidationErrorResponse, ErrorResponse
 
+E = TypeVar("E", bound=Enum)
+M = TypeVar("M", bound=BaseModel)
+
+# Set to 0 to send fast-path routes through FastAPI's response_model validation again, e.g. to compare output
+FAST_RESPONSES = os.environ.get("FAST_RESPONSES", "1") != "0"
+
 
 profile_tag = "Profile API"
 chat_tag = "Chat API"
@@ -32,4 +45,61 @@ common_internal_api_errors = {
     status.HTTP_403_FORBIDDEN: {},
     status.HTTP_422_UNPROCESSABLE_ENTITY: {"model": ValidationErrorResponse},
     status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": ErrorResponse}
-}
\ No newline at end of file
+}
+
+rate_limited_api_errors = {
+    status.HTTP_429_TOO_MANY_REQUESTS: {"model": ErrorResponse, "description": "Rate limit of the customer exceeded, "
+                                                                             "see the Retry-After header"}
+}
+
+idempotency_api_errors = {
+    status.HTTP_409_CONFLICT: {"model": ErrorResponse, "description": "external_request_id was already used for a "
+                                                                     "different request"}
+}
+
+
+class ApiError(Exception):
+    """Error rendered as ErrorResponse with the given HTTP status."""
+
+    def __init__(self, status_code: int, code: str, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.message = message
+        self.headers = headers
+
+
+def customer_id_from_token(token: str) -> UUID:
+    """
+    Id of the customer the bearer token belongs to. Tokens are not verified yet, so the id is
+    derived from the token itself and stays stable for the same token.
+    """
+    return uuid5(NAMESPACE_OID, token)
+
+
+def parse_enum_list(value: Optional[str], enum_type: Type[E], field: str) -> List[E]:
+    """Parse a comma-separated list of enum values from a query or body parameter."""
+    if not value:
+        return []
+    try:
+        return [enum_type(item.strip()) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_%s" % field, "Unsupported %s: %s" % (field, value))
+
+
+class ModelResponse(Response):
+    """JSON response serialized straight to bytes by pydantic-core from the declared fields of the model."""
+
+    media_type = "application/json"
+
+    def render(self, content: BaseModel) -> bytes:
+        return content.__pydantic_serializer__.to_json(content)
+
+
+def fast_response(model: M) -> Union[M, ModelResponse]:
+    """
+    Opt-in fast path for routes returning large trusted models built by the services. FastAPI passes a returned
+    Response through as is, so the model is not validated against response_model again, dumped to Python objects
+    and re-encoded by json.dumps. The route keeps its response_model for the OpenAPI schema.
+    """
+    return ModelResponse(model) if FAST_RESPONSES else model
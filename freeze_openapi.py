@@ -0,0 +1,38 @@
+"""
+Build step freezing the OpenAPI document of the app to the file main.py serves, so it is not generated by every
+new process. Run it whenever routes or models change; --check only reports whether the file is up to date.
+
+Run from the project root: python -m freeze_openapi [--check]
+"""
+import json
+import sys
+
+from fastapi import FastAPI
+
+from main import OPENAPI_FILE, app, include_routers
+
+
+def render() -> str:
+    include_routers()
+    return json.dumps(FastAPI.openapi(app), ensure_ascii=False, indent=1) + "\n"
+
+
+def main():
+    document = render()
+    try:
+        with open(OPENAPI_FILE, encoding="utf-8") as file:
+            frozen = file.read()
+    except FileNotFoundError:
+        frozen = None
+    if "--check" in sys.argv[1:]:
+        if frozen != document:
+            sys.exit("%s is out of date, run python -m freeze_openapi" % OPENAPI_FILE)
+        return
+    if frozen != document:
+        with open(OPENAPI_FILE, "w", encoding="utf-8") as file:
+            file.write(document)
+    print("%s: %d bytes" % (OPENAPI_FILE, len(document.encode("utf-8"))))
+
+
+if __name__ == "__main__":
+    main()
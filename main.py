@@ -1,6 +1,33 @@
-from fastapi import FastAPI
+import importlib
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Dict
 
-from routers import messages, chats, profile, attachments
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from dependencies import ApiError
+from models import ErrorResponse
+from services.acks import ack_coalescer
+from services.blobs import blob_store
+from services.chat_log import chat_log
+from services.inbox import INBOX_EVENT_BUS
+from services.rate_limits import shared_buckets
+from services.system_messages import system_message_queue
+
+# Routers in routing order; they are imported and included when the app starts up
+ROUTERS = ("chats", "messages", "profile", "attachments", "inbox", "trades", "marketing")
+# Set to 0 to include the routers while importing the app instead
+LAZY_ROUTERS = os.environ.get("LAZY_ROUTERS", "1") != "0"
+# OpenAPI document frozen by `python -m freeze_openapi`; an empty value generates it from the routes instead
+OPENAPI_FILE = os.environ.get("OPENAPI_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "openapi.json"))
+# Worker processes, as uvicorn and gunicorn read it. Only one is supported: the chats and everything else the
+# API serves are kept in the memory of the process. An inbox event bus between processes needs the secrets
+# below set to the same value in every process.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+SHARED_SECRETS = ("PAGE_TOKEN_SECRET", "INBOX_TOKEN_SECRET")
 
 description = """
 Message Service API gives ability to create chats between customers, send messages, subscribe to chat notification channel 
@@ -8,10 +35,83 @@ and etc. for Messenger product
 
 """
 
-app = FastAPI(title="Message Service API", description=description, version="1.1_17.04.2024")
 
-app.include_router(chats.router)
-app.include_router(messages.router)
-app.include_router(profile.router)
-app.include_router(attachments.router)
+def check_workers() -> None:
+    """
+    Refuse to serve from more than one worker: chats, messages, trades, marketing messages, idempotency keys and
+    customer settings are kept in the memory of each process, and only inbox events cross between processes. A
+    second worker would serve chats of its own, and with CHAT_LOG_DIR set could not lock the chat log either.
+    """
+    if WEB_CONCURRENCY > 1:
+        raise RuntimeError("WEB_CONCURRENCY is %d, but the API keeps its state in one process and runs in one worker"
+                           % WEB_CONCURRENCY)
+
+
+def check_shared_secrets() -> None:
+    """
+    Refuse to serve behind an inbox event bus with the token secrets left to each process: a page or inbox token
+    issued by one process would be rejected by the others.
+    """
+    missing = [name for name in SHARED_SECRETS if not os.environ.get(name)]
+    if missing and INBOX_EVENT_BUS != "local":
+        raise RuntimeError("%s must be set when running more than one process" % " and ".join(missing))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Include the routers and restore the chats from the chat log before serving. On shutdown, apply the
+    acknowledgements already answered and write the system messages already accepted, then write out what is
+    still buffered in the log, stop the thumbnail processes and release the rate limit segment.
+    """
+    check_workers()
+    check_shared_secrets()
+    include_routers()
+    chat_log.open()
+    yield
+    await ack_coalescer.flush()
+    await system_message_queue.close()
+    await chat_log.close()
+    await blob_store.thumbnails.close()
+    shared_buckets.close()
+
+
+app = FastAPI(title="Message Service API", description=description, version="1.1_17.04.2024", lifespan=lifespan)
+
+_routers_included = False
+
+
+def include_routers() -> None:
+    """
+    Import the routers and include them in the app. Startup does it rather than the import of the app, so a new
+    process is up sooner and builds the routes once, before it takes requests.
+    """
+    global _routers_included
+    if not _routers_included:
+        _routers_included = True
+        for name in ROUTERS:
+            app.include_router(importlib.import_module("routers.%s" % name).router)
+
+
+def openapi() -> Dict[str, Any]:
+    """The frozen OpenAPI document if there is one, so neither the routers nor the schema are built for it."""
+    if app.openapi_schema is None:
+        if OPENAPI_FILE and os.path.exists(OPENAPI_FILE):
+            with open(OPENAPI_FILE, "rb") as file:
+                app.openapi_schema = json.load(file)
+        else:
+            include_routers()
+            FastAPI.openapi(app)
+    return app.openapi_schema
+
+
+app.openapi = openapi
+if not LAZY_ROUTERS:
+    include_routers()
+
+
+@app.exception_handler(ApiError)
+async def api_error_handler(request: Request, exc: ApiError):
+    return JSONResponse(status_code=exc.status_code, headers=exc.headers,
+                        content=ErrorResponse(code=exc.code, message=exc.message).model_dump())
 
@@ -1,7 +1,7 @@
 from enum import Enum
 
 from fastapi import Query, Depends
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationInfo, ValidatorFunctionWrapHandler, field_validator
 from datetime import datetime
 from typing import List, Optional, Union, Dict, Any, Type
 from uuid import UUID
@@ -85,6 +85,13 @@ class Profile(Customer):
     email: str = Field(readOnly=True)
 
 
+class UnreadCounters(BaseModel):
+    chats_unread_count: int = Field(readOnly=True)
+    trades_unread_count: int = Field(readOnly=True)
+    system_unread_count: int = Field(readOnly=True)
+    marketing_unread_count: int = Field(readOnly=True)
+
+
 class ProfileUpdate(BaseModel):
     accept_chat_messages: AcceptChatMessagesEnum = Field(deprecated=True)
 
@@ -142,6 +149,16 @@ class FileContent(BaseModel):
                                   "allowed.")
 
 
+class AttachmentMetrics(BaseModel):
+    uploads: int = Field(description="Uploaded files", readOnly=True)
+    deduplicated_uploads: int = Field(description="Uploads that matched an already stored file", readOnly=True)
+    dedup_ratio: float = Field(description="Share of uploads that were deduplicated", readOnly=True)
+    thumbnail_cache_hits: int = Field(readOnly=True)
+    thumbnail_cache_misses: int = Field(readOnly=True)
+    thumbnail_cache_hit_rate: float = Field(readOnly=True)
+    thumbnail_cache_bytes: int = Field(description="Size of the cached thumbnails", readOnly=True)
+
+
 class OfferTypeEnum(str, Enum):
     sell = "sell"
     buy = "buy"
@@ -265,6 +282,14 @@ class InternalTransferParameters(BaseModel):
     fiat_fee: Optional[str] = Field(example="0.2", format="decimal")
 
 
+PARAMETERS_BY_MESSAGE_TYPE: Dict[MessageTypeEnum, Type[BaseModel]] = {
+    MessageTypeEnum.SPECIAL_TRADE: SpecialTradeParameters,
+    MessageTypeEnum.SPECIAL_OFFER: SpecialOfferParameters,
+    MessageTypeEnum.INTERNAL_TRANSFER: InternalTransferParameters,
+    MessageTypeEnum.SYSTEM: SystemMessageParameters,
+}
+
+
 class MessageSimple(BaseModel):
     external_request_id: Optional[str] = Field(example="bb638f26-7064-4285-94b3-ce5d48f29b9b", max_length=40,
                                                title="Idempotence key, provided by the caller")
@@ -290,6 +315,18 @@ class MessageSimple(BaseModel):
     trade_hash: Optional[str] = Field(example="lJkgEzVgCaT", max_length=40,
                                       description="Optional Trade Hash, applicable to SPECIAL_TRADE type")
 
+    @field_validator("parameters", mode="wrap")
+    @classmethod
+    def parameters_by_type(cls, value: Any, handler: ValidatorFunctionWrapHandler, info: ValidationInfo) -> Any:
+        """
+        Validate parameters against the model of the message type only, instead of trying every member of the
+        union. Types without a parameters model, or an invalid type, keep the union.
+        """
+        model = PARAMETERS_BY_MESSAGE_TYPE.get(info.data.get("type"))
+        if model is None or value is None:
+            return handler(value)
+        return model.model_validate(value)
+
 
 class Message(MessageSimple):
     attachments: Optional[List[MessageAttachment]] = Field(readOnly=True)
@@ -434,6 +471,12 @@ class TradeDetails(Trade):
     me: Customer = Field(description="Current user profile", readOnly=True)
 
 
+class TradeUpdateInternalRequest(BaseModel):
+    customer_id: UUID = Field(description="Id of Customer whose view of the trade is updated")
+    trade: Trade = Field(description="Trade as the customer sees it. context.unread_count is maintained by the "
+                                     "service and ignored")
+
+
 class NewChat(BaseModel):
     partner: Customer = Field(description="Other party of chat")
     context: Optional[ChatContext] = Field(description="Customer specific chat context")
@@ -474,14 +517,14 @@ class MarketingMessage(BaseModel):
 
 
 class MarketingMessageUpdateReq(BaseModel):
-    text: str = Field(description="Message text",
-                      example="Hello bro! We've got a new cool feature - BSC network support")
-    title: Optional[str] = Field(description="Message title, actually, not used", example="")
-    link: Optional[str] = Field(example="https://noones.com/wallet")
-    link_text: Optional[str] = Field(example="Go To Wallet")
-    start_time: Optional[datetime] = Field(description="Time when message should be delivered to the user",
+    text: Optional[str] = Field(None, description="Message text",
+                                example="Hello bro! We've got a new cool feature - BSC network support")
+    title: Optional[str] = Field(None, description="Message title, actually, not used", example="")
+    link: Optional[str] = Field(None, example="https://noones.com/wallet")
+    link_text: Optional[str] = Field(None, example="Go To Wallet")
+    start_time: Optional[datetime] = Field(None, description="Time when message should be delivered to the user",
                                            example="2021-04-02T11:34:15Z")
-    status: Optional[MarketingMessageStatusEnum] = Field(description="Message status",
+    status: Optional[MarketingMessageStatusEnum] = Field(None, description="Message status",
                                                          example=MarketingMessageStatusEnum.DELETED)
 
 
@@ -528,10 +571,15 @@ class MessageListParams:
     def __init__(self, list_params: ListParams = Depends(ListParams),
                  last_message_id: UUID = Query(None, description="Optional filter: from last message id"),
                  order_by: str = Query(None, description="Optional sorting order. Only 'create_time desc' supported",
-                                       example="create_time desc")):
+                                       example="create_time desc"),
+                 q: Optional[str] = Query(None, description="Optional search query. Will be applied as searchable "
+                                                            "substring for following message attributes: text, "
+                                                            "parameters.message",
+                                          example="payment")):
         self.basic_params = list_params
         self.order_by = order_by
         self.last_message_id = last_message_id
+        self.q = q
 
 
 class MarketingMessageListParams:
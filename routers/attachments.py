@@ -1,13 +1,81 @@
-from uuid import UUID
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from uuid import UUID, uuid4
 
-from fastapi import APIRouter, Path, Body, Security, File, Form
+from fastapi import APIRouter, Path, Body, Security, Request, Depends
 from fastapi import status
+from fastapi.responses import FileResponse, Response
+from starlette.concurrency import run_in_threadpool
 
-from dependencies import common_api_errors, oauth2_scheme, attachment_tag
-from models import ErrorResponse, Message, MessageAttachment
+from dependencies import common_api_errors, common_internal_api_errors, attachment_tag, internal_tag, \
+    ApiError, rate_limited_api_errors, idempotency_api_errors
+from models import ErrorResponse, Message, MessageAttachment, MessageStatusEnum, MessageTypeEnum, AttachmentMetrics
+from services.auth import verified_customer
+from services.blobs import blob_store, BLOB_NAME, MEDIA_TYPES
+from services.chat_log import chat_log
+from services.chats import ChatRecord, chat_store
+from services.idempotency import idempotency_store, request_fingerprint
+from services.inbox import notify_message, notify_context
+from services.rate_limits import rate_limit
+from services.uploads import receive_upload
 
 router = APIRouter()
 
+_FILE_PROPERTY = {"type": "string", "format": "binary",
+                  "description": "File to upload. Supported formats are jpeg, png, jpg. Files up to 10mb are only "
+                                 "allowed."}
+_EXTERNAL_REQUEST_ID_PROPERTY = {"type": "string", "description": "Optional idempotency key for request"}
+
+
+def _upload_form(**properties) -> dict:
+    """OpenAPI request body of the streaming upload routes, which read the multipart body themselves."""
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "required": ["file"], "properties": {"file": _FILE_PROPERTY, **properties}}}}}}
+
+
+async def _post_file_message(chat_id: UUID, customer_id: UUID, attachment: MessageAttachment,
+                             external_request_id: Optional[str]) -> Message:
+    record = chat_store.writable_chat(chat_id, customer_id)
+    sent = chat_store.post_message(record, Message(
+        external_request_id=external_request_id, message_id=uuid4(), create_time=datetime.now(timezone.utc),
+        text=None, author_id=customer_id, is_mine=True, status=MessageStatusEnum.SENT, type=MessageTypeEnum.FILE,
+        parameters=None, update_time=None, offer_hash=None, trade_hash=None, attachments=[attachment],
+        prev_message_id=None))
+    await chat_log.commit()
+    notify_message(record, sent)
+    for member_id in record.members:
+        notify_context(record, member_id)
+    return sent
+
+
+def _own_message(chat_id: UUID, message_id: UUID, customer_id: UUID) -> Tuple[ChatRecord, Message]:
+    """The writable chat and the message in it the customer could attach files to."""
+    record = chat_store.writable_chat(chat_id, customer_id)
+    message = record.messages.get(message_id)
+    if message is None or message.author_id != customer_id:
+        raise ApiError(status.HTTP_404_NOT_FOUND, "message_not_found", "Message not found")
+    return record, message
+
+
+async def _attach_to_message(chat_id: UUID, message_id: UUID, customer_id: UUID,
+                             attachment: MessageAttachment) -> Message:
+    record, message = _own_message(chat_id, message_id, customer_id)
+    chat_store.attach(record, message, attachment)
+    await chat_log.commit()
+    notify_message(record, message)
+    return message
+
+
+def _blob_name(name: str) -> str:
+    if not BLOB_NAME.match(name) or not blob_store.exists(name):
+        raise ApiError(status.HTTP_404_NOT_FOUND, "attachment_not_found", "Attachment not found")
+    return name
+
+
+def _linked(attachment: MessageAttachment) -> MessageAttachment:
+    """External files are not fetched, so they serve as their own thumbnail."""
+    return attachment.model_copy(update={"thumbnail_uri": attachment.uri})
+
 
 @router.post("/api/v3/chats/{id}/messages/link-file", response_model=Message, status_code=status.HTTP_200_OK,
              tags=[attachment_tag], description="Add File to Chat", deprecated=True,
@@ -17,8 +85,8 @@ router = APIRouter()
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def link_file(id: UUID = Path(..., description="Chat Id"),
                     attachment: MessageAttachment = Body(..., description="Message Attachment"),
-                    token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                    customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    return await _post_file_message(id, customer_id, _linked(attachment), None)
 
 
 @router.post("/api/v3/chats/{id}/messages/{message_id}/link-file", response_model=Message,
@@ -31,13 +99,15 @@ async def link_file(id: UUID = Path(..., description="Chat Id"),
 async def link_file(id: UUID = Path(..., description="Chat Id"),
                     message_id: UUID = Path(..., description="Message Id"),
                     attachment: MessageAttachment = Body(..., description="Message Attachment"),
-                    token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                    customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    return await _attach_to_message(id, message_id, customer_id, _linked(attachment))
 
 
 @router.post("/api/v3/chats/{id}/messages/upload-file", response_model=Message, status_code=status.HTTP_201_CREATED,
              tags=[attachment_tag], description="Upload File to Chat",
-             responses={**common_api_errors,
+             openapi_extra=_upload_form(external_request_id=_EXTERNAL_REQUEST_ID_PROPERTY),
+             dependencies=[Depends(rate_limit("upload_file", "chats:write"))],
+             responses={**common_api_errors, **rate_limited_api_errors, **idempotency_api_errors,
                         status.HTTP_201_CREATED: {"content": {"application/json": {"example": {
                             "external_request_id": "bb638f26-7064-4285-94b3-ce5d48f29b9b",
                             "message_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
@@ -58,22 +128,65 @@ async def link_file(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat not found"},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
-async def upload_file(file: bytes = File(default=None),
+async def upload_file(request: Request,
                       id: UUID = Path(..., description="Chat Id"),
-                      external_request_id: str = Form(default=None, description="Optional idempotency key for request"),
-                      token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                      customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    chat_store.writable_chat(id, customer_id)
+    upload, fields = await receive_upload(request)
+    external_request_id = fields.get("external_request_id") or None
+
+    async def post() -> Message:
+        return await _post_file_message(id, customer_id, await blob_store.attach(upload), external_request_id)
+    try:
+        return await idempotency_store.run(customer_id, "upload_file", id, external_request_id,
+                                           request_fingerprint(upload.filename, upload.sha256), post)
+    finally:
+        await run_in_threadpool(upload.discard)
 
 
 @router.post("/api/v3/chats/{id}/messages/{message_id}/upload-file", response_model=Message,
              status_code=status.HTTP_200_OK,
              tags=[attachment_tag], description="Upload File to the given message of Chat",
-             responses={**common_api_errors,
+             openapi_extra=_upload_form(),
+             dependencies=[Depends(rate_limit("upload_file", "chats:write"))],
+             responses={**common_api_errors, **rate_limited_api_errors,
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat not found"},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
-async def upload_file(file: bytes = File(default=None),
+async def upload_file(request: Request,
                       id: UUID = Path(..., description="Chat Id"),
                       message_id: UUID = Path(..., description="Message Id"),
-                      token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                      customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    # Checked before anything is stored, so files could not be uploaded against messages of others
+    _own_message(id, message_id, customer_id)
+    upload, _ = await receive_upload(request)
+    try:
+        return await _attach_to_message(id, message_id, customer_id, await blob_store.attach(upload))
+    finally:
+        await run_in_threadpool(upload.discard)
+
+
+@router.get("/api/v3/attachments/{name}", tags=[attachment_tag], description="Download an uploaded file",
+            responses={status.HTTP_200_OK: {"content": {"image/png": {}, "image/jpeg": {}}},
+                       status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Attachment not found"}})
+async def get_attachment(name: str = Path(..., description="Attachment name")):
+    name = _blob_name(name)
+    return FileResponse(blob_store.path(name), media_type=MEDIA_TYPES[name[-4:]],
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+@router.get("/api/v3/attachments/{name}/thumbnail", tags=[attachment_tag],
+            description="Download the thumbnail of an uploaded file",
+            responses={status.HTTP_200_OK: {"content": {"image/png": {}, "image/jpeg": {}}},
+                       status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Attachment not found"}})
+async def get_attachment_thumbnail(name: str = Path(..., description="Attachment name")):
+    name = _blob_name(name)
+    return Response(await blob_store.thumbnail(name), media_type=MEDIA_TYPES[name[-4:]],
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+@router.get("/api/v3/internal/attachments/metrics", response_model=AttachmentMetrics, tags=[internal_tag],
+            description="Attachment deduplication and thumbnail cache metrics",
+            responses={**common_internal_api_errors})
+async def attachment_metrics():
+    return blob_store.metrics()
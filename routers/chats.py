@@ -1,26 +1,89 @@
 from typing import List
 from uuid import UUID
 
-from fastapi import APIRouter, Path, Body, Security, Depends
+from fastapi import APIRouter, Path, Body, Security, Depends, Response
 from fastapi import status
 
-from dependencies import common_api_errors, oauth2_scheme, chat_tag
+from dependencies import common_api_errors, common_internal_api_errors, chat_tag, internal_tag, \
+    ApiError, parse_enum_list, fast_response, rate_limited_api_errors
 from models import Chat, ErrorResponse, ChatListResponse, ChatListParams, NewChat, ChatDetails, ProfileBaseListResponse, \
-    CustomerIds, Message, SystemMessage
+    CustomerIds, Message, SystemMessage, CheckRespondersInternalRequest, CheckChatCreationInternalRequest, \
+    CheckChatCreationInternalResponse, CheckChatCreationResultEnum, ChatContextStatusEnum
+from services.auth import verified_customer
+from services.chat_log import chat_log
+from services.chats import chat_store, chat_key
+from services.customers import customer_directory
+from services.eligibility import chat_eligibility
+from services.inbox import notify_message, notify_context
+from services.messages import new_message, effective_limit
+from services.page_tokens import PageTokenCodec, keyset_page
+from services.presence import presence_index
+from services.rate_limits import rate_limit
+from services.system_messages import system_message_queue
 
 router = APIRouter()
 
+page_tokens = PageTokenCodec("chats")
+
+CHECK_RESPONDERS_MAX_IDS = 1000
+
+_COULD_NOT_START_MESSAGES = {
+    "user_banned": "Customer is banned",
+    "chat_blocked": "Chat with the customer is blocked",
+    "privacy_settings": "Customer does not accept chat messages",
+    "could_not_start": "Chat with yourself or the system account could not be started",
+}
+
+
+def _check_responders(customer_id: UUID, responder_ids: List[str], return_chat_id: bool) -> ProfileBaseListResponse:
+    if len(responder_ids) > CHECK_RESPONDERS_MAX_IDS:
+        raise ApiError(status.HTTP_400_BAD_REQUEST, "too_many_customers",
+                       "Up to %d customers could be checked at once" % CHECK_RESPONDERS_MAX_IDS)
+    try:
+        ids = [UUID(responder_id) for responder_id in responder_ids]
+    except ValueError:
+        raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_customer_id", "Malformed customer id")
+    items = presence_index.resolve(ids)
+    if return_chat_id:
+        chat_ids = chat_store.partners_of(customer_id)
+        items = [item.model_copy(update={"chat_id": chat_ids[item.customer_id]}) if item.customer_id in chat_ids
+                 else item for item in items]
+    return ProfileBaseListResponse(items=items)
+
 
 @router.post("/api/v3/chats", response_model=ChatDetails, status_code=status.HTTP_201_CREATED,
              tags=[chat_tag], description="Create a new Chat with the given customer",
-             responses={**common_api_errors,
+             dependencies=[Depends(rate_limit("start_chat", "chats:write"))],
+             responses={**common_api_errors, **rate_limited_api_errors,
                         status.HTTP_200_OK: {"model": ChatDetails},
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse},
                         status.HTTP_503_SERVICE_UNAVAILABLE: {"model": ErrorResponse}})
-async def start_chat(chat: NewChat = Body(..., description="Chat to start"),
-                     token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return ChatDetails
+async def start_chat(response: Response,
+                     chat: NewChat = Body(..., description="Chat to start"),
+                     customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    partner_id = chat.partner.customer_id
+    decision = chat_eligibility.check(customer_id, partner_id)
+    if decision.result == CheckChatCreationResultEnum.COULD_NOT_START:
+        raise ApiError(status.HTTP_400_BAD_REQUEST, decision.error_code.value,
+                       _COULD_NOT_START_MESSAGES[decision.error_code.value])
+    if decision.result == CheckChatCreationResultEnum.ALREADY_STARTED:
+        response.status_code = status.HTTP_200_OK
+        return chat_store.details(chat_store.get(decision.chat_id), customer_id)
+
+    # The partner profile in the request is the caller's say-so; chats show the profile the directory knows
+    record = chat_store.create(customer_directory.get(customer_id), customer_directory.get(partner_id),
+                               chat.context.chat_name if chat.context is not None else None)
+    chat_eligibility.pair_changed(customer_id, partner_id)
+    sent = None
+    if chat.message is not None and chat.message.text:
+        sent = chat_store.post_message(record, new_message(chat.message, customer_id))
+    await chat_log.commit()
+    if sent is not None:
+        notify_message(record, sent)
+    for member_id in record.members:
+        notify_context(record, member_id)
+    return chat_store.details(record, customer_id)
 
 
 @router.get("/api/v3/chats/{id}", response_model=ChatDetails, tags=[chat_tag],
@@ -28,8 +91,8 @@ async def start_chat(chat: NewChat = Body(..., description="Chat to start"),
                        status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat not found"},
                        status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def get_chat(id: UUID = Path(..., description="Chat Id"),
-                   token: str = Security(oauth2_scheme, scopes=["chats:read"])):
-    return ChatDetails
+                   customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    return fast_response(chat_store.details(chat_store.member_chat(id, customer_id), customer_id))
 
 
 @router.get("/api/v3/chats", response_model=ChatListResponse, tags=[chat_tag],
@@ -37,8 +100,36 @@ async def get_chat(id: UUID = Path(..., description="Chat Id"),
                         "there are no messages) (DESC)",
             responses={**common_api_errors})
 async def list_chats(list_params: ChatListParams = Depends(ChatListParams),
-                     token: str = Security(oauth2_scheme, scopes=["chats:read"])):
-    return ChatListResponse
+                     customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    limit = effective_limit(list_params.basic_params.limit)
+    statuses = set(parse_enum_list(list_params.statuses, ChatContextStatusEnum, "statuses"))
+    matches = None
+    if statuses:
+        def matches(record):
+            return record.contexts[customer_id].status in statuses
+    # What the page tokens are bound to besides the order
+    listing = (customer_id, ",".join(sorted(item.value for item in statuses)), list_params.q or "")
+    after, backward = None, False
+    if list_params.basic_params.page_token:
+        after, backward = page_tokens.decode(list_params.basic_params.page_token, True, listing)
+
+    index = chat_store.chat_index(customer_id)
+    if list_params.q:
+        hits = chat_store.search_chats(customer_id, list_params.q)
+
+        def page(key, size, descending):
+            return index.page_among(hits, key, size, descending, matches)
+    else:
+        def page(key, size, descending):
+            return index.page(key, size, descending, matches)
+    items, has_next, has_prev = keyset_page(page, after, backward, limit, descending=True)
+    return fast_response(ChatListResponse(
+        limit=limit,
+        next_page_token=page_tokens.encode(chat_key(items[-1], customer_id), False, True, listing)
+        if items and has_next else None,
+        prev_page_token=page_tokens.encode(chat_key(items[0], customer_id), True, True, listing)
+        if items and has_prev else None,
+        items=[chat_store.summary(record, customer_id) for record in items]))
 
 
 @router.post("/api/v3/chats/{id}/block", response_model=ChatDetails, tags=[chat_tag],
@@ -104,8 +195,14 @@ async def list_chats(list_params: ChatListParams = Depends(ChatListParams),
                  status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat not found"},
                  status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def block_chat(id: UUID = Path(..., description="Chat Id"),
-                     token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return ChatDetails
+                     customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    chat_store.block(record, customer_id)
+    await chat_log.commit()
+    chat_eligibility.pair_changed(*record.members)
+    for member_id in record.members:
+        notify_context(record, member_id)
+    return chat_store.details(record, customer_id)
 
 
 @router.post("/api/v3/chats/{id}/unblock", response_model=ChatDetails, tags=[chat_tag],
@@ -114,8 +211,14 @@ async def block_chat(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat not found"},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def unblock_chat(id: UUID = Path(..., description="Chat Id"),
-                       token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return ChatDetails
+                       customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    chat_store.unblock(record, customer_id)
+    await chat_log.commit()
+    chat_eligibility.pair_changed(*record.members)
+    for member_id in record.members:
+        notify_context(record, member_id)
+    return chat_store.details(record, customer_id)
 
 
 @router.post("/api/v3/chats/check-responders", response_model=ProfileBaseListResponse, status_code=status.HTTP_200_OK,
@@ -125,6 +228,33 @@ async def unblock_chat(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_503_SERVICE_UNAVAILABLE: {"model": ErrorResponse}})
 async def check_responders(body: CustomerIds = Body(..., description="Array of Customer ids"),
-                           token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return ProfileBaseListResponse
+                           customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    return _check_responders(customer_id, body.customer_ids, body.return_chat_id)
+
+
+@router.post("/api/v3/internal/chats/check-responders", response_model=ProfileBaseListResponse,
+             status_code=status.HTTP_200_OK, tags=[internal_tag],
+             description="Check presence of the requested responders from the perspective of the given customer",
+             responses={**common_internal_api_errors,
+                        status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse}})
+async def check_responders_internal(body: CheckRespondersInternalRequest = Body(...,
+                                                                               description="Responders to check")):
+    return _check_responders(body.customer_id, body.responder_ids, body.return_chat_id)
+
 
+@router.post("/api/v3/internal/chats/check-chat-creation", response_model=CheckChatCreationInternalResponse,
+             status_code=status.HTTP_200_OK, tags=[internal_tag],
+             description="Check whether the given customer could start a chat with the partner",
+             responses={**common_internal_api_errors})
+async def check_chat_creation_internal(body: CheckChatCreationInternalRequest = Body(..., description="Pair to check")):
+    return chat_eligibility.check(body.customer_id, body.partner_id)
+
+
+@router.post("/api/v3/internal/chats/system-messages", status_code=status.HTTP_202_ACCEPTED, tags=[internal_tag],
+             description="Queue system notifications for delivery to the SYSTEM chats of their customers. The call "
+                         "returns once the messages are queued, they are written shortly after",
+             responses={**common_internal_api_errors,
+                        status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
+                        status.HTTP_503_SERVICE_UNAVAILABLE: {"model": ErrorResponse}})
+async def post_system_messages(messages: List[SystemMessage] = Body(..., description="System messages to deliver")):
+    system_message_queue.submit(messages)
@@ -0,0 +1,92 @@
+import asyncio
+
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect
+from fastapi import status
+from fastapi.responses import StreamingResponse
+
+from dependencies import profile_tag, ApiError
+from models import ErrorResponse, ValidationErrorResponse
+from services.inbox import inbox_hub, channel_tokens, encode_batch, customer_of_channel, Subscription
+from services.presence import presence_index
+
+router = APIRouter()
+
+# Idle SSE streams get a comment line this often so proxies keep them open
+SSE_KEEPALIVE_SECONDS = 15
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+
+
+async def _forward(subscription: Subscription, websocket: WebSocket) -> None:
+    while (batch := await subscription.next_batch()) is not None:
+        await websocket.send_text(encode_batch(batch))
+    await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER)
+
+
+async def _wait_disconnect(websocket: WebSocket) -> None:
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+
+
+@router.websocket("/api/v3/inbox/ws")
+async def inbox_websocket(websocket: WebSocket,
+                          channel: str = Query(..., description="Inbox channel from request-token"),
+                          token: str = Query(..., description="Channel token from request-token")):
+    if not channel_tokens.verify(channel, token):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscription = inbox_hub.subscribe(channel)
+    presence_index.connected(customer_of_channel(channel))
+    tasks = {asyncio.ensure_future(_forward(subscription, websocket)),
+             asyncio.ensure_future(_wait_disconnect(websocket))}
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        inbox_hub.unsubscribe(subscription)
+        presence_index.disconnected(customer_of_channel(channel))
+
+
+async def _event_stream(channel: str):
+    # Subscribed once the response is streaming, so a client gone before that leaves nothing behind
+    subscription = inbox_hub.subscribe(channel)
+    presence_index.connected(customer_of_channel(channel))
+    # The read of the next batch outlives keepalives: waiting on it again after one loses no batch
+    next_batch = None
+    try:
+        while True:
+            if next_batch is None:
+                next_batch = asyncio.ensure_future(subscription.next_batch())
+            done, _ = await asyncio.wait({next_batch}, timeout=SSE_KEEPALIVE_SECONDS)
+            if not done:
+                yield ": keepalive\n\n"
+                continue
+            batch, next_batch = next_batch.result(), None
+            if batch is None:
+                return
+            yield "data: %s\n\n" % encode_batch(batch)
+    finally:
+        if next_batch is not None:
+            next_batch.cancel()
+        inbox_hub.unsubscribe(subscription)
+        presence_index.disconnected(customer_of_channel(channel))
+
+
+@router.get("/api/v3/inbox/events", tags=[profile_tag],
+            description="Server-Sent Events stream of the inbox channel. Every event carries a JSON array of "
+                        "message, context and unread counter updates",
+            responses={status.HTTP_200_OK: {"content": {"text/event-stream": {}}},
+                       status.HTTP_403_FORBIDDEN: {"model": ErrorResponse,
+                                                   "description": "invalid_channel_token: the channel token is "
+                                                                  "invalid or expired"},
+                       status.HTTP_422_UNPROCESSABLE_ENTITY: {"model": ValidationErrorResponse},
+                       status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": ErrorResponse}})
+async def inbox_events(channel: str = Query(..., description="Inbox channel from request-token"),
+                       token: str = Query(..., description="Channel token from request-token")):
+    if not channel_tokens.verify(channel, token):
+        raise ApiError(status.HTTP_403_FORBIDDEN, "invalid_channel_token", "Channel token is invalid or expired")
+    return StreamingResponse(_event_stream(channel), media_type="text/event-stream")
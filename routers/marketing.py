@@ -0,0 +1,80 @@
+from uuid import UUID
+
+from fastapi import APIRouter, Path, Body, Depends
+from fastapi import status
+
+from dependencies import common_internal_api_errors, internal_tag, parse_enum_list, \
+    idempotency_api_errors
+from models import ErrorResponse, MarketingMessage, MarketingMessageUpdateReq, MarketingMessageListParams, \
+    MarketingMessageListResponse, MarketingMessageStatusEnum
+from services.idempotency import idempotency_store, request_fingerprint
+from services.marketing import marketing_store
+from services.messages import effective_limit
+from services.page_tokens import PageTokenCodec, keyset_page
+
+router = APIRouter()
+
+page_tokens = PageTokenCodec("marketing")
+
+
+@router.post("/api/v3/internal/marketing-messages", response_model=MarketingMessage,
+             status_code=status.HTTP_201_CREATED, tags=[internal_tag],
+             description="Create a marketing message. It stays PENDING until start_time and is delivered to all "
+                         "customers after that",
+             responses={**common_internal_api_errors, **idempotency_api_errors})
+async def create_marketing_message(message: MarketingMessage = Body(..., description="Marketing message to create")):
+    async def create() -> MarketingMessage:
+        return marketing_store.create(message)
+    return await idempotency_store.run(
+        message.author, "create_marketing_message", None, message.external_request_id,
+        request_fingerprint(message.text, message.title, message.link, message.link_text, message.start_time),
+        create)
+
+
+@router.get("/api/v3/internal/marketing-messages", response_model=MarketingMessageListResponse, tags=[internal_tag],
+            description="List marketing messages, sort by creation time (DESC)",
+            responses={**common_internal_api_errors,
+                       status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse}})
+async def list_marketing_messages(list_params: MarketingMessageListParams = Depends(MarketingMessageListParams)):
+    limit = effective_limit(list_params.basic_params.limit)
+    statuses = parse_enum_list(list_params.statuses, MarketingMessageStatusEnum, "statuses")
+    # What the page tokens are bound to besides the order
+    listing = (",".join(sorted(item.value for item in statuses)),)
+    after, backward = None, False
+    if list_params.basic_params.page_token:
+        after, backward = page_tokens.decode(list_params.basic_params.page_token, True, listing)
+
+    def page(key, size, descending):
+        return marketing_store.page(key, size, descending, statuses)
+    items, has_next, has_prev = keyset_page(page, after, backward, limit, descending=True)
+    return MarketingMessageListResponse(limit=limit,
+                                        next_page_token=page_tokens.encode((items[-1].create_time,
+                                                                            items[-1].marketing_id),
+                                                                           False, True, listing)
+                                        if items and has_next else None,
+                                        prev_page_token=page_tokens.encode((items[0].create_time,
+                                                                            items[0].marketing_id),
+                                                                           True, True, listing)
+                                        if items and has_prev else None,
+                                        items=items)
+
+
+@router.get("/api/v3/internal/marketing-messages/{id}", response_model=MarketingMessage, tags=[internal_tag],
+            responses={**common_internal_api_errors,
+                       status.HTTP_404_NOT_FOUND: {"model": ErrorResponse,
+                                                   "description": "Marketing message not found"}})
+async def get_marketing_message(id: UUID = Path(..., description="Marketing Message Id")):
+    return marketing_store.get(id)
+
+
+@router.patch("/api/v3/internal/marketing-messages/{id}", response_model=MarketingMessage, tags=[internal_tag],
+              description="Update a marketing message. A PENDING message is rescheduled to the new start_time, "
+                          "status=ACTIVE delivers it right away and status=DELETED withdraws it from all customers",
+              responses={**common_internal_api_errors,
+                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
+                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse,
+                                                     "description": "Marketing message not found"}})
+async def update_marketing_message(id: UUID = Path(..., description="Marketing Message Id"),
+                                   update: MarketingMessageUpdateReq = Body(..., description="Marketing message "
+                                                                                             "to update")):
+    return marketing_store.update(id, update)
@@ -1,25 +1,74 @@
+from typing import List, Optional
 from uuid import UUID
 
 from fastapi import APIRouter, Path, Body, Security, Depends
 from fastapi import status
 
-from dependencies import common_api_errors, oauth2_scheme, message_tag
+from dependencies import common_api_errors, message_tag, ApiError, fast_response, \
+    rate_limited_api_errors, idempotency_api_errors
 from models import ErrorResponse, Message, MessageListResponse, MessageListParams, MessageListResponseSimple, \
-    MessageIds, CancelOfferRequest, AcceptOfferRequest
+    MessageIds, CancelOfferRequest, AcceptOfferRequest, MessageStatusEnum
+from services.acks import ack_coalescer
+from services.auth import verified_customer
+from services.chat_log import chat_log
+from services.chats import chat_store, ChatRecord
+from services.idempotency import idempotency_store, request_fingerprint
+from services.inbox import notify_message, notify_context, notify_acknowledged
+from services.messages import as_seen_by, new_message, message_key, effective_limit
+from services.page_tokens import PageTokenCodec, keyset_page
+from services.rate_limits import rate_limit
 
 router = APIRouter()
 
+page_tokens = PageTokenCodec("messages")
+
+
+def _is_descending(order_by: Optional[str]) -> bool:
+    if order_by is None or order_by == "create_time asc":
+        return False
+    if order_by == "create_time desc":
+        return True
+    raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_order_by", "Only 'create_time desc' sorting is supported")
+
+
+def _chat_messages(record: ChatRecord, message_ids: List[str]) -> List[Message]:
+    history = record.messages
+    messages = []
+    for message_id in message_ids:
+        try:
+            message = history.get(UUID(message_id))
+        except ValueError:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_message_id", "Malformed message id %s" % message_id)
+        if message is None:
+            raise ApiError(status.HTTP_404_NOT_FOUND, "message_not_found", "Message %s not found" % message_id)
+        messages.append(message)
+    return messages
+
 
 @router.post("/api/v3/chats/{id}/messages", response_model=Message, status_code=status.HTTP_201_CREATED,
              tags=[message_tag], description="Send a new chat Message",
-             responses={**common_api_errors,
+             dependencies=[Depends(rate_limit("send_message", "chats:write"))],
+             responses={**common_api_errors, **rate_limited_api_errors, **idempotency_api_errors,
                         status.HTTP_200_OK: {"model": Message},
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def send_message(id: UUID = Path(..., description="Chat Id"),
                        message: Message = Body(..., description="Message to send"),
-                       token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                       customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+
+    async def send() -> Message:
+        record = chat_store.writable_chat(id, customer_id)
+        if not message.text:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "empty_message", "Message text is required")
+        sent = chat_store.post_message(record, new_message(message, customer_id))
+        await chat_log.commit()
+        notify_message(record, sent)
+        for member_id in record.members:
+            notify_context(record, member_id)
+        return sent
+    return await idempotency_store.run(
+        customer_id, "send_message", id, message.external_request_id,
+        request_fingerprint(message.text, message.offer_hash, message.trade_hash), send)
 
 
 @router.post("/api/v3/chats/{id}/messages/{message_id}/delivered", response_model=Message, tags=[message_tag],
@@ -28,8 +77,10 @@ async def send_message(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat/Message not found"}})
 async def message_delivered(id: UUID = Path(..., description="Chat Id"),
                             message_id: UUID = Path(..., description="Message Id"),
-                            token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                            customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    messages = _chat_messages(record, [str(message_id)])
+    return ack_coalescer.acknowledge(record, customer_id, messages, MessageStatusEnum.DELIVERED)[0]
 
 
 @router.post("/api/v3/chats/{id}/messages/{message_id}/read", response_model=Message, tags=[message_tag],
@@ -48,8 +99,10 @@ async def message_delivered(id: UUID = Path(..., description="Chat Id"),
                  status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat/Message not found"}})
 async def message_read(id: UUID = Path(..., description="Chat Id"),
                        message_id: UUID = Path(..., description="Message Id"),
-                       token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return Message
+                       customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    messages = _chat_messages(record, [str(message_id)])
+    return ack_coalescer.acknowledge(record, customer_id, messages, MessageStatusEnum.READ)[0]
 
 
 @router.post("/api/v3/chats/{id}/messages/delivered", response_model=MessageListResponseSimple, tags=[message_tag],
@@ -58,8 +111,11 @@ async def message_read(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat/Message not found"}})
 async def messages_delivered(id: UUID = Path(..., description="Chat Id"),
                              body: MessageIds = Body(..., description="Array of Message ids"),
-                             token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return MessageListResponseSimple
+                             customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    messages = _chat_messages(record, body.message_ids)
+    return MessageListResponseSimple(items=ack_coalescer.acknowledge(record, customer_id, messages,
+                                                                     MessageStatusEnum.DELIVERED))
 
 
 @router.post("/api/v3/chats/{id}/messages/read", response_model=MessageListResponseSimple, tags=[message_tag],
@@ -68,8 +124,11 @@ async def messages_delivered(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat/Message not found"}})
 async def messages_read(id: UUID = Path(..., description="Chat Id"),
                         body: MessageIds = Body(..., description="Array of Message ids"),
-                        token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return MessageListResponseSimple
+                        customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    messages = _chat_messages(record, body.message_ids)
+    return MessageListResponseSimple(items=ack_coalescer.acknowledge(record, customer_id, messages,
+                                                                     MessageStatusEnum.READ))
 
 
 @router.get("/api/v3/chats/{id}/messages", response_model=MessageListResponse, tags=[message_tag],
@@ -77,8 +136,36 @@ async def messages_read(id: UUID = Path(..., description="Chat Id"),
             responses={**common_api_errors})
 async def list_messages(id: UUID = Path(..., description="Chat Id"),
                         list_params: MessageListParams = Depends(MessageListParams),
-                        token: str = Security(oauth2_scheme, scopes=["chats:read"])):
-    return MessageListResponse
+                        customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    history = chat_store.member_chat(id, customer_id).messages
+    limit = effective_limit(list_params.basic_params.limit)
+    descending = _is_descending(list_params.order_by)
+    # What the page tokens are bound to besides the order
+    listing = (id, list_params.q or "")
+    after, backward = None, False
+    if list_params.basic_params.page_token:
+        after, backward = page_tokens.decode(list_params.basic_params.page_token, descending, listing)
+    elif list_params.last_message_id is not None:
+        last_message = history.get(list_params.last_message_id)
+        if last_message is None:
+            raise ApiError(status.HTTP_404_NOT_FOUND, "message_not_found", "Message not found")
+        after = message_key(last_message)
+
+    if list_params.q:
+        hits = history.search(list_params.q)
+
+        def page(key, size, page_descending):
+            return history.page_among(hits, key, size, page_descending)
+    else:
+        page = history.page
+    items, has_next, has_prev = keyset_page(page, after, backward, limit, descending)
+    return fast_response(MessageListResponse(
+        limit=limit,
+        next_page_token=page_tokens.encode(message_key(items[-1]), False, descending, listing)
+        if items and has_next else None,
+        prev_page_token=page_tokens.encode(message_key(items[0]), True, descending, listing)
+        if items and has_prev else None,
+        items=[as_seen_by(item, customer_id) for item in items]))
 
 
 @router.get("/api/v3/chats/{id}/messages/{message_id}", response_model=Message, tags=[message_tag],
@@ -86,8 +173,11 @@ async def list_messages(id: UUID = Path(..., description="Chat Id"),
                        status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Chat/Message not found"}})
 async def get_message(id: UUID = Path(..., description="Chat Id"),
                       message_id: UUID = Path(..., description="Message Id"),
-                      token: str = Security(oauth2_scheme, scopes=["chats:read"])):
-    return Message
+                      customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    message = chat_store.member_chat(id, customer_id).messages.get(message_id)
+    if message is None:
+        raise ApiError(status.HTTP_404_NOT_FOUND, "message_not_found", "Message not found")
+    return fast_response(as_seen_by(message, customer_id))
 
 
 @router.post("/api/v3/chats/{id}/messages/cancel-offer", response_model=Message, tags=[message_tag],
@@ -98,7 +188,7 @@ async def get_message(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def cancel_offer(id: UUID = Path(..., description="Chat Id"),
                        body: CancelOfferRequest = Body(..., description="Cancel Offer Request"),
-                       token: str = Security(oauth2_scheme, scopes=["chats:write"])):
+                       customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
     return Message
 
 
@@ -110,7 +200,7 @@ async def cancel_offer(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def accept_offer(id: UUID = Path(..., description="Chat Id"),
                        body: AcceptOfferRequest = Body(..., description="Accept Offer Request"),
-                       token: str = Security(oauth2_scheme, scopes=["chats:write"])):
+                       customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
     return Message
 
 
@@ -121,5 +211,10 @@ async def accept_offer(id: UUID = Path(..., description="Chat Id"),
                         status.HTTP_400_BAD_REQUEST: {"model": ErrorResponse},
                         status.HTTP_424_FAILED_DEPENDENCY: {"model": ErrorResponse}})
 async def read_all(id: UUID = Path(..., description="Chat Id"),
-                   token: str = Security(oauth2_scheme, scopes=["chats:write"])):
-    return MessageListResponseSimple
+                   customer_id: UUID = Security(verified_customer, scopes=["chats:write"])):
+    record = chat_store.member_chat(id, customer_id)
+    acknowledged = chat_store.mark_all_read(record, customer_id)
+    await chat_log.commit()
+    notify_acknowledged(record, customer_id, *acknowledged)
+    last = record.last_message
+    return MessageListResponseSimple(items=[as_seen_by(last, customer_id)] if last is not None else [])
@@ -1,34 +1,57 @@
+from uuid import UUID
+
 from fastapi import APIRouter, Security, Body
 from fastapi import status
 
-from dependencies import common_api_errors, oauth2_scheme, profile_tag
-from models import Profile, Token, ProfileUpdate, ReadAllMessagesReq
+from dependencies import common_api_errors, profile_tag, parse_enum_list
+from models import Profile, Token, ProfileUpdate, ReadAllMessagesReq, ChatContextStatusEnum, FeatureFlags
+from services.auth import verified_customer
+from services.chat_log import chat_log
+from services.chats import chat_store
+from services.customers import customer_directory
+from services.eligibility import chat_eligibility
+from services.inbox import channel_tokens, notify_acknowledged, notify_unread
+from services.marketing import marketing_store
+from services.presence import presence_index
+from services.trades import trade_store
+from services.unread import unread_counters
 
 router = APIRouter()
 
 
+def _profile(customer_id: UUID) -> Profile:
+    return Profile(**customer_directory.get(customer_id).model_dump(),
+                   **unread_counters.counters(customer_id).model_dump(),
+                   token=channel_tokens.issue(customer_id),
+                   accept_chat_messages=customer_directory.accept_chat_messages(customer_id),
+                   feature_flags=FeatureFlags(messenger_enabled_for_user=True, adabot_global=False),
+                   email="")
+
+
 @router.get("/api/v3/profile", status_code=status.HTTP_200_OK,
             response_model=Profile,
             tags=[profile_tag], description="Read user profile",
             responses={**common_api_errors})
-async def read_profile(token: str = Security(oauth2_scheme, scopes=["profile:read"])):
-    return Profile
+async def read_profile(customer_id: UUID = Security(verified_customer, scopes=["profile:read"])):
+    return _profile(customer_id)
 
 
 @router.post("/api/v3/profile/request-token", status_code=status.HTTP_200_OK,
              response_model=Token,
              tags=[profile_tag], description="Request channel token for subscription",
              responses={**common_api_errors})
-async def request_token(token: str = Security(oauth2_scheme, scopes=["profile:read"])):
-    return Token
+async def request_token(customer_id: UUID = Security(verified_customer, scopes=["profile:read"])):
+    return channel_tokens.issue(customer_id)
 
 
 @router.post("/api/v3/profile/read-all-trades", status_code=status.HTTP_200_OK,
              response_model=Profile,
              tags=[profile_tag], description="Mark all trades in a list as read and reset trades_unread_count to 0",
              responses={**common_api_errors})
-async def read_all_trades(token: str = Security(oauth2_scheme, scopes=["profile:read"])):
-    return Profile
+async def read_all_trades(customer_id: UUID = Security(verified_customer, scopes=["profile:read"])):
+    trade_store.read_all(customer_id)
+    notify_unread(customer_id)
+    return _profile(customer_id)
 
 
 @router.patch("/api/v3/profile", status_code=status.HTTP_200_OK,
@@ -36,8 +59,11 @@ async def read_all_trades(token: str = Security(oauth2_scheme, scopes=["profile:
               tags=[profile_tag], description="Update user profile",
               responses={**common_api_errors})
 async def update_profile(profile: ProfileUpdate = Body(..., description="Profile to update"),
-                         token: str = Security(oauth2_scheme, scopes=["profile:write"])):
-    return Profile
+                         customer_id: UUID = Security(verified_customer, scopes=["profile:write"])):
+    customer_directory.set_accept_chat_messages(customer_id, profile.accept_chat_messages)
+    presence_index.invalidate(customer_id)
+    chat_eligibility.privacy_changed(customer_id)
+    return _profile(customer_id)
 
 
 @router.post("/api/v3/profile/read-all-messages", status_code=status.HTTP_200_OK,
@@ -46,5 +72,16 @@ async def update_profile(profile: ProfileUpdate = Body(..., description="Profile
                                              "chats_unread_count or/and system_unread_count to 0",
              responses={**common_api_errors})
 async def read_all_messages(req: ReadAllMessagesReq = Body(..., description="Chats to update"),
-                            token: str = Security(oauth2_scheme, scopes=["profile:read"])):
-    return Profile
+                            customer_id: UUID = Security(verified_customer, scopes=["profile:read"])):
+    acknowledged = []
+    for context_status in parse_enum_list(req.status, ChatContextStatusEnum, "status"):
+        if context_status == ChatContextStatusEnum.MARKETING:
+            marketing_store.read_all(customer_id)
+            notify_unread(customer_id)
+        for chat_id in unread_counters.unread_chats(customer_id, context_status):
+            record = chat_store.get(chat_id)
+            acknowledged.append((record, chat_store.mark_all_read(record, customer_id)))
+    await chat_log.commit()
+    for record, (context_changed, updated) in acknowledged:
+        notify_acknowledged(record, customer_id, context_changed, updated)
+    return _profile(customer_id)
@@ -0,0 +1,45 @@
+from uuid import UUID
+
+from fastapi import APIRouter, Path, Body, Security, Depends
+from fastapi import status
+
+from dependencies import common_api_errors, common_internal_api_errors, trade_tag, internal_tag, \
+    ApiError, parse_enum_list
+from models import ErrorResponse, TradeListParams, TradeListResponse, TradeDetails, TradeStatusEnum, \
+    TradeUpdateInternalRequest
+from services.auth import verified_customer
+from services.customers import customer_directory
+from services.inbox import notify_unread
+from services.messages import effective_limit
+from services.trades import trade_store
+
+router = APIRouter()
+
+
+@router.get("/api/v3/trades", response_model=TradeListResponse, tags=[trade_tag],
+            description="List trades, sort by last trade update time (DESC)",
+            responses={**common_api_errors})
+async def list_trades(list_params: TradeListParams = Depends(TradeListParams),
+                      customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    statuses = parse_enum_list(list_params.statuses, TradeStatusEnum, "statuses")
+    return TradeListResponse(items=trade_store.newest(customer_id, statuses,
+                                                      effective_limit(list_params.limit)))
+
+
+@router.get("/api/v3/trades/{trade_hash}", response_model=TradeDetails, tags=[trade_tag],
+            responses={**common_api_errors,
+                       status.HTTP_404_NOT_FOUND: {"model": ErrorResponse, "description": "Trade not found"}})
+async def get_trade(trade_hash: str = Path(..., description="Trade Hash", max_length=40),
+                    customer_id: UUID = Security(verified_customer, scopes=["chats:read"])):
+    trade = trade_store.get(customer_id, trade_hash)
+    if trade is None:
+        raise ApiError(status.HTTP_404_NOT_FOUND, "trade_not_found", "Trade not found")
+    return TradeDetails(**dict(trade), me=customer_directory.get(customer_id))
+
+
+@router.post("/api/v3/internal/trades", status_code=status.HTTP_204_NO_CONTENT, tags=[internal_tag],
+             description="Create or update the trade in the trade list of the given customer",
+             responses={**common_internal_api_errors})
+async def update_trade_internal(body: TradeUpdateInternalRequest = Body(..., description="Trade to store")):
+    trade_store.put(body.customer_id, body.trade)
+    notify_unread(body.customer_id)
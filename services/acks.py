@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from models import Message, MessageStatusEnum
+from services.chat_log import chat_log
+from services.chats import ChatRecord, acknowledged_view, chat_store
+from services.inbox import notify_acknowledged
+
+# Seconds an acknowledgement may wait to be merged with the following ones. 0 applies every request at once.
+ACK_FLUSH_INTERVAL = float(os.environ.get("ACK_FLUSH_INTERVAL", "0.05"))
+# Pending acknowledged messages that force a flush before the interval ends
+ACK_FLUSH_BATCH_SIZE = int(os.environ.get("ACK_FLUSH_BATCH_SIZE", "1000"))
+
+AckKey = Tuple[UUID, UUID, MessageStatusEnum]
+
+logger = logging.getLogger(__name__)
+
+
+class AckCoalescer:
+    """
+    Write-coalescing stage for delivered / read acknowledgements.
+
+    Acknowledgements of the same chat by the same customer are merged until the next flush and applied as one
+    high-water-mark update of the chat context, so a client acking every message while scrolling through
+    history costs one context write and one context notification per flush instead of one per message.
+    Handlers answer right away with the messages as they look once the acknowledgement is applied; every flush
+    is then committed to the chat log. An acknowledgement that fails to apply is logged and dropped without
+    holding up the others.
+    """
+
+    def __init__(self, flush_interval: float = ACK_FLUSH_INTERVAL, batch_size: int = ACK_FLUSH_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: Dict[AckKey, Dict[UUID, Message]] = {}
+        self._pending_count = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._commits: Set[asyncio.Task] = set()
+        self.acknowledged = 0
+        self.context_writes = 0
+        self.failed = 0
+
+    def acknowledge(self, record: ChatRecord, customer_id: UUID, messages: List[Message],
+                    message_status: MessageStatusEnum) -> List[Message]:
+        pending = self._pending.setdefault((record.chat_id, customer_id, message_status), {})
+        for message in messages:
+            pending[message.message_id] = message
+        self._pending_count += len(messages)
+        self.acknowledged += len(messages)
+        if self.flush_interval <= 0 or self._pending_count >= self.batch_size:
+            self._flush_in_background()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush_in_background)
+        return [acknowledged_view(message, customer_id, message_status) for message in messages]
+
+    async def flush(self) -> None:
+        """Apply the pending acknowledgements and wait until they are in the chat log."""
+        self._apply()
+        await chat_log.commit()
+
+    def _flush_in_background(self) -> None:
+        self._apply()
+        task = asyncio.get_running_loop().create_task(self._commit())
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def _commit(self) -> None:
+        try:
+            await chat_log.commit()
+        except Exception:
+            logger.exception("Failed to commit acknowledgements to the chat log")
+
+    def _apply(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_count = self._pending, {}, 0
+        for (chat_id, customer_id, message_status), messages in pending.items():
+            try:
+                record = chat_store.get(chat_id)
+                context_changed, updated = chat_store.acknowledge(record, customer_id, list(messages.values()),
+                                                                  message_status)
+                notify_acknowledged(record, customer_id, context_changed, updated)
+            except Exception:
+                self.failed += len(messages)
+                logger.exception("Failed to apply %d %s acknowledgements of chat %s by %s", len(messages),
+                                 message_status.value, chat_id, customer_id)
+            else:
+                self.context_writes += context_changed
+
+
+ack_coalescer = AckCoalescer()
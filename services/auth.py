@@ -0,0 +1,107 @@
+import hashlib
+import os
+from collections import OrderedDict
+from time import time
+from typing import Callable, FrozenSet, Iterable, Tuple
+from uuid import UUID
+
+from fastapi import Depends, status
+from fastapi.security import SecurityScopes
+
+from dependencies import ApiError, customer_id_from_token, oauth2_scheme
+
+# Seconds verified claims are trusted before the token is verified again, unless the token expires earlier
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "300"))
+# Verified tokens kept at most; the least recently used are evicted first
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "100000"))
+
+
+class TokenClaims:
+    """Decoded claims of a verified bearer token."""
+
+    __slots__ = ("customer_id", "scopes", "expire_time")
+
+    def __init__(self, customer_id: UUID, scopes: Iterable[str], expire_time: float):
+        self.customer_id = customer_id
+        self.scopes: FrozenSet[str] = frozenset(scopes)
+        self.expire_time = expire_time
+
+    def grants(self, scope: str) -> bool:
+        """The scope itself or the wildcard of its family, e.g. chats:* for chats:read."""
+        return scope in self.scopes or "%s:*" % scope.partition(":")[0] in self.scopes
+
+
+class InvalidToken(Exception):
+    """Raised by a token verifier for a token that is malformed, forged or expired."""
+
+
+TokenVerifier = Callable[[str], TokenClaims]
+
+
+def unverified_claims(token: str) -> TokenClaims:
+    """
+    Claims of a token that is not verified yet: the customer id derived from the token itself and every scope the
+    oauth2 scheme offers. Stands in until the tokens are signed.
+    """
+    return TokenClaims(customer_id_from_token(token), oauth2_scheme.model.flows.authorizationCode.scopes,
+                       float("inf"))
+
+
+class TokenCache:
+    """
+    Verified tokens by the SHA-256 of the token, so the raw bearer tokens are not kept in memory. A hit costs a hash
+    and a lookup instead of a signature check or an introspection round-trip. Entries expire with the token or
+    after the TTL, whichever comes first, and the cache is bounded in size.
+    """
+
+    def __init__(self, verifier: TokenVerifier = unverified_claims, ttl: float = TOKEN_CACHE_TTL,
+                 max_tokens: int = TOKEN_CACHE_SIZE):
+        self.verifier = verifier
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self._claims: "OrderedDict[bytes, Tuple[float, TokenClaims]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def claims(self, token: str) -> TokenClaims:
+        key = hashlib.sha256(token.encode()).digest()
+        now = time()
+        entry = self._claims.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            self._claims.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        try:
+            claims = self.verifier(token)
+        except InvalidToken:
+            self._claims.pop(key, None)
+            raise ApiError(status.HTTP_401_UNAUTHORIZED, "invalid_token", "Token is invalid or expired")
+        expire_time = min(claims.expire_time, now + self.ttl)
+        if expire_time <= now:
+            self._claims.pop(key, None)
+            raise ApiError(status.HTTP_401_UNAUTHORIZED, "invalid_token", "Token is invalid or expired")
+        self._claims[key] = (expire_time, claims)
+        self._claims.move_to_end(key)
+        while len(self._claims) > self.max_tokens:
+            self._claims.popitem(last=False)
+        return claims
+
+    def authorize(self, token: str, scopes: Iterable[str]) -> TokenClaims:
+        claims = self.claims(token)
+        missing = [scope for scope in scopes if not claims.grants(scope)]
+        if missing:
+            raise ApiError(status.HTTP_403_FORBIDDEN, "insufficient_scope",
+                           "Token lacks the scopes: %s" % ", ".join(missing))
+        return claims
+
+
+async def verified_customer(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme)) -> UUID:
+    """
+    Customer of the request from the claims of its bearer token, verified through the cache and checked for the
+    scopes of the route. Routes and rate limits take the caller from here, never from the raw token.
+    """
+    return token_cache.authorize(token, security_scopes.scopes).customer_id
+
+
+token_cache = TokenCache()
@@ -0,0 +1,175 @@
+import asyncio
+import io
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Set
+
+from fastapi import status
+from starlette.concurrency import run_in_threadpool
+
+from dependencies import ApiError
+from models import AttachmentMetrics, MessageAttachment
+from services.uploads import UploadedFile
+
+ATTACHMENT_DIR = os.environ.get("ATTACHMENT_DIR") or os.path.join(tempfile.gettempdir(), "attachments")
+ATTACHMENT_BASE_URL = os.environ.get("ATTACHMENT_BASE_URL", "/api/v3/attachments/")
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.(png|jpg)$")
+MEDIA_TYPES = {".png": "image/png", ".jpg": "image/jpeg"}
+
+
+def make_thumbnail(path: str, extension: str) -> bytes:
+    """Render the thumbnail of an image file. Runs in the thumbnail process pool."""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        output = io.BytesIO()
+        if extension == ".png":
+            image.save(output, format="PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Size-bounded LRU of rendered thumbnails in front of the thumbnail files and the process pool."""
+
+    def __init__(self, max_bytes: int = THUMBNAIL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def render(self, path: str, extension: str) -> bytes:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(THUMBNAIL_WORKERS)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, make_thumbnail, path, extension)
+
+    async def close(self) -> None:
+        """Stop the process pool once the renders under way are done; the next render starts a new one."""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await run_in_threadpool(pool.shutdown)
+
+    def get(self, name: str) -> Optional[bytes]:
+        data = self._items.get(name)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(name)
+        return data
+
+    def put(self, name: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        previous = self._items.pop(name, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._items[name] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class BlobStore:
+    """
+    Content-addressed attachment storage. Blobs are named by the SHA-256 of their content, so an image that is
+    uploaded again, into any chat, reuses the stored blob and its thumbnail instead of being stored and
+    thumbnailed once more.
+    """
+
+    def __init__(self, directory: str = ATTACHMENT_DIR, base_url: str = ATTACHMENT_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url
+        self.thumbnails = ThumbnailCache()
+        self.uploads = 0
+        self.deduplicated = 0
+        self._known: Set[str] = set()
+        self._storing: Dict[str, asyncio.Future] = {}
+        os.makedirs(os.path.join(directory, "thumbnails"), exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def thumbnail_path(self, name: str) -> str:
+        return os.path.join(self.directory, "thumbnails", name)
+
+    def exists(self, name: str) -> bool:
+        return name in self._known or os.path.exists(self.path(name))
+
+    async def attach(self, upload: UploadedFile) -> MessageAttachment:
+        """Store the upload unless the same content is already stored and describe it as an attachment."""
+        name = upload.sha256 + upload.extension
+        if name in self._storing:
+            await asyncio.shield(self._storing[name])
+        if self.exists(name):
+            self.deduplicated += 1
+            await run_in_threadpool(upload.discard)
+        else:
+            self._storing[name] = asyncio.get_running_loop().create_future()
+            try:
+                await self._store(upload, name)
+            finally:
+                self._storing.pop(name).set_result(None)
+        self.uploads += 1
+        return MessageAttachment(filename=upload.filename, uri=self.base_url + name,
+                                 thumbnail_uri=self.base_url + name + "/thumbnail")
+
+    async def _store(self, upload: UploadedFile, name: str) -> None:
+        try:
+            thumbnail = await self.thumbnails.render(upload.path, upload.extension)
+        except Exception:
+            await run_in_threadpool(upload.discard)
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_file", "File is not a valid image")
+        await run_in_threadpool(self._write, upload, name, thumbnail)
+        self.thumbnails.put(name, thumbnail)
+        self._known.add(name)
+
+    def _write(self, upload: UploadedFile, name: str, thumbnail: bytes) -> None:
+        with open(self.thumbnail_path(name), "wb") as thumbnail_file:
+            thumbnail_file.write(thumbnail)
+        shutil.move(upload.path, self.path(name))
+
+    async def thumbnail(self, name: str) -> Optional[bytes]:
+        data = self.thumbnails.get(name)
+        if data is not None:
+            return data
+        if not self.exists(name):
+            return None
+        path = self.thumbnail_path(name)
+        if os.path.exists(path):
+            data = await run_in_threadpool(_read, path)
+        else:
+            data = await self.thumbnails.render(self.path(name), os.path.splitext(name)[1])
+        self.thumbnails.put(name, data)
+        return data
+
+    def metrics(self) -> AttachmentMetrics:
+        lookups = self.thumbnails.hits + self.thumbnails.misses
+        return AttachmentMetrics(uploads=self.uploads,
+                                 deduplicated_uploads=self.deduplicated,
+                                 dedup_ratio=self.deduplicated / self.uploads if self.uploads else 0.0,
+                                 thumbnail_cache_hits=self.thumbnails.hits,
+                                 thumbnail_cache_misses=self.thumbnails.misses,
+                                 thumbnail_cache_hit_rate=self.thumbnails.hits / lookups if lookups else 0.0,
+                                 thumbnail_cache_bytes=self.thumbnails.size)
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+blob_store = BlobStore()
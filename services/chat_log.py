@@ -0,0 +1,382 @@
+import array
+import asyncio
+import fcntl
+import gc
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from pydantic import TypeAdapter
+
+from models import ChatContext, ChatContextStatusEnum, Message, MessageStatusEnum
+from services.chats import ChatJournal, ChatRecord, chat_store
+from services.messages import MESSAGE_STATUSES, ChatMessages, MessageArchive, message_store
+from services.packing import construct, from_microseconds, to_microseconds
+from services.shards import chat_shards
+from services.wal import WriteAheadLog, frame, frames, sync_directory
+
+# Directory of the write-ahead log and the snapshots of the chats. Empty keeps the chats in memory only.
+CHAT_LOG_DIR = os.environ.get("CHAT_LOG_DIR", "")
+# Seconds between snapshots; a restart reads the last snapshot and replays only the log written after it
+CHAT_SNAPSHOT_INTERVAL = float(os.environ.get("CHAT_SNAPSHOT_INTERVAL", "300"))
+# Chats serialized per event loop iteration while a snapshot is taken
+CHAT_SNAPSHOT_SLICE = 1000
+
+# Kinds of the log records, each starting with the chat id
+CHAT = 1
+MESSAGE = 2
+ACKNOWLEDGED = 3
+BLOCKED = 4
+UNBLOCKED = 5
+EDITED = 6
+# Kinds of the snapshot records
+CHAT_STATE = 1
+SNAPSHOT_END = 2
+
+SNAPSHOT_SUFFIX = ".snapshot"
+# Snapshots kept, the newest first; an older one is used if the newest does not read back whole
+SNAPSHOTS_KEPT = 2
+
+_SENT = MESSAGE_STATUSES.index(MessageStatusEnum.SENT)
+# Last log position applied to the chat and number of its messages
+_STATE = struct.Struct("<QI")
+_END = struct.Struct("<Q")
+# Chat id, started_by, members, number of contexts
+_CHAT = struct.Struct("<16s16s16s16sB")
+# Member id, delivered and read message ids, status, unread count, update and activity times, blocked_by_me and
+# the size of the chat name that follows
+_CONTEXT = struct.Struct("<16s16s16sBIqqBI")
+# Encodes a message id that is not set
+_NO_ID = bytes(16)
+_NO_STATUS = 255
+_CONTEXT_STATUSES = list(ChatContextStatusEnum)
+_CONTEXT_STATUS_CODES = {context_status: code for code, context_status in enumerate(_CONTEXT_STATUSES)}
+
+_ack_adapter = TypeAdapter(Tuple[UUID, MessageStatusEnum, List[UUID], datetime])
+_block_adapter = TypeAdapter(Tuple[UUID, datetime])
+
+logger = logging.getLogger(__name__)
+
+
+def pack_chat(record: ChatRecord) -> bytes:
+    """
+    The chat with its contexts in a fixed binary layout, read back many times faster than JSON since the
+    contexts are rebuilt without validation.
+    """
+    first, second = record.members
+    parts = [_CHAT.pack(record.chat_id.bytes, record.started_by.bytes, first.bytes, second.bytes,
+                        len(record.contexts))]
+    for member_id, context in record.contexts.items():
+        name = context.chat_name.encode()
+        parts.append(_CONTEXT.pack(
+            member_id.bytes, context.delivered_message_id.bytes if context.delivered_message_id else _NO_ID,
+            context.read_message_id.bytes if context.read_message_id else _NO_ID,
+            _CONTEXT_STATUS_CODES.get(context.status, _NO_STATUS), context.unread_count,
+            to_microseconds(context.update_time), to_microseconds(context.activity_time),
+            context.blocked_by_me, len(name)))
+        parts.append(name)
+    return b"".join(parts)
+
+
+def unpack_chat(data: bytes, offset: int = 0) -> Tuple[ChatRecord, int]:
+    """The chat packed at the offset and the offset past it."""
+    chat_id, started_by, first, second, count = _CHAT.unpack_from(data, offset)
+    offset += _CHAT.size
+    # The members, started_by and the context keys share the UUID objects
+    ids = {first: UUID(bytes=first), second: UUID(bytes=second)}
+    contexts = {}
+    for _ in range(count):
+        member_id, delivered_id, read_id, status_code, unread_count, update_time, activity_time, blocked_by_me, \
+            size = _CONTEXT.unpack_from(data, offset)
+        offset += _CONTEXT.size
+        update_time = from_microseconds(update_time) if update_time != activity_time else None
+        activity_time = from_microseconds(activity_time)
+        contexts[ids.get(member_id) or UUID(bytes=member_id)] = construct(ChatContext, dict(
+            chat_name=data[offset:offset + size].decode(),
+            delivered_message_id=UUID(bytes=delivered_id) if delivered_id != _NO_ID else None,
+            read_message_id=UUID(bytes=read_id) if read_id != _NO_ID else None,
+            status=_CONTEXT_STATUSES[status_code] if status_code != _NO_STATUS else None, unread_count=unread_count,
+            update_time=update_time or activity_time, activity_time=activity_time, blocked_by_me=bool(blocked_by_me)))
+        offset += size
+    record = ChatRecord(UUID(bytes=chat_id), ids.get(started_by) or UUID(bytes=started_by),
+                        (ids[first], ids[second]), contexts)
+    return record, offset
+
+
+def _snapshot_position(name: str) -> int:
+    return int(name[:-len(SNAPSHOT_SUFFIX)], 16)
+
+
+class ChatLogEntry:
+    """Where the messages of a chat are in the log, and the last log position applied to the chat."""
+
+    __slots__ = ("locations", "statuses", "position")
+
+    def __init__(self, position: int):
+        self.locations = array.array("Q")
+        # Statuses of the messages while the history is not in use; once it is, the history holds them
+        self.statuses: Optional[bytearray] = bytearray()
+        self.position = position
+
+
+class ChatLog(ChatJournal, MessageArchive):
+    """
+    Durable chats. Every change is appended to a write-ahead log as it is made, and the requests making changes
+    wait for the log to be on disk before they answer; the group commit of the log lets them share fsyncs.
+
+    The log segments are where the messages are kept. A snapshot, taken every CHAT_SNAPSHOT_INTERVAL without
+    stopping the service, holds the chats with their contexts and the log positions and statuses of their
+    messages, not the messages themselves. A restart restores the chats from the newest snapshot and replays the
+    log written since; the histories stay in the memory-mapped log until a chat is first used. Snapshots are
+    taken chat by chat while changes go on, so every chat carries the last log position applied to it and
+    replay skips what a chat already has.
+    """
+
+    def __init__(self, directory: str = CHAT_LOG_DIR, snapshot_interval: float = CHAT_SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.wal = WriteAheadLog(os.path.join(directory, "wal"))
+        self._lock = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._snapshotting: Optional[asyncio.Task] = None
+        self._snapshot_position = -1
+
+    def open(self) -> None:
+        """
+        Restore the chats and log every change from now on. Call from the event loop before serving requests; a
+        directory is used by one process at a time.
+        """
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = open(os.path.join(self.directory, "lock"), "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            self._lock = None
+            raise RuntimeError("Chat log %s is in use by another process" % self.directory)
+        snapshots = self._snapshots()
+        # Where the newest snapshot ends is a record boundary, the scan for a torn last record can start there
+        self.wal.open(_snapshot_position(snapshots[0]) if snapshots else 0)
+        message_store.archive = self
+        # Restoring creates objects by the million and none of them are garbage; collections on the way would
+        # rescan the growing heap over and over, and once restored the chats are left out of collections for good
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            position = self._restore_snapshot(snapshots)
+            for location, kind, payload in self.wal.records(position):
+                self._replay(location, kind, payload)
+        finally:
+            if collecting:
+                gc.enable()
+        gc.freeze()
+        chat_store.journal = self
+        self._snapshot_position = position if position else -1
+        self._timer = asyncio.get_running_loop().call_later(self.snapshot_interval, self._start_snapshot)
+
+    async def commit(self) -> None:
+        """Wait until the changes made so far are on disk."""
+        await self.wal.commit()
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._snapshotting is not None:
+            await self._snapshotting
+        await self.wal.close()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    # Restoring
+
+    def _snapshots(self) -> List[str]:
+        return sorted((name for name in os.listdir(self.directory) if name.endswith(SNAPSHOT_SUFFIX)), reverse=True)
+
+    def _restore_snapshot(self, snapshots: List[str]) -> int:
+        """Restore the chats of the newest snapshot that reads back whole. Returns the log position it covers."""
+        for name in snapshots:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    end = list(frames(data, len(data) - _END.size - 9))
+                    if not end or end[0][1] != SNAPSHOT_END:
+                        logger.error("Snapshot %s is incomplete, trying an older one", name)
+                        continue
+                    restored = 0
+                    for _, kind, payload in frames(data):
+                        if kind == CHAT_STATE:
+                            self._restore_chat(payload)
+                            restored += 1
+                    if restored != _END.unpack(end[0][2])[0]:
+                        raise RuntimeError("Snapshot %s is damaged after %d chats" % (name, restored))
+            return _snapshot_position(name)
+        return 0
+
+    def _restore_chat(self, payload: bytes) -> None:
+        position, count = _STATE.unpack_from(payload)
+        record, offset = unpack_chat(payload, _STATE.size)
+        entry = ChatLogEntry(position)
+        entry.locations.frombytes(payload[offset:offset + count * 8])
+        entry.statuses = bytearray(payload[offset + count * 8:offset + count * 9])
+        chat_shards.shard(record.chat_id).logs[record.chat_id] = entry
+        chat_store.restore(record, has_messages=count > 0)
+
+    def _replay(self, location: int, kind: int, payload: bytes) -> None:
+        chat_id = UUID(bytes=payload[:16])
+        entry = chat_shards.shard(chat_id).logs.get(chat_id)
+        if kind == CHAT:
+            if entry is None:
+                chat_shards.shard(chat_id).logs[chat_id] = ChatLogEntry(location)
+                chat_store.restore(unpack_chat(payload)[0], has_messages=False)
+            return
+        if entry is None or location <= entry.position:
+            return
+        record = chat_store.get(chat_id)
+        if kind == MESSAGE:
+            chat_store.replay_messages(record, [Message.model_validate_json(payload[16:])])
+            entry.locations.append(location)
+            if entry.statuses is not None:
+                entry.statuses.append(_SENT)
+        elif kind == ACKNOWLEDGED:
+            customer_id, message_status, message_ids, now = _ack_adapter.validate_json(payload[16:])
+            history = record.messages
+            messages = [message for message in map(history.get, message_ids) if message is not None]
+            chat_store.acknowledge(record, customer_id, messages, message_status, now)
+        elif kind == EDITED:
+            edited = Message.model_validate_json(payload[16:])
+            history = record.messages
+            position = history.position(edited.message_id)
+            if position is not None:
+                edited.status = history.status_of(position)
+                chat_store.edit(record, edited)
+                entry.locations[position] = location
+        elif kind == BLOCKED:
+            chat_store.block(record, *_block_adapter.validate_json(payload[16:]))
+        elif kind == UNBLOCKED:
+            chat_store.unblock(record, *_block_adapter.validate_json(payload[16:]))
+        entry.position = location
+
+    # MessageArchive
+
+    def _message(self, location: int, code: int) -> Message:
+        _, payload = self.wal.read(location)
+        message = Message.model_validate_json(payload[16:])
+        message.status = MESSAGE_STATUSES[code]
+        return message
+
+    def history(self, chat_id: UUID) -> ChatMessages:
+        history = ChatMessages()
+        entry = chat_shards.shard(chat_id).logs.get(chat_id)
+        if entry is not None and entry.statuses is not None:
+            for location, code in zip(entry.locations, entry.statuses):
+                history.add(self._message(location, code))
+            entry.statuses = None
+        return history
+
+    def last(self, chat_id: UUID) -> Optional[Message]:
+        entry = chat_shards.shard(chat_id).logs.get(chat_id)
+        if entry is None or not entry.locations:
+            return None
+        return self._message(entry.locations[-1], entry.statuses[-1] if entry.statuses else _SENT)
+
+    # ChatJournal
+
+    def _entry(self, record: ChatRecord) -> ChatLogEntry:
+        return chat_shards.shard(record.chat_id).logs[record.chat_id]
+
+    def created(self, record: ChatRecord) -> None:
+        position = self.wal.append(CHAT, pack_chat(record))
+        chat_shards.shard(record.chat_id).logs[record.chat_id] = ChatLogEntry(position)
+
+    def posted(self, record: ChatRecord, messages: List[Message]) -> None:
+        entry = self._entry(record)
+        chat_id = record.chat_id.bytes
+        to_json = Message.__pydantic_serializer__.to_json
+        for message in messages:
+            entry.position = self.wal.append(MESSAGE, chat_id + to_json(message))
+            entry.locations.append(entry.position)
+
+    def edited(self, record: ChatRecord, message: Message) -> None:
+        entry = self._entry(record)
+        entry.position = self.wal.append(
+            EDITED, record.chat_id.bytes + Message.__pydantic_serializer__.to_json(message))
+        # Histories are in the order the messages were posted, the order of the locations
+        entry.locations[record.messages.position(message.message_id)] = entry.position
+
+    def acknowledged(self, record: ChatRecord, customer_id: UUID, messages: List[Message],
+                     message_status: MessageStatusEnum, now: datetime) -> None:
+        self._entry(record).position = self.wal.append(ACKNOWLEDGED, record.chat_id.bytes + _ack_adapter.dump_json(
+            (customer_id, message_status, [message.message_id for message in messages], now)))
+
+    def blocked(self, record: ChatRecord, customer_id: UUID, now: datetime) -> None:
+        self._entry(record).position = self.wal.append(
+            BLOCKED, record.chat_id.bytes + _block_adapter.dump_json((customer_id, now)))
+
+    def unblocked(self, record: ChatRecord, customer_id: UUID, now: datetime) -> None:
+        self._entry(record).position = self.wal.append(
+            UNBLOCKED, record.chat_id.bytes + _block_adapter.dump_json((customer_id, now)))
+
+    # Snapshots
+
+    def _start_snapshot(self) -> None:
+        self._snapshotting = asyncio.get_running_loop().create_task(self.snapshot())
+        self._snapshotting.add_done_callback(self._snapshot_done)
+
+    def _snapshot_done(self, task: asyncio.Task) -> None:
+        self._snapshotting = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Chat snapshot failed", exc_info=task.exception())
+        if self._lock is not None:
+            self._timer = asyncio.get_running_loop().call_later(self.snapshot_interval, self._start_snapshot)
+
+    def _chat_state(self, record: ChatRecord) -> bytes:
+        entry = self._entry(record)
+        history = message_store.find(record.chat_id)
+        if history is not None:
+            statuses = history.statuses()
+        else:
+            statuses = bytes(entry.statuses)
+        return b"".join((_STATE.pack(entry.position, len(entry.locations)), pack_chat(record),
+                         entry.locations.tobytes(), statuses))
+
+    async def snapshot(self) -> Optional[str]:
+        """Write a snapshot of every chat, a slice of chats per event loop iteration. Returns its path."""
+        position = self.wal.position
+        if position == self._snapshot_position:
+            return None
+        records = [record for shard in chat_shards.shards() for record in shard.records.values()]
+        chunks = []
+        for start in range(0, len(records), CHAT_SNAPSHOT_SLICE):
+            for record in records[start:start + CHAT_SNAPSHOT_SLICE]:
+                chunks.append(frame(CHAT_STATE, self._chat_state(record)))
+            await asyncio.sleep(0)
+        chunks.append(frame(SNAPSHOT_END, _END.pack(len(records))))
+        # Positions of records still on their way to disk must not outlive a crash in the snapshot
+        await self.wal.commit()
+        path = await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, position, chunks)
+        self._snapshot_position = position
+        return path
+
+    def _write_snapshot(self, position: int, chunks: List[bytes]) -> str:
+        path = os.path.join(self.directory, "%016x%s" % (position, SNAPSHOT_SUFFIX))
+        with open(path + ".tmp", "wb") as file:
+            file.writelines(chunks)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        sync_directory(self.directory)
+        for name in self._snapshots()[SNAPSHOTS_KEPT:]:
+            os.unlink(os.path.join(self.directory, name))
+        return path
+
+
+chat_log = ChatLog()
@@ -0,0 +1,470 @@
+import heapq
+import os
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID, uuid4
+
+from fastapi import status
+
+from dependencies import ApiError
+from models import Chat, ChatContext, ChatContextStatusEnum, ChatDetails, Customer, Message, MessageAttachment, \
+    MessageStatusEnum
+from services.customers import customer_directory
+from services.messages import ChatMessages, as_seen_by, message_key, message_store
+from services.search import SearchIndex
+from services.shards import chat_shards
+from services.unread import unread_counters
+
+# Statuses a partner message could be moved from by a delivered / read acknowledgement
+_ACKNOWLEDGEABLE = {MessageStatusEnum.DELIVERED: (MessageStatusEnum.SENT,),
+                    MessageStatusEnum.READ: (MessageStatusEnum.SENT, MessageStatusEnum.DELIVERED)}
+_POINTERS = {MessageStatusEnum.DELIVERED: "delivered_message_id",
+             MessageStatusEnum.READ: "read_message_id"}
+
+ChatKey = Tuple[datetime, UUID]
+
+# Author of system notifications and partner in the SYSTEM chat of every customer
+SYSTEM_ACCOUNT_ID = UUID(os.environ.get("SYSTEM_ACCOUNT_ID", "00000000-0000-0000-0000-000000000001"))
+SYSTEM_CHAT_NAME = "Notifications"
+
+# Last message of a chat restored from the log, read from the log the first time it is asked for
+_NOT_LOADED = object()
+
+
+class ChatRecord:
+    """A chat between two customers with the per-customer contexts."""
+
+    __slots__ = ("chat_id", "started_by", "members", "contexts", "_last_message")
+
+    def __init__(self, chat_id: UUID, started_by: UUID, members: Tuple[UUID, UUID],
+                 contexts: Dict[UUID, ChatContext]):
+        self.chat_id = chat_id
+        self.started_by = started_by
+        self.members = members
+        self.contexts = contexts
+        self._last_message: Optional[Message] = None
+
+    @property
+    def last_message(self) -> Optional[Message]:
+        message = self._last_message
+        if message is _NOT_LOADED:
+            message = self._last_message = message_store.last(self.chat_id)
+        return message
+
+    @last_message.setter
+    def last_message(self, message: Optional[Message]) -> None:
+        self._last_message = message
+
+    def partner_of(self, customer_id: UUID) -> UUID:
+        first, second = self.members
+        return second if customer_id == first else first
+
+    @property
+    def messages(self) -> ChatMessages:
+        return message_store.chat(self.chat_id)
+
+
+class ChatActivityIndex:
+    """
+    Chats of a single customer ordered by (activity_time, chat_id) of the customer's context.
+
+    A chat moves to the end of the index when it gets a message, so listing chats by activity seeks with a
+    binary search and slices like ChatMessages.page instead of sorting all chats of the customer.
+    """
+
+    def __init__(self):
+        self._keys: List[ChatKey] = []
+        self._records: List[ChatRecord] = []
+        self._key_of: Dict[ChatRecord, ChatKey] = {}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def records(self) -> List[ChatRecord]:
+        return self._records
+
+    def add(self, record: ChatRecord, activity_time: datetime) -> None:
+        key = (activity_time, record.chat_id)
+        self._key_of[record] = key
+        if not self._keys or key > self._keys[-1]:
+            self._keys.append(key)
+            self._records.append(record)
+        else:
+            position = bisect_left(self._keys, key)
+            self._keys.insert(position, key)
+            self._records.insert(position, record)
+
+    def touch(self, record: ChatRecord, activity_time: datetime) -> None:
+        """Move the chat to its new activity time."""
+        key = self._key_of.get(record)
+        if key is not None:
+            position = bisect_left(self._keys, key)
+            del self._keys[position]
+            del self._records[position]
+        self.add(record, activity_time)
+
+    def page(self, after: Optional[ChatKey], limit: int, descending: bool = True,
+             matches: Optional[Callable[[ChatRecord], bool]] = None) -> Tuple[List[ChatRecord], bool]:
+        """
+        Return up to `limit` chats strictly after the `after` key in the requested order and whether more follow.
+        With `matches`, chats are filtered while scanning from the key, so the scan stops at `limit` + 1 hits.
+        """
+        if descending:
+            end = bisect_left(self._keys, after) if after is not None else len(self._keys)
+            if matches is None:
+                start = max(0, end - limit)
+                return self._records[start:end][::-1], start > 0
+            candidates = (self._records[position] for position in range(end - 1, -1, -1))
+        else:
+            start = bisect_right(self._keys, after) if after is not None else 0
+            if matches is None:
+                end = start + limit
+                return self._records[start:end], end < len(self._records)
+            candidates = (self._records[position] for position in range(start, len(self._records)))
+        items = []
+        for record in candidates:
+            if matches(record):
+                if len(items) == limit:
+                    return items, True
+                items.append(record)
+        return items, False
+
+    def page_among(self, records: Set[ChatRecord], after: Optional[ChatKey], limit: int, descending: bool = True,
+                   matches: Optional[Callable[[ChatRecord], bool]] = None) -> Tuple[List[ChatRecord], bool]:
+        """
+        Same as page, restricted to the given chats, e.g. search hits. Scanning the index for them takes about
+        limit * len(index) / len(records) steps and ranking them on their own about len(records), so the
+        cheaper of the two is used.
+        """
+        if len(records) ** 2 >= (limit + 1) * len(self._keys):
+            return self.page(after, limit, descending,
+                             lambda record: record in records and (matches is None or matches(record)))
+        key_of = self._key_of
+        candidates = [record for record in records if record in key_of and (matches is None or matches(record))]
+        if after is not None:
+            candidates = [record for record in candidates
+                          if (key_of[record] < after if descending else key_of[record] > after)]
+        items = (heapq.nlargest if descending else heapq.nsmallest)(limit + 1, candidates, key=key_of.__getitem__)
+        return items[:limit], len(items) > limit
+
+
+def chat_key(record: ChatRecord, customer_id: UUID) -> ChatKey:
+    return record.contexts[customer_id].activity_time, record.chat_id
+
+
+def _chat_name(partner: Customer) -> str:
+    return "Chat with %s" % (partner.display_name or partner.username)
+
+
+def _new_context(chat_name: str, now: datetime) -> ChatContext:
+    return ChatContext(chat_name=chat_name, delivered_message_id=None, read_message_id=None,
+                       status=ChatContextStatusEnum.ACTIVE, unread_count=0, update_time=now, activity_time=now,
+                       blocked_by_me=False)
+
+
+def acknowledged_view(message: Message, customer_id: UUID, message_status: MessageStatusEnum) -> Message:
+    """The message as the customer sees it once their acknowledgement is applied."""
+    if message.author_id != customer_id and message.status in _ACKNOWLEDGEABLE[message_status]:
+        return message.model_copy(update={"status": message_status, "is_mine": False})
+    return as_seen_by(message, customer_id)
+
+
+def _pair(first: UUID, second: UUID) -> Tuple[UUID, UUID]:
+    return (first, second) if first < second else (second, first)
+
+
+def _set_unread(record: ChatRecord, member_id: UUID, unread_count: int) -> None:
+    context = record.contexts[member_id]
+    unread_counters.update(member_id, record.chat_id, context.status, context.unread_count, unread_count)
+    context.unread_count = unread_count
+
+
+def _set_status(record: ChatRecord, member_id: UUID, context_status: ChatContextStatusEnum) -> None:
+    context = record.contexts[member_id]
+    unread_counters.move(member_id, record.chat_id, context.status, context_status, context.unread_count)
+    context.status = context_status
+
+
+class ChatJournal:
+    """
+    Receives every change of the chats once it is made, with what it takes to make it again. The base class
+    keeps nothing; services.chat_log writes the changes ahead to disk.
+    """
+
+    def created(self, record: ChatRecord) -> None:
+        pass
+
+    def posted(self, record: ChatRecord, messages: List[Message]) -> None:
+        pass
+
+    def acknowledged(self, record: ChatRecord, customer_id: UUID, messages: List[Message],
+                     message_status: MessageStatusEnum, now: datetime) -> None:
+        pass
+
+    def edited(self, record: ChatRecord, message: Message) -> None:
+        pass
+
+    def blocked(self, record: ChatRecord, customer_id: UUID, now: datetime) -> None:
+        pass
+
+    def unblocked(self, record: ChatRecord, customer_id: UUID, now: datetime) -> None:
+        pass
+
+
+class ChatStore:
+    """Chats by id, kept in the shard of each chat, and the indexes of the chats of every customer."""
+
+    def __init__(self):
+        self._member_chats: Dict[UUID, ChatActivityIndex] = {}
+        self._pairs: Dict[Tuple[UUID, UUID], ChatRecord] = {}
+        # SYSTEM chats by customer, apart from the pairs so no chat a customer starts could take their place
+        self._system_chats: Dict[UUID, ChatRecord] = {}
+        # Built for a customer on their first search
+        self._chat_names: Dict[UUID, SearchIndex[ChatRecord]] = {}
+        self.journal = ChatJournal()
+
+    def create(self, me: Customer, partner: Customer, chat_name: Optional[str] = None) -> ChatRecord:
+        now = datetime.now(timezone.utc)
+        record = ChatRecord(chat_id=uuid4(), started_by=me.customer_id,
+                            members=(me.customer_id, partner.customer_id),
+                            contexts={me.customer_id: _new_context(chat_name or _chat_name(partner), now),
+                                      partner.customer_id: _new_context(_chat_name(me), now)})
+        self._register(record)
+        return record
+
+    def system_chat(self, customer_id: UUID) -> ChatRecord:
+        """
+        The SYSTEM chat of the customer, created on first use. Only the customer's context is kept: the system
+        account is a member of every SYSTEM chat and has no use for chat lists or unread counters.
+        """
+        record = self._system_chats.get(customer_id)
+        if record is None:
+            now = datetime.now(timezone.utc)
+            context = _new_context(SYSTEM_CHAT_NAME, now)
+            context.status = ChatContextStatusEnum.SYSTEM
+            record = ChatRecord(chat_id=uuid4(), started_by=SYSTEM_ACCOUNT_ID, members=(customer_id, SYSTEM_ACCOUNT_ID),
+                                contexts={customer_id: context})
+            self._register(record)
+        return record
+
+    def _register(self, record: ChatRecord) -> None:
+        self._add(record)
+        self.journal.created(record)
+
+    def _add(self, record: ChatRecord) -> None:
+        chat_shards.shard(record.chat_id).records[record.chat_id] = record
+        for member_id, context in record.contexts.items():
+            self.chat_index(member_id, create=True).add(record, context.activity_time)
+            names = self._chat_names.get(member_id)
+            if names is not None:
+                names.update(record, context.chat_name)
+            if context.unread_count:
+                unread_counters.update(member_id, record.chat_id, context.status, 0, context.unread_count)
+        if record.started_by == SYSTEM_ACCOUNT_ID:
+            self._system_chats[record.members[0]] = record
+        else:
+            self._pairs[_pair(*record.members)] = record
+
+    def restore(self, record: ChatRecord, has_messages: bool) -> None:
+        """Add a chat read back from the log with its contexts as they were; its messages stay there until used."""
+        if has_messages:
+            record.last_message = _NOT_LOADED
+        self._add(record)
+
+    def get(self, chat_id: UUID) -> Optional[ChatRecord]:
+        return chat_shards.shard(chat_id).records.get(chat_id)
+
+    def chat_index(self, customer_id: UUID, create: bool = False) -> ChatActivityIndex:
+        """Chats of the customer by activity. Without `create`, a customer with no chats gets an empty index."""
+        index = self._member_chats.get(customer_id)
+        if index is None:
+            index = ChatActivityIndex()
+            if create:
+                self._member_chats[customer_id] = index
+        return index
+
+    def search_chats(self, customer_id: UUID, query: str) -> Set[ChatRecord]:
+        """Chats of the customer whose name matches the query."""
+        names = self._chat_names.get(customer_id)
+        if names is None:
+            names = self._chat_names[customer_id] = SearchIndex()
+            for record in self.chats_of(customer_id):
+                names.update(record, record.contexts[customer_id].chat_name)
+        return names.search(query)
+
+    def chats_of(self, customer_id: UUID) -> Iterable[ChatRecord]:
+        return self.chat_index(customer_id).records()
+
+    def find_between(self, customer_id: UUID, partner_id: UUID) -> Optional[ChatRecord]:
+        return self._pairs.get(_pair(customer_id, partner_id))
+
+    def partners_of(self, customer_id: UUID) -> Dict[UUID, UUID]:
+        """Chat ids of the customer by partner id."""
+        return {record.partner_of(customer_id): record.chat_id for record in self.chats_of(customer_id)}
+
+    def member_chat(self, chat_id: UUID, customer_id: UUID) -> ChatRecord:
+        record = chat_shards.shard(chat_id).records.get(chat_id)
+        if record is None or customer_id not in record.contexts:
+            raise ApiError(status.HTTP_404_NOT_FOUND, "chat_not_found", "Chat not found")
+        return record
+
+    def writable_chat(self, chat_id: UUID, customer_id: UUID) -> ChatRecord:
+        """The chat the customer could post to."""
+        record = self.member_chat(chat_id, customer_id)
+        context_status = record.contexts[customer_id].status
+        if context_status == ChatContextStatusEnum.BLOCKED:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "chat_blocked", "Chat is blocked")
+        if context_status == ChatContextStatusEnum.SYSTEM:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "chat_read_only", "System chats are read-only")
+        return record
+
+    def post_message(self, record: ChatRecord, message: Message) -> Message:
+        """Append the message to the chat history and move both contexts forward."""
+        return self.post_messages(record, [message])[0]
+
+    def post_messages(self, record: ChatRecord, messages: List[Message]) -> List[Message]:
+        """Append the messages to the chat history and move the contexts forward once for the whole batch."""
+        history = record.messages
+        sent_messages = []
+        for message in messages:
+            sent = message.model_copy(update={"message_id": uuid4(),
+                                              "create_time": history.next_create_time(),
+                                              "status": MessageStatusEnum.SENT,
+                                              "prev_message_id": history.last_id})
+            history.add(sent)
+            sent_messages.append(sent)
+        if sent_messages:
+            self._advance(record, sent_messages)
+            self.journal.posted(record, sent_messages)
+        return sent_messages
+
+    def replay_messages(self, record: ChatRecord, messages: List[Message]) -> None:
+        """Apply messages read back from the log as they were posted."""
+        history = message_store.find(record.chat_id)
+        if history is not None:
+            for message in messages:
+                history.add(message)
+        self._advance(record, messages)
+
+    def _advance(self, record: ChatRecord, sent_messages: List[Message]) -> None:
+        """Move the contexts forward past the newly sent messages."""
+        record.last_message = last = sent_messages[-1]
+        for member_id, context in record.contexts.items():
+            context.activity_time = context.update_time = last.create_time
+            self._member_chats[member_id].touch(record, last.create_time)
+            unread_count = context.unread_count
+            for sent in sent_messages:
+                if sent.author_id == member_id:
+                    context.read_message_id = sent.message_id
+                    unread_count = 0
+                else:
+                    unread_count += 1
+            _set_unread(record, member_id, unread_count)
+
+    def attach(self, record: ChatRecord, message: Message, attachment: MessageAttachment) -> Message:
+        message.attachments = [*(message.attachments or []), attachment]
+        message.update_time = datetime.now(timezone.utc)
+        self.edit(record, message)
+        return message
+
+    def edit(self, record: ChatRecord, message: Message) -> None:
+        """Store the changed message in the chat history."""
+        if not record.messages.update(message):
+            return
+        last = record.last_message
+        if last is not None and last.message_id == message.message_id:
+            record.last_message = message
+        self.journal.edited(record, message)
+
+    def mark_read(self, record: ChatRecord, customer_id: UUID,
+                  messages: List[Message]) -> Tuple[bool, List[Message]]:
+        """
+        Move the read pointer of the customer up to the newest of the given messages.
+        Return whether the context changed and the partner messages that became READ.
+        """
+        return self.acknowledge(record, customer_id, messages, MessageStatusEnum.READ)
+
+    def mark_all_read(self, record: ChatRecord, customer_id: UUID) -> Tuple[bool, List[Message]]:
+        last = record.last_message
+        return self.mark_read(record, customer_id, [last] if last is not None else [])
+
+    def acknowledge(self, record: ChatRecord, customer_id: UUID, messages: List[Message],
+                    message_status: MessageStatusEnum, now: Optional[datetime] = None) -> Tuple[bool, List[Message]]:
+        """Apply a DELIVERED or READ acknowledgement of the given messages by the customer."""
+        if not messages:
+            return False, []
+        pointer = _POINTERS[message_status]
+        history = record.messages
+        updated = []
+        for message in messages:
+            # The given messages are copies read from the history some time ago, the history has the status
+            position = history.position(message.message_id)
+            if (message.author_id != customer_id and position is not None
+                    and history.status_of(position) in _ACKNOWLEDGEABLE[message_status]):
+                history.set_status(position, message_status)
+                message.status = message_status
+                updated.append(message)
+        last = record.last_message
+        if last is not None and any(message.message_id == last.message_id for message in updated):
+            last.status = message_status
+
+        context = record.contexts[customer_id]
+        newest = max(messages, key=message_key)
+        current_id = getattr(context, pointer)
+        current = history.get(current_id) if current_id is not None else None
+        now = now or datetime.now(timezone.utc)
+        if current is not None and message_key(current) >= message_key(newest):
+            if updated:
+                self.journal.acknowledged(record, customer_id, messages, message_status, now)
+            return False, updated
+        setattr(context, pointer, newest.message_id)
+        if message_status == MessageStatusEnum.READ:
+            _set_unread(record, customer_id, history.count_after(message_key(newest)))
+        context.update_time = now
+        self.journal.acknowledged(record, customer_id, messages, message_status, now)
+        return True, updated
+
+    def block(self, record: ChatRecord, customer_id: UUID, now: Optional[datetime] = None) -> None:
+        context = record.contexts[customer_id]
+        if context.status == ChatContextStatusEnum.SYSTEM:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "chat_not_blockable", "System chats could not be blocked")
+        now = now or datetime.now(timezone.utc)
+        for member_id, member_context in record.contexts.items():
+            _set_status(record, member_id, ChatContextStatusEnum.BLOCKED)
+            member_context.blocked_by_me = member_context.blocked_by_me or member_id == customer_id
+            member_context.update_time = now
+        self.journal.blocked(record, customer_id, now)
+
+    def unblock(self, record: ChatRecord, customer_id: UUID, now: Optional[datetime] = None) -> None:
+        if not record.contexts[customer_id].blocked_by_me:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "chat_not_blocked_by_me",
+                           "Chat could be unblocked only by the customer who blocked it")
+        now = now or datetime.now(timezone.utc)
+        record.contexts[customer_id].blocked_by_me = False
+        if not any(context.blocked_by_me for context in record.contexts.values()):
+            for member_id, context in record.contexts.items():
+                _set_status(record, member_id, ChatContextStatusEnum.ACTIVE)
+                context.update_time = now
+        self.journal.unblocked(record, customer_id, now)
+
+    def summary(self, record: ChatRecord, customer_id: UUID) -> Chat:
+        """The chat list entry, built from the denormalized last message without reading the chat history."""
+        last_message = record.last_message
+        return Chat(chat_id=record.chat_id,
+                    partner=customer_directory.get(record.partner_of(customer_id)),
+                    last_message=as_seen_by(last_message, customer_id) if last_message is not None else None,
+                    context=record.contexts[customer_id])
+
+    def details(self, record: ChatRecord, customer_id: UUID) -> ChatDetails:
+        last_message = record.last_message
+        return ChatDetails(chat_id=record.chat_id,
+                           partner=customer_directory.get(record.partner_of(customer_id)),
+                           last_message=as_seen_by(last_message, customer_id) if last_message is not None else None,
+                           context=record.contexts[customer_id],
+                           moderator=None,
+                           me=customer_directory.get(customer_id),
+                           is_started_by_me=record.started_by == customer_id)
+
+
+chat_store = ChatStore()
@@ -0,0 +1,36 @@
+from typing import Dict
+from uuid import UUID
+
+from models import AcceptChatMessagesEnum, Customer, CustomerStatusEnum
+
+
+class CustomerDirectory:
+    """
+    Customer profiles known to this process. Profiles are owned by the profile service and only profiles from a
+    trusted source are remembered, never one a client sends about another customer; customers without a known
+    profile get a placeholder carrying nothing but their id.
+    """
+
+    def __init__(self):
+        self._customers: Dict[UUID, Customer] = {}
+        self._accept_chat_messages: Dict[UUID, AcceptChatMessagesEnum] = {}
+
+    def remember(self, customer: Customer) -> None:
+        """Keep the profile of a customer from a trusted source, e.g. the system account."""
+        self._customers.setdefault(customer.customer_id, customer)
+
+    def get(self, customer_id: UUID) -> Customer:
+        customer = self._customers.get(customer_id)
+        if customer is None:
+            customer = Customer(customer_id=customer_id, username=str(customer_id), avatar_url="",
+                                display_name="", status=CustomerStatusEnum.OFFLINE, country=None)
+        return customer
+
+    def accept_chat_messages(self, customer_id: UUID) -> AcceptChatMessagesEnum:
+        return self._accept_chat_messages.get(customer_id, AcceptChatMessagesEnum.YES)
+
+    def set_accept_chat_messages(self, customer_id: UUID, value: AcceptChatMessagesEnum) -> None:
+        self._accept_chat_messages[customer_id] = value
+
+
+customer_directory = CustomerDirectory()
@@ -0,0 +1,65 @@
+from typing import Dict, Tuple
+from uuid import UUID
+
+from models import AcceptChatMessagesEnum, ChatContextStatusEnum, CheckChatCreationErrorCodeEnum, \
+    CheckChatCreationInternalResponse, CheckChatCreationResultEnum
+from services.chats import SYSTEM_ACCOUNT_ID, chat_store
+from services.customers import customer_directory
+
+# Cached decisions kept before the cache is dropped and rebuilt from the pair index
+ELIGIBILITY_CACHE_SIZE = 100_000
+
+
+def _could_not_start(error_code: CheckChatCreationErrorCodeEnum, chat_id=None) -> CheckChatCreationInternalResponse:
+    return CheckChatCreationInternalResponse(result=CheckChatCreationResultEnum.COULD_NOT_START,
+                                             error_code=error_code, chat_id=chat_id)
+
+
+class ChatCreationEligibility:
+    """
+    Decides whether a customer could start a chat with a partner, backed by the chat pair index.
+
+    Decisions are cached per (customer, partner). Block / unblock and chat creation drop the entries of the pair;
+    a privacy change of the partner bumps their version, which makes every cached decision about them stale.
+    """
+
+    def __init__(self):
+        self._decisions: Dict[Tuple[UUID, UUID], Tuple[int, CheckChatCreationInternalResponse]] = {}
+        self._privacy_versions: Dict[UUID, int] = {}
+
+    def check(self, customer_id: UUID, partner_id: UUID) -> CheckChatCreationInternalResponse:
+        version = self._privacy_versions.get(partner_id, 0)
+        cached = self._decisions.get((customer_id, partner_id))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        decision = self._decide(customer_id, partner_id)
+        if len(self._decisions) >= ELIGIBILITY_CACHE_SIZE:
+            self._decisions.clear()
+        self._decisions[(customer_id, partner_id)] = (version, decision)
+        return decision
+
+    def _decide(self, customer_id: UUID, partner_id: UUID) -> CheckChatCreationInternalResponse:
+        # The SYSTEM chat of a customer is made by the system messages only, never started by the customer
+        if customer_id == partner_id or partner_id == SYSTEM_ACCOUNT_ID:
+            return _could_not_start(CheckChatCreationErrorCodeEnum.could_not_start)
+        record = chat_store.find_between(customer_id, partner_id)
+        if record is not None:
+            if record.contexts[customer_id].status == ChatContextStatusEnum.BLOCKED:
+                return _could_not_start(CheckChatCreationErrorCodeEnum.chat_blocked, record.chat_id)
+            return CheckChatCreationInternalResponse(result=CheckChatCreationResultEnum.ALREADY_STARTED,
+                                                     error_code=None, chat_id=record.chat_id)
+        # Trusted contacts and trade partners are not known to this service, so only YES lets a new chat start
+        if customer_directory.accept_chat_messages(partner_id) != AcceptChatMessagesEnum.YES:
+            return _could_not_start(CheckChatCreationErrorCodeEnum.privacy_settings)
+        return CheckChatCreationInternalResponse(result=CheckChatCreationResultEnum.COULD_START, error_code=None,
+                                                 chat_id=None)
+
+    def pair_changed(self, customer_id: UUID, partner_id: UUID) -> None:
+        self._decisions.pop((customer_id, partner_id), None)
+        self._decisions.pop((partner_id, customer_id), None)
+
+    def privacy_changed(self, customer_id: UUID) -> None:
+        self._privacy_versions[customer_id] = self._privacy_versions.get(customer_id, 0) + 1
+
+
+chat_eligibility = ChatCreationEligibility()
@@ -0,0 +1,438 @@
+import abc
+import asyncio
+import importlib
+import logging
+import os
+import socket
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set
+
+# Datagrams kept for a worker that does not read its socket fast enough. Past that they are dropped and the worker
+# is told to disconnect its subscribers, who missed events.
+EVENT_BUS_BACKLOG = 1_000
+# Events sent to a worker are packed into datagrams of up to this many bytes
+EVENT_BUS_DATAGRAM = 65_536
+# Seconds before sending to a worker again after a datagram to it could not be sent and was dropped
+EVENT_BUS_RETRY = 1.0
+
+# Frames of the bus protocol. A payload is the sender name and one frame per line: the kind, the channel and for
+# events "\0" and the event. Channels and serialized events are single-line.
+EVENT = "E"
+SUBSCRIBED = "S"
+UNSUBSCRIBED = "U"
+HELLO = "H"
+LOST = "L"
+
+logger = logging.getLogger(__name__)
+
+
+def _ignore(*args) -> None:
+    pass
+
+
+class EventBus:
+    """
+    Carries serialized inbox events to the other processes serving the API, so subscribers get the events of
+    every worker. The hub delivers events to its own subscribers and hands them to the bus for the processes that
+    announced subscribers on the channel; events of other processes come back through deliver(channel, event).
+    Events of one process arrive everywhere in the order it published them, so the events of a chat stay in
+    order while its writes go through one process at a time.
+
+    This base class is the bus of a single process, with nobody else to tell. The subclasses keep track of the
+    channels the other processes listen on from their announcements, and tell the callbacks in listening_changed
+    when a channel gets its first listening process or loses its last one.
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.deliver: Callable[[str, str], None] = _ignore
+        self.lost: Callable[[], None] = _ignore
+        self._local: Set[str] = set()
+        self._listeners: Dict[str, Set[str]] = {}
+        self._peer_channels: Dict[str, Set[str]] = {}
+        self.listening_changed: List[Callable[[str], None]] = []
+
+    def start(self, deliver: Callable[[str, str], None], lost: Callable[[], None]) -> None:
+        """Start receiving; lost() is called when events of another process were dropped on the way."""
+        self.deliver = deliver
+        self.lost = lost
+
+    def subscribed(self, channel: str) -> None:
+        """The channel has got its first subscriber in this process."""
+        self._local.add(channel)
+        self._announce(SUBSCRIBED + channel)
+
+    def unsubscribed(self, channel: str) -> None:
+        """The last subscriber of the channel in this process is gone."""
+        self._local.discard(channel)
+        self._announce(UNSUBSCRIBED + channel)
+
+    def listening(self, channel: str) -> bool:
+        """Whether another process has subscribers on the channel."""
+        return channel in self._listeners
+
+    def channels(self) -> Iterable[str]:
+        """Channels with subscribers in other processes."""
+        return self._listeners.keys()
+
+    def publish(self, channel: str, event: str) -> None:
+        """Hand the event to the other processes with subscribers on the channel."""
+
+    def close(self) -> None:
+        pass
+
+    def _announce(self, frame: str) -> None:
+        """Send a frame to every other process."""
+
+    def _greet(self, peer: str) -> None:
+        """Tell a process that has just started which channels this one listens on."""
+
+    def _receive(self, payload: str) -> None:
+        sender, *frames = payload.split("\n")
+        if sender == self.name:
+            return
+        for frame in frames:
+            kind = frame[:1]
+            if kind == EVENT:
+                channel, _, event = frame.partition("\0")
+                self.deliver(channel[1:], event)
+            elif kind == SUBSCRIBED:
+                peers = self._listeners.get(frame[1:])
+                if peers is None:
+                    peers = self._listeners[frame[1:]] = set()
+                    self._changed(frame[1:])
+                peers.add(sender)
+                self._peer_channels.setdefault(sender, set()).add(frame[1:])
+            elif kind == UNSUBSCRIBED:
+                self._drop_listener(sender, frame[1:])
+                self._peer_channels.get(sender, set()).discard(frame[1:])
+            elif kind == HELLO:
+                self._greet(sender)
+            elif kind == LOST:
+                logger.warning("Events from %s were dropped, disconnecting the subscribers", sender)
+                self._forget(sender)
+                self.lost()
+
+    def _drop_listener(self, peer: str, channel: str) -> None:
+        peers = self._listeners.get(channel)
+        if peers is not None:
+            peers.discard(peer)
+            if not peers:
+                del self._listeners[channel]
+                self._changed(channel)
+
+    def _changed(self, channel: str) -> None:
+        for callback in self.listening_changed:
+            callback(channel)
+
+    def _forget(self, peer: str) -> None:
+        for channel in self._peer_channels.pop(peer, ()):
+            self._drop_listener(peer, channel)
+
+
+class _Peer:
+    __slots__ = ("name", "socket", "frames", "backlog", "lost")
+
+    def __init__(self, name: str, sock: socket.socket):
+        self.name = name
+        self.socket = sock
+        self.frames: List[str] = []
+        self.backlog: Deque[Optional[bytes]] = deque()
+        self.lost = False
+
+
+class UnixSocketEventBus(EventBus):
+    """
+    The workers of one host, each bound to a Unix datagram socket named after its pid in a shared directory. A
+    starting worker greets the sockets it finds there and the others answer with the channels they listen on;
+    later changes are announced as they happen. An event is sent only to the workers listening on its channel,
+    with everything published for a worker in one event loop iteration packed into as few datagrams as possible.
+
+    Datagrams between two sockets are neither lost nor reordered. Those a slow worker cannot take yet wait in a
+    backlog in order, and a worker that is gone is noticed when sending to it fails and is forgotten with its
+    channels. A socket file without a worker behind it is removed by the next worker that starts.
+    """
+
+    def __init__(self, directory: str, backlog: int = EVENT_BUS_BACKLOG):
+        super().__init__("%d.sock" % os.getpid())
+        self.directory = directory
+        self.backlog = backlog
+        self._socket: Optional[socket.socket] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._peers: Dict[str, _Peer] = {}
+        self._flushing: List[_Peer] = []
+        self._buffer = bytearray(1 << 20)
+
+    def start(self, deliver: Callable[[str, str], None], lost: Callable[[], None]) -> None:
+        super().start(deliver, lost)
+        self._loop = asyncio.get_running_loop()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.name)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        self._socket.setblocking(False)
+        self._loop.add_reader(self._socket.fileno(), self._read)
+        for name in os.listdir(self.directory):
+            if name.endswith(".sock") and name != self.name:
+                self._send(name, HELLO)
+
+    def publish(self, channel: str, event: str) -> None:
+        peers = self._listeners.get(channel)
+        if peers:
+            frame = "%s%s\0%s" % (EVENT, channel, event)
+            for name in list(peers):
+                self._send(name, frame)
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._loop.remove_reader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+            try:
+                os.unlink(os.path.join(self.directory, self.name))
+            except FileNotFoundError:
+                pass
+        for name in list(self._peers):
+            self._disconnect(name)
+
+    def _announce(self, frame: str) -> None:
+        for name in list(self._peer_channels.keys() | self._peers.keys()):
+            self._send(name, frame)
+
+    def _greet(self, peer: str) -> None:
+        if self._peer(peer) is not None:
+            for channel in self._local:
+                self._send(peer, SUBSCRIBED + channel)
+
+    def _read(self) -> None:
+        # One datagram per event loop iteration: it holds what a worker published in one iteration, and the
+        # subscribers get to drain their queues before the next
+        try:
+            size = self._socket.recv_into(self._buffer)
+        except BlockingIOError:
+            return
+        self._receive(self._buffer[:size].decode())
+
+    def _peer(self, name: str) -> Optional[_Peer]:
+        peer = self._peers.get(name)
+        if peer is None:
+            path = os.path.join(self.directory, name)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(path)
+            except ConnectionRefusedError:
+                sock.close()
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                return None
+            except FileNotFoundError:
+                sock.close()
+                return None
+            peer = self._peers[name] = _Peer(name, sock)
+        return peer
+
+    def _send(self, name: str, frame: str) -> None:
+        """Queue a frame for the worker; the frames go out once the current event loop iteration is done."""
+        peer = self._peer(name)
+        if peer is None:
+            self._forget(name)
+            return
+        if not peer.frames:
+            if not self._flushing:
+                self._loop.call_soon(self._flush)
+            self._flushing.append(peer)
+        peer.frames.append(frame)
+
+    def _pack(self, peer: _Peer) -> None:
+        frames, peer.frames = peer.frames, []
+        if peer.lost:
+            return
+        if len(peer.backlog) >= self.backlog:
+            # Everything up to the resync is dropped; it is built when sent, with the channels listened on then
+            logger.warning("Worker %s does not keep up with the event bus, dropping its backlog", peer.name)
+            peer.backlog.clear()
+            peer.backlog.append(None)
+            peer.lost = True
+            return
+        peer.backlog.extend(self._datagrams(frames))
+
+    def _datagrams(self, frames: List[str]) -> List[bytes]:
+        header = self.name.encode()
+        datagrams = []
+        chunk, size = [header], len(header)
+        for frame in frames:
+            data = frame.encode()
+            if size + 1 + len(data) > EVENT_BUS_DATAGRAM and len(chunk) > 1:
+                datagrams.append(b"\n".join(chunk))
+                chunk, size = [header], len(header)
+            chunk.append(data)
+            size += 1 + len(data)
+        datagrams.append(b"\n".join(chunk))
+        return datagrams
+
+    def _flush(self) -> None:
+        flushing, self._flushing = self._flushing, []
+        for peer in flushing:
+            self._pack(peer)
+            if self._peers.get(peer.name) is peer:
+                self._write(peer)
+
+    def _write(self, peer: _Peer) -> None:
+        backlog = peer.backlog
+        while backlog:
+            if backlog[0] is None:
+                backlog.popleft()
+                resync = [LOST] + [SUBSCRIBED + channel for channel in self._local]
+                backlog.extendleft(reversed(self._datagrams(resync)))
+                peer.lost = False
+            try:
+                peer.socket.send(backlog[0])
+            except BlockingIOError:
+                self._loop.add_writer(peer.socket.fileno(), self._drain, peer)
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._disconnect(peer.name)
+                return
+            except OSError:
+                # The worker misses what was dropped: it gets the resync instead, once sending works again
+                logger.exception("Event bus datagram to %s dropped, resyncing it", peer.name)
+                backlog.clear()
+                backlog.append(None)
+                peer.lost = True
+                self._loop.call_later(EVENT_BUS_RETRY, self._retry, peer)
+                return
+            backlog.popleft()
+
+    def _retry(self, peer: _Peer) -> None:
+        if self._peers.get(peer.name) is peer:
+            self._write(peer)
+
+    def _drain(self, peer: _Peer) -> None:
+        self._loop.remove_writer(peer.socket.fileno())
+        self._write(peer)
+
+    def _disconnect(self, name: str) -> None:
+        peer = self._peers.pop(name, None)
+        if peer is not None:
+            self._loop.remove_writer(peer.socket.fileno())
+            peer.socket.close()
+        self._forget(name)
+
+
+class Broker(abc.ABC):
+    """
+    Topic-based publish/subscribe of a message broker, e.g. an adapter over a Redis or NATS client. Messages of a
+    topic published by one client are expected to reach the subscribers in order, and the callbacks are called on
+    the event loop of the process.
+    """
+
+    @abc.abstractmethod
+    def publish(self, topic: str, payload: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def subscribe(self, topic: str, callback: Callable[[str], None]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def unsubscribe(self, topic: str, callback: Callable[[str], None]) -> None:
+        pass
+
+
+class InProcessBroker(Broker):
+    """Broker of the processes simulated in one process, delivering synchronously. Stands in for a real one in tests."""
+
+    def __init__(self):
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = {}
+        self.published = 0
+
+    def publish(self, topic: str, payload: str) -> None:
+        self.published += 1
+        for callback in list(self._callbacks.get(topic, ())):
+            callback(payload)
+
+    def subscribe(self, topic: str, callback: Callable[[str], None]) -> None:
+        self._callbacks.setdefault(topic, []).append(callback)
+
+    def unsubscribe(self, topic: str, callback: Callable[[str], None]) -> None:
+        callbacks = self._callbacks.get(topic)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._callbacks[topic]
+
+
+class BrokerEventBus(EventBus):
+    """
+    Processes on any number of hosts sharing a broker. Each process subscribes to the topics of the channels it
+    has subscribers on, so the broker routes an event only where it is wanted; the announcements go to a common
+    control topic, so publishers skip events nobody listens to, and answers to a greeting go to the topic of the
+    process that greeted. A process that stopped without unsubscribing stays a listener of its channels, which
+    only costs events the broker drops.
+    """
+
+    def __init__(self, broker: Broker, prefix: str = "inbox-bus"):
+        super().__init__(uuid.uuid4().hex)
+        self.broker = broker
+        self.prefix = prefix
+        self._control = "%s.control" % prefix
+
+    def start(self, deliver: Callable[[str, str], None], lost: Callable[[], None]) -> None:
+        super().start(deliver, lost)
+        self.broker.subscribe(self._control, self._receive)
+        self.broker.subscribe(self._topic(self.name), self._receive)
+        self._announce(HELLO)
+
+    def subscribed(self, channel: str) -> None:
+        self.broker.subscribe(self._topic(channel), self._receive)
+        super().subscribed(channel)
+
+    def unsubscribed(self, channel: str) -> None:
+        self.broker.unsubscribe(self._topic(channel), self._receive)
+        super().unsubscribed(channel)
+
+    def publish(self, channel: str, event: str) -> None:
+        if channel in self._listeners:
+            self.broker.publish(self._topic(channel), "%s\n%s%s\0%s" % (self.name, EVENT, channel, event))
+
+    def close(self) -> None:
+        for channel in list(self._local):
+            self.unsubscribed(channel)
+        self.broker.unsubscribe(self._control, self._receive)
+        self.broker.unsubscribe(self._topic(self.name), self._receive)
+
+    def _topic(self, channel: str) -> str:
+        return "%s.%s" % (self.prefix, channel)
+
+    def _announce(self, frame: str) -> None:
+        self.broker.publish(self._control, "%s\n%s" % (self.name, frame))
+
+    def _greet(self, peer: str) -> None:
+        if self._local:
+            self.broker.publish(self._topic(peer), "%s\n%s" % (
+                self.name, "\n".join(SUBSCRIBED + channel for channel in self._local)))
+
+
+def event_bus(setting: str) -> EventBus:
+    """
+    The bus of a setting: "local" for a single process, "unix:<directory>" for the processes of one host, or
+    "broker:<module>:<name>" for processes sharing a broker, with the name of a Broker subclass or of a function
+    returning a Broker in the module.
+    """
+    if setting.startswith("unix:"):
+        return UnixSocketEventBus(setting[len("unix:"):])
+    if setting.startswith("broker:"):
+        module, _, name = setting[len("broker:"):].partition(":")
+        broker = getattr(importlib.import_module(module), name)()
+        if not isinstance(broker, Broker):
+            raise ValueError("Event bus %r does not make a Broker" % setting)
+        return BrokerEventBus(broker)
+    if setting != "local":
+        raise ValueError("Unknown event bus %r" % setting)
+    return EventBus()
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+from fastapi import status
+from pydantic import BaseModel
+
+from dependencies import ApiError
+
+T = TypeVar("T")
+
+# Seconds a response is replayed for a repeated idempotence key
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+# Responses kept at most; the oldest are evicted first
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+# Author, route, target of the request, e.g. the chat, and the idempotence key
+IdempotencyKey = Tuple[Hashable, str, Hashable, str]
+
+
+def request_fingerprint(*values: Any) -> bytes:
+    """SHA-256 of the parts of a request that make up what it does, to tell a retry from another request."""
+    return hashlib.sha256(json.dumps(values, default=str).encode()).digest()
+
+
+def _check_fingerprint(original: bytes, fingerprint: bytes, request_id: str) -> None:
+    if original != fingerprint:
+        raise ApiError(status.HTTP_409_CONFLICT, "idempotency_key_reused",
+                       "external_request_id %s was already used for a different request" % request_id)
+
+
+def _retrieve(task: asyncio.Future) -> None:
+    # Every caller may have gone by the time the handler fails; mark the outcome retrieved to keep the loop from
+    # logging it
+    if not task.cancelled():
+        task.exception()
+
+
+class IdempotencyStore:
+    """
+    Responses of requests carrying an idempotence key, by (author, route, target, external_request_id), with the
+    fingerprint of the request that produced them.
+
+    A repeated request gets the stored response without running the handler again, as it was when answered. A
+    duplicate arriving while the first request is still running waits for it and gets the same outcome, also when
+    the first caller is cancelled. A request reusing the key of
+    another one, i.e. with a different fingerprint, is rejected with 409 instead of getting a response that is
+    not its own. Failed requests are not stored, so they could be retried with the same key. Entries expire
+    after the TTL and the store is bounded in size.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._responses: "OrderedDict[IdempotencyKey, Tuple[float, bytes, object]]" = OrderedDict()
+        self._running: Dict[IdempotencyKey, Tuple[bytes, asyncio.Task]] = {}
+        self.replayed = 0
+        self.coalesced = 0
+
+    def _get(self, key: IdempotencyKey) -> Optional[Tuple[bytes, object]]:
+        entry = self._responses.get(key)
+        if entry is None or entry[0] <= monotonic():
+            return None
+        return entry[1], entry[2]
+
+    async def run(self, author: Hashable, route: str, target: Hashable, request_id: Optional[str],
+                  fingerprint: bytes, handler: Callable[[], Awaitable[T]]) -> T:
+        if not request_id:
+            return await handler()
+        key = (author, route, target, request_id)
+        stored = self._get(key)
+        if stored is not None:
+            _check_fingerprint(stored[0], fingerprint, request_id)
+            self.replayed += 1
+            return stored[1]
+        running = self._running.get(key)
+        if running is not None:
+            _check_fingerprint(running[0], fingerprint, request_id)
+            self.coalesced += 1
+            return await asyncio.shield(running[1])
+
+        # The handler runs in a task of its own, so a caller that goes away, e.g. on a client disconnect, stops
+        # waiting without cancelling the request for the duplicates waiting on it
+        task = asyncio.ensure_future(self._complete(key, fingerprint, handler))
+        task.add_done_callback(_retrieve)
+        self._running[key] = (fingerprint, task)
+        return await asyncio.shield(task)
+
+    async def _complete(self, key: IdempotencyKey, fingerprint: bytes, handler: Callable[[], Awaitable[T]]) -> T:
+        try:
+            response = await handler()
+            self._store(key, fingerprint, response)
+            return response
+        finally:
+            del self._running[key]
+
+    def _store(self, key: IdempotencyKey, fingerprint: bytes, response: object) -> None:
+        now = monotonic()
+        responses = self._responses
+        responses.pop(key, None)
+        # A copy, as the response may be a live object, e.g. the last message of a chat, that changes after
+        # it was sent; a retry gets it as it was answered
+        if isinstance(response, BaseModel):
+            response = response.model_copy()
+        responses[key] = (now + self.ttl, fingerprint, response)
+        while responses and (len(responses) > self.max_keys or next(iter(responses.values()))[0] <= now):
+            responses.popitem(last=False)
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,237 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+from uuid import UUID
+
+from pydantic import BaseModel
+
+from models import MarketingMessage, Message, Token
+from services.chats import ChatRecord
+from services.event_bus import EventBus, event_bus
+from services.marketing import marketing_store
+from services.messages import as_seen_by
+from services.unread import unread_counters
+
+# Secret for inbox channel tokens. Shared between workers the same way as PAGE_TOKEN_SECRET.
+INBOX_TOKEN_SECRET = os.environ.get("INBOX_TOKEN_SECRET", "").encode() or os.urandom(32)
+INBOX_SUBSCRIBE_KEY = os.environ.get("INBOX_SUBSCRIBE_KEY", "sub-inbox")
+INBOX_TOKEN_TTL = 3600
+
+# Events waiting for a subscriber. A subscriber that falls this far behind is disconnected
+# and is expected to reconnect and re-read its chats.
+INBOX_QUEUE_SIZE = 256
+# Max events sent to a subscriber in one WebSocket frame / SSE event
+INBOX_BATCH_SIZE = 64
+# Online channels a marketing broadcast is published to per event loop iteration
+MARKETING_FANOUT_SHARD = 1000
+# How events reach the subscribers connected to other processes: "local" when there is one process,
+# "unix:<directory>" for the processes of one host, each listening on a Unix socket in the directory, or
+# "broker:<module>:<name>" for processes sharing a message broker, with the Broker made by module.name()
+INBOX_EVENT_BUS = os.environ.get("INBOX_EVENT_BUS", "local")
+
+
+def inbox_channel(customer_id: UUID) -> str:
+    return "inbox.%s" % customer_id
+
+
+def customer_of_channel(channel: str) -> UUID:
+    return UUID(channel[len("inbox."):])
+
+
+class ChannelTokens:
+    """HMAC tokens granting subscription to one inbox channel until they expire."""
+
+    def _sign(self, channel: str, expire: int) -> str:
+        digest = hmac.new(INBOX_TOKEN_SECRET, ("%s:%d" % (channel, expire)).encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode()
+
+    def issue(self, customer_id: UUID) -> Token:
+        channel = inbox_channel(customer_id)
+        expire = int(time.time()) + INBOX_TOKEN_TTL
+        return Token(token="%d.%s" % (expire, self._sign(channel, expire)),
+                     expire_time=datetime.fromtimestamp(expire, timezone.utc).isoformat(),
+                     remaining_seconds=INBOX_TOKEN_TTL,
+                     inbox_channel=channel,
+                     subscribe_key=INBOX_SUBSCRIBE_KEY)
+
+    def verify(self, channel: str, token: str) -> bool:
+        expire, _, signature = token.partition(".")
+        if not expire.isdigit() or int(expire) < time.time():
+            return False
+        return hmac.compare_digest(signature, self._sign(channel, int(expire)))
+
+
+class Subscription:
+    __slots__ = ("channel", "queue", "shed")
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(INBOX_QUEUE_SIZE)
+        self.shed = False
+
+    async def next_batch(self) -> Optional[List[str]]:
+        """
+        Wait for the next events and return everything queued up to INBOX_BATCH_SIZE, so bursts go out
+        in one frame. None means the subscriber was shed and the connection should be closed.
+        """
+        event = await self.queue.get()
+        batch = []
+        while event is not None:
+            batch.append(event)
+            if len(batch) >= INBOX_BATCH_SIZE or self.queue.empty():
+                return batch
+            event = self.queue.get_nowait()
+        return None
+
+
+class InboxHub:
+    """
+    Pub/sub for inbox channels with bounded per-subscriber queues. Events published for channels with subscribers
+    in other processes are handed to the event bus, which brings theirs to the subscribers of this process.
+    """
+
+    def __init__(self, bus: Optional[EventBus] = None):
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self.shed_count = 0
+        self.bus = bus or EventBus()
+        self._bus_started = False
+
+    def _start_bus(self) -> None:
+        self._bus_started = True
+        self.bus.start(self._deliver, self.shed_all)
+
+    def subscribe(self, channel: str) -> Subscription:
+        if not self._bus_started:
+            self._start_bus()
+        subscription = Subscription(channel)
+        subscribers = self._subscribers.get(channel)
+        if subscribers is None:
+            subscribers = self._subscribers[channel] = set()
+            self.bus.subscribed(channel)
+        subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.channel)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.channel]
+                self.bus.unsubscribed(subscription.channel)
+
+    def channels(self) -> List[str]:
+        """Channels with subscribers in this or another process."""
+        if not self._bus_started:
+            self._start_bus()
+        return list(self._subscribers.keys() | self.bus.channels())
+
+    def listening(self, channel: str) -> bool:
+        if not self._bus_started:
+            self._start_bus()
+        return channel in self._subscribers or self.bus.listening(channel)
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, channel: str, event: str) -> None:
+        """Queue a serialized event for every subscriber of the channel without waiting for any of them."""
+        if not self._bus_started:
+            self._start_bus()
+        self._deliver(channel, event)
+        self.bus.publish(channel, event)
+
+    def _deliver(self, channel: str, event: str) -> None:
+        subscribers = self._subscribers.get(channel)
+        if not subscribers:
+            return
+        for subscription in list(subscribers):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._shed(subscription)
+
+    def shed_all(self) -> None:
+        """Disconnect every subscriber, e.g. after events for them were lost on the way from another process."""
+        for subscribers in list(self._subscribers.values()):
+            for subscription in list(subscribers):
+                self._shed(subscription)
+
+    def _shed(self, subscription: Subscription) -> None:
+        self.unsubscribe(subscription)
+        subscription.shed = True
+        self.shed_count += 1
+        queue = subscription.queue
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+def encode_event(event_type: str, chat_id: Optional[UUID], data: BaseModel) -> str:
+    chat = '"%s"' % chat_id if chat_id is not None else "null"
+    return '{"type":"%s","chat_id":%s,"data":%s}' % (event_type, chat, data.model_dump_json())
+
+
+def encode_batch(batch: List[str]) -> str:
+    return "[%s]" % ",".join(batch)
+
+
+# The notify_* helpers serialize an event only when its channel has subscribers in some process: most members
+# are offline.
+
+def notify_message(record: ChatRecord, message: Message) -> None:
+    for member_id in record.members:
+        channel = inbox_channel(member_id)
+        if inbox_hub.listening(channel):
+            inbox_hub.publish(channel, encode_event("message", record.chat_id, as_seen_by(message, member_id)))
+
+
+def notify_unread(customer_id: UUID) -> None:
+    channel = inbox_channel(customer_id)
+    if inbox_hub.listening(channel):
+        inbox_hub.publish(channel, encode_event("unread", None, unread_counters.counters(customer_id)))
+
+
+def notify_context(record: ChatRecord, member_id: UUID) -> None:
+    """Publish the chat context of the member along with the unread counters it feeds."""
+    channel = inbox_channel(member_id)
+    if inbox_hub.listening(channel):
+        inbox_hub.publish(channel, encode_event("context", record.chat_id, record.contexts[member_id]))
+    notify_unread(member_id)
+
+
+def notify_acknowledged(record: ChatRecord, member_id: UUID, context_changed: bool, updated: List[Message]) -> None:
+    """Publish the outcome of a delivered / read acknowledgement made by the member."""
+    for message in updated:
+        notify_message(record, message)
+    if context_changed:
+        notify_context(record, member_id)
+
+
+async def _fan_out(event: str) -> None:
+    channels = inbox_hub.channels()
+    for start in range(0, len(channels), MARKETING_FANOUT_SHARD):
+        for channel in channels[start:start + MARKETING_FANOUT_SHARD]:
+            inbox_hub.publish(channel, event)
+        await asyncio.sleep(0)
+
+
+def notify_marketing(message: MarketingMessage) -> None:
+    """
+    Announce an activated broadcast to the customers online right now, in any process. The event is serialized
+    once and published a shard of channels at a time, so a large audience does not stall the event loop. Offline
+    customers pick the broadcast up from marketing_unread_count.
+    """
+    task = asyncio.get_running_loop().create_task(_fan_out(encode_event("marketing", None, message)))
+    _fan_outs.add(task)
+    task.add_done_callback(_fan_outs.discard)
+
+
+inbox_hub = InboxHub(event_bus(INBOX_EVENT_BUS))
+channel_tokens = ChannelTokens()
+_fan_outs: Set[asyncio.Task] = set()
+marketing_store.listeners.append(notify_marketing)
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from fastapi import status
+
+from dependencies import ApiError
+from models import MarketingMessage, MarketingMessageStatusEnum, MarketingMessageUpdateReq
+from services.timer_wheel import TimerWheel
+
+# Seconds per scheduler tick: broadcasts go out at most this long after their start_time
+MARKETING_TICK = float(os.environ.get("MARKETING_TICK", "1"))
+MARKETING_WHEEL_SLOTS = 3600
+
+MarketingKey = Tuple[datetime, UUID]
+
+
+class MarketingStore:
+    """
+    Marketing broadcasts and their PENDING -> ACTIVE -> DELETED lifecycle.
+
+    Pending broadcasts sit in a timer wheel until their start_time. Activation does not copy anything per
+    recipient: the broadcast gets the next sequence number on a shared timeline, and every customer only has a
+    read pointer into it, so marketing_unread_count is the number of live broadcasts past the pointer. A customer
+    gets the pointer on first sight at the end of the timeline: broadcasts that went out before they ever asked
+    for their counters are not unread for them.
+    """
+
+    def __init__(self, tick: float = MARKETING_TICK, slots: int = MARKETING_WHEEL_SLOTS):
+        self._messages: Dict[UUID, MarketingMessage] = {}
+        self._keys: List[MarketingKey] = []
+        self._sequence_of: Dict[UUID, int] = {}
+        self._live: List[int] = []
+        self._last_sequence = 0
+        self._pointers: Dict[UUID, int] = {}
+        self._wheel: TimerWheel[UUID] = TimerWheel(tick, slots)
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.listeners: List[Callable[[MarketingMessage], None]] = []
+
+    def get(self, marketing_id: UUID) -> MarketingMessage:
+        message = self._messages.get(marketing_id)
+        if message is None:
+            raise ApiError(status.HTTP_404_NOT_FOUND, "marketing_message_not_found", "Marketing message not found")
+        return message
+
+    def create(self, message: MarketingMessage) -> MarketingMessage:
+        created = message.model_copy(update={"marketing_id": uuid4(),
+                                             "status": MarketingMessageStatusEnum.PENDING,
+                                             "create_time": datetime.now(timezone.utc),
+                                             "update_time": None})
+        self._messages[created.marketing_id] = created
+        insort(self._keys, (created.create_time, created.marketing_id))
+        self._schedule(created)
+        return self._messages[created.marketing_id]
+
+    def update(self, marketing_id: UUID, update: MarketingMessageUpdateReq) -> MarketingMessage:
+        message = self.get(marketing_id)
+        if message.status == MarketingMessageStatusEnum.DELETED:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "marketing_message_deleted", "Marketing message is deleted")
+        if message.status == MarketingMessageStatusEnum.ACTIVE and update.status == MarketingMessageStatusEnum.PENDING:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_status",
+                           "Active marketing message could not be moved back to PENDING")
+        # A PATCH: fields left out of the request keep their value, and the text can't be cleared
+        changes = update.model_dump(exclude_unset=True, exclude={"status"})
+        if update.text is None:
+            changes.pop("text", None)
+        updated = message.model_copy(update={**changes, "update_time": datetime.now(timezone.utc)})
+        self._messages[marketing_id] = updated
+        if update.status == MarketingMessageStatusEnum.DELETED:
+            self._delete(updated)
+        elif updated.status == MarketingMessageStatusEnum.PENDING:
+            if update.status == MarketingMessageStatusEnum.ACTIVE:
+                self._activate(marketing_id)
+            else:
+                self._schedule(updated)
+        return self._messages[marketing_id]
+
+    def page(self, after: Optional[MarketingKey], limit: int, descending: bool,
+             statuses: List[MarketingMessageStatusEnum]) -> Tuple[List[MarketingMessage], bool]:
+        """Broadcasts with the given statuses strictly after the key in creation order."""
+        if descending:
+            end = bisect_left(self._keys, after) if after is not None else len(self._keys)
+            keys = (self._keys[position] for position in range(end - 1, -1, -1))
+        else:
+            start = bisect_right(self._keys, after) if after is not None else 0
+            keys = (self._keys[position] for position in range(start, len(self._keys)))
+        items = []
+        for _, marketing_id in keys:
+            message = self._messages[marketing_id]
+            if not statuses or message.status in statuses:
+                if len(items) == limit:
+                    return items, True
+                items.append(message)
+        return items, False
+
+    def unread_count(self, customer_id: UUID) -> int:
+        pointer = self._pointers.get(customer_id)
+        if pointer is None:
+            pointer = self._pointers[customer_id] = self._last_sequence
+        return len(self._live) - bisect_right(self._live, pointer)
+
+    def read_all(self, customer_id: UUID) -> None:
+        if self._last_sequence:
+            self._pointers[customer_id] = self._last_sequence
+
+    def activate_due(self, now: float) -> None:
+        for marketing_id in self._wheel.advance(now):
+            self._activate(marketing_id)
+
+    def _schedule(self, message: MarketingMessage) -> None:
+        if message.start_time is None or message.start_time.timestamp() <= time.time():
+            self._activate(message.marketing_id)
+            return
+        self._wheel.schedule(message.marketing_id, message.start_time.timestamp())
+        if self._timer is None:
+            self._arm()
+
+    def _arm(self) -> None:
+        self._timer = None
+        if len(self._wheel):
+            self._timer = asyncio.get_running_loop().call_later(self._wheel.next_delay(time.time()), self._tick)
+
+    def _tick(self) -> None:
+        self.activate_due(time.time())
+        self._arm()
+
+    def _activate(self, marketing_id: UUID) -> None:
+        self._wheel.cancel(marketing_id)
+        self._last_sequence += 1
+        self._sequence_of[marketing_id] = self._last_sequence
+        self._live.append(self._last_sequence)
+        message = self._messages[marketing_id] = self._messages[marketing_id].model_copy(
+            update={"status": MarketingMessageStatusEnum.ACTIVE})
+        for listener in self.listeners:
+            listener(message)
+
+    def _delete(self, message: MarketingMessage) -> None:
+        self._wheel.cancel(message.marketing_id)
+        sequence = self._sequence_of.pop(message.marketing_id, None)
+        if sequence is not None:
+            del self._live[bisect_left(self._live, sequence)]
+        self._messages[message.marketing_id] = message.model_copy(
+            update={"status": MarketingMessageStatusEnum.DELETED})
+
+
+marketing_store = MarketingStore()
@@ -0,0 +1,386 @@
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from pydantic import TypeAdapter
+
+from models import PARAMETERS_BY_MESSAGE_TYPE, Message, MessageAttachment, MessageStatusEnum, MessageTypeEnum, \
+    SystemMessageParameters
+from services.packing import construct, from_microseconds, to_microseconds
+from services.search import SearchIndex
+from services.shards import chat_shards
+
+MessageKey = Tuple[datetime, UUID]
+
+DEFAULT_PAGE_LIMIT = 20
+MAX_PAGE_LIMIT = 100
+# Messages appended to a history before their ids are indexed; until then lookups scan their packed ids
+ID_RUN_SIZE = int(os.environ.get("ID_RUN_SIZE", "1024"))
+
+# Statuses by the code the histories and services.chat_log store them as
+MESSAGE_STATUSES = list(MessageStatusEnum)
+_STATUS_CODES = {message_status: code for code, message_status in enumerate(MESSAGE_STATUSES)}
+_TYPES = list(MessageTypeEnum)
+_TYPE_CODES = {message_type: code for code, message_type in enumerate(_TYPES)}
+_TYPE_MASK = 0x3F
+_IS_MINE = 0x80
+# The message follows the one before it in the history, prev_message_id is the id packed before its own
+_AFTER_PREVIOUS = 0x40
+# Texts up to this length are interned, short replies repeat across messages and chats
+INTERNED_TEXT_LENGTH = 32
+# Fields that are mostly None, stored as a tuple in this order only when one of them is set
+_SPARSE_FIELDS = ("parameters", "update_time", "offer_hash", "trade_hash", "attachments", "prev_message_id")
+_NO_SPARSE = (None,) * len(_SPARSE_FIELDS)
+# Low bits of an id index entry holding the position, the high bits hold the id prefix
+_POSITION_BITS = 28
+_POSITION_MASK = (1 << _POSITION_BITS) - 1
+
+_attachments_adapter = TypeAdapter(List[MessageAttachment])
+
+
+def message_key(message: Message) -> MessageKey:
+    return message.create_time, message.message_id
+
+
+def as_seen_by(message: Message, customer_id: UUID) -> Message:
+    """The message with is_mine set from the point of view of the given customer."""
+    is_mine = message.author_id == customer_id
+    if message.is_mine == is_mine:
+        return message
+    return message.model_copy(update={"is_mine": is_mine})
+
+
+def new_message(message: Message, author_id: UUID) -> Message:
+    """A client message with the read-only fields replaced, ready to be posted to a chat."""
+    return message.model_copy(update={"author_id": author_id, "is_mine": True, "type": MessageTypeEnum.MESSAGE,
+                                      "parameters": None, "update_time": None, "attachments": None})
+
+
+def searchable_text(message: Message) -> str:
+    texts = [message.text or ""]
+    parameters = message.parameters
+    if isinstance(parameters, SystemMessageParameters) and parameters.message and parameters.message != message.text:
+        texts.append(parameters.message)
+    # Keeps a query from matching across the end of one text and the start of the next
+    return " \0 ".join(texts)
+
+
+def effective_limit(limit: Optional[int]) -> int:
+    if not limit:
+        return DEFAULT_PAGE_LIMIT
+    return max(1, min(limit, MAX_PAGE_LIMIT))
+
+
+class ChatMessages:
+    """
+    Messages of a single chat ordered by (create_time, message_id), kept in columns rather than as Message
+    objects: the ids packed 16 bytes each, the create times as int64 microseconds, the authors as indexes into
+    the few authors of the chat, the status and type as one-byte codes, the texts and external request ids as
+    strings, system texts and offer / trade hashes interned, and the rarely set fields aside by position. That
+    takes a few dozen bytes per message next to the couple of kilobytes of a Message. A Message is built from
+    the columns every time one is read and is a copy, so changes are stored with set_status and update.
+
+    Pages are served by seeking to the cursor key with a binary search over the create times and building
+    `limit` messages, so the cost of a page does not depend on how deep into the history it is. Message ids
+    are looked up in sorted runs of their prefixes, merged as the history grows, and the messages appended
+    since the last run by scanning their packed ids from the newest one back.
+
+    The text search index is built on the first search in the chat and kept up to date by `add` from then on.
+    """
+
+    def __init__(self):
+        self._ids = bytearray()
+        self._times = array("q")
+        self._authors = array("H")
+        self._author_ids: List[UUID] = []
+        self._statuses = bytearray()
+        # Type code with the _IS_MINE and _AFTER_PREVIOUS bits
+        self._kinds = bytearray()
+        self._texts: List[Optional[str]] = []
+        self._request_ids: List[Optional[str]] = []
+        self._sparse: Dict[int, tuple] = {}
+        # Sorted runs of id prefix << _POSITION_BITS | position, the largest first, covering the first
+        # `_indexed` messages
+        self._runs: List[array] = []
+        self._indexed = 0
+        self._search: Optional[SearchIndex[int]] = None
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def _message(self, position: int) -> Message:
+        kind = self._kinds[position]
+        offset = position * 16
+        values = {"external_request_id": self._request_ids[position],
+                  "message_id": UUID(int=int.from_bytes(self._ids[offset:offset + 16])),
+                  "create_time": from_microseconds(self._times[position]),
+                  "text": self._texts[position],
+                  "author_id": self._author_ids[self._authors[position]],
+                  "is_mine": bool(kind & _IS_MINE),
+                  "status": MESSAGE_STATUSES[self._statuses[position]],
+                  "type": _TYPES[kind & _TYPE_MASK],
+                  "parameters": None, "update_time": None, "offer_hash": None, "trade_hash": None,
+                  "attachments": None, "prev_message_id": None}
+        sparse = self._sparse.get(position)
+        if sparse is not None:
+            values.update(zip(_SPARSE_FIELDS, sparse))
+            # Parameters and attachments are kept as JSON, a fraction of the size of their models
+            if type(values["parameters"]) is bytes:
+                values["parameters"] = PARAMETERS_BY_MESSAGE_TYPE[values["type"]].model_validate_json(
+                    values["parameters"])
+            if values["attachments"] is not None:
+                values["attachments"] = _attachments_adapter.validate_json(values["attachments"])
+        if kind & _AFTER_PREVIOUS:
+            values["prev_message_id"] = UUID(int=int.from_bytes(self._ids[offset - 16:offset]))
+        return construct(Message, values)
+
+    @property
+    def last(self) -> Optional[Message]:
+        return self._message(len(self._times) - 1) if self._times else None
+
+    @property
+    def last_id(self) -> Optional[UUID]:
+        return UUID(int=int.from_bytes(self._ids[-16:])) if self._times else None
+
+    def next_create_time(self) -> datetime:
+        """Current time, bumped past the last message so the history stays strictly ordered."""
+        now = datetime.now(timezone.utc)
+        if self._times and to_microseconds(now) <= self._times[-1]:
+            now = from_microseconds(self._times[-1] + 1)
+        return now
+
+    def _columns(self, position: int, message: Message) -> Tuple[int, int, int, Optional[str], Optional[tuple]]:
+        """Status code, author index, kind and text of the message at the position and its sparse fields."""
+        author_id = message.author_id
+        try:
+            author = self._author_ids.index(author_id)
+        except ValueError:
+            author = len(self._author_ids)
+            self._author_ids.append(author_id)
+        kind = _TYPE_CODES[message.type] | (_IS_MINE if message.is_mine else 0)
+        text = message.text
+        if text is not None and (len(text) <= INTERNED_TEXT_LENGTH or message.type == MessageTypeEnum.SYSTEM):
+            text = sys.intern(text)
+        prev_message_id = message.prev_message_id
+        if (prev_message_id is not None and position
+                and prev_message_id.bytes == self._ids[position * 16 - 16:position * 16]):
+            kind |= _AFTER_PREVIOUS
+            prev_message_id = None
+        parameters, attachments = message.parameters, message.attachments
+        if parameters is not None and type(parameters) is PARAMETERS_BY_MESSAGE_TYPE.get(message.type):
+            parameters = parameters.__pydantic_serializer__.to_json(parameters)
+        if attachments is not None:
+            attachments = _attachments_adapter.dump_json(attachments)
+        offer_hash, trade_hash = message.offer_hash, message.trade_hash
+        sparse = (parameters, message.update_time, offer_hash and sys.intern(offer_hash),
+                  trade_hash and sys.intern(trade_hash), attachments, prev_message_id)
+        return _STATUS_CODES[message.status], author, kind, text, sparse if sparse != _NO_SPARSE else None
+
+    def add(self, message: Message) -> None:
+        time = to_microseconds(message.create_time)
+        raw = message.message_id.bytes
+        position = len(self._times)
+        if position and (time < self._times[-1] or time == self._times[-1] and raw <= self._ids[-16:]):
+            self._insert(self._seek(time, raw, right=False), time, raw, message)
+        else:
+            status_code, author, kind, text, sparse = self._columns(position, message)
+            self._ids += raw
+            self._times.append(time)
+            self._authors.append(author)
+            self._statuses.append(status_code)
+            self._kinds.append(kind)
+            self._texts.append(text)
+            self._request_ids.append(message.external_request_id)
+            if sparse:
+                self._sparse[position] = sparse
+            if position + 1 - self._indexed >= ID_RUN_SIZE:
+                self._index_tail()
+            if self._search is not None:
+                self._search.update(position, searchable_text(message))
+
+    def _insert(self, position: int, time: int, raw: bytes, message: Message) -> None:
+        """Insert a message posted out of order; the positions after it move, so the indexes are rebuilt."""
+        if position < len(self._times) and self._kinds[position] & _AFTER_PREVIOUS:
+            self._kinds[position] &= ~_AFTER_PREVIOUS
+            self._sparse[position] = self._sparse.get(position, _NO_SPARSE)[:-1] + (
+                UUID(int=int.from_bytes(self._ids[position * 16 - 16:position * 16])),)
+        self._sparse = {(moved + 1 if moved >= position else moved): sparse
+                        for moved, sparse in self._sparse.items()}
+        status_code, author, kind, text, sparse = self._columns(position, message)
+        self._ids[position * 16:position * 16] = raw
+        self._times.insert(position, time)
+        self._authors.insert(position, author)
+        self._statuses.insert(position, status_code)
+        self._kinds.insert(position, kind)
+        self._texts.insert(position, text)
+        self._request_ids.insert(position, message.external_request_id)
+        if sparse:
+            self._sparse[position] = sparse
+        self._runs, self._indexed = [], 0
+        self._search = None
+
+    def update(self, message: Message) -> bool:
+        """Store the fields of a message of the history other than its id and create time."""
+        position = self.position(message.message_id)
+        if position is None:
+            return False
+        status_code, author, kind, text, sparse = self._columns(position, message)
+        self._authors[position] = author
+        self._statuses[position] = status_code
+        self._kinds[position] = kind
+        self._texts[position] = text
+        self._request_ids[position] = message.external_request_id
+        if sparse:
+            self._sparse[position] = sparse
+        else:
+            self._sparse.pop(position, None)
+        if self._search is not None:
+            self._search.update(position, searchable_text(message))
+        return True
+
+    def _index_tail(self) -> None:
+        """Index the messages appended since the last run, merging runs so there are a logarithmic number."""
+        ids = self._ids
+        run = array("Q", sorted(int.from_bytes(ids[position * 16:position * 16 + 8]) >> _POSITION_BITS
+                                << _POSITION_BITS | position for position in range(self._indexed, len(self._times))))
+        runs = self._runs
+        while runs and len(runs[-1]) <= len(run):
+            # Sorting two sorted runs is a merge
+            run = array("Q", sorted(runs.pop() + run))
+        runs.append(run)
+        self._indexed = len(self._times)
+
+    def position(self, message_id: UUID) -> Optional[int]:
+        """Where the message is in the history, or None."""
+        raw = message_id.bytes
+        ids = self._ids
+        start = self._indexed * 16
+        end = len(ids)
+        while True:
+            found = ids.rfind(raw, start, end)
+            if found < 0:
+                break
+            if found % 16 == 0:
+                return found // 16
+            # A match across two ids, look further back
+            end = found + 15
+        prefix = int.from_bytes(raw[:8]) >> _POSITION_BITS
+        for run in self._runs:
+            index = bisect_left(run, prefix << _POSITION_BITS)
+            while index < len(run) and run[index] >> _POSITION_BITS == prefix:
+                position = run[index] & _POSITION_MASK
+                if ids[position * 16:position * 16 + 16] == raw:
+                    return position
+                index += 1
+        return None
+
+    def get(self, message_id: UUID) -> Optional[Message]:
+        position = self.position(message_id)
+        return self._message(position) if position is not None else None
+
+    def status_of(self, position: int) -> MessageStatusEnum:
+        return MESSAGE_STATUSES[self._statuses[position]]
+
+    def set_status(self, position: int, message_status: MessageStatusEnum) -> None:
+        self._statuses[position] = _STATUS_CODES[message_status]
+
+    def statuses(self) -> bytes:
+        """Status codes of the messages in order, indexes into MESSAGE_STATUSES."""
+        return bytes(self._statuses)
+
+    def _seek(self, time: int, raw: bytes, right: bool) -> int:
+        """Position of the key as bisect_left, or bisect_right if `right`, over the message keys."""
+        position = bisect_left(self._times, time)
+        end = bisect_right(self._times, time, position)
+        # Messages posted within the same microsecond are ordered by id, the packed ids compare as the UUIDs
+        while position < end:
+            current = self._ids[position * 16:position * 16 + 16]
+            if current > raw or current == raw and not right:
+                break
+            position += 1
+        return position
+
+    def _bounds(self, after: Optional[MessageKey], descending: bool) -> int:
+        """Position to read from for messages strictly after the key in the requested order."""
+        if after is None:
+            return len(self._times) if descending else 0
+        return self._seek(to_microseconds(after[0]), after[1].bytes, right=not descending)
+
+    def count_after(self, key: MessageKey) -> int:
+        return len(self._times) - self._bounds(key, descending=False)
+
+    def page(self, after: Optional[MessageKey], limit: int, descending: bool = False) -> Tuple[List[Message], bool]:
+        """
+        Return up to `limit` messages strictly after the `after` key in the requested order
+        and whether more messages follow.
+        """
+        if descending:
+            end = self._bounds(after, descending)
+            start = max(0, end - limit)
+            return [self._message(position) for position in range(end - 1, start - 1, -1)], start > 0
+        start = self._bounds(after, descending)
+        end = min(start + limit, len(self._times))
+        return [self._message(position) for position in range(start, end)], end < len(self._times)
+
+    def search(self, query: str) -> Set[int]:
+        """Positions of the messages whose text or system message matches the query."""
+        if self._search is None:
+            self._search = SearchIndex()
+            for position in range(len(self._times)):
+                self._search.update(position, searchable_text(self._message(position)))
+        return self._search.search(query)
+
+    def page_among(self, positions: Set[int], after: Optional[MessageKey], limit: int,
+                   descending: bool = False) -> Tuple[List[Message], bool]:
+        """Same as page, restricted to the messages at the given positions, e.g. search hits."""
+        ordered = sorted(positions)
+        if descending:
+            candidates = ordered[:bisect_left(ordered, self._bounds(after, descending))]
+            selected = candidates[:-limit - 1:-1]
+        else:
+            candidates = ordered[bisect_left(ordered, self._bounds(after, descending)):]
+            selected = candidates[:limit]
+        return [self._message(position) for position in selected], len(candidates) > limit
+
+
+class MessageArchive:
+    """
+    Where the messages of a chat come from when its history is first used. The base class has none, so every
+    history starts empty; services.chat_log reads them back from its log.
+    """
+
+    def history(self, chat_id: UUID) -> ChatMessages:
+        return ChatMessages()
+
+    def last(self, chat_id: UUID) -> Optional[Message]:
+        return None
+
+
+class MessageStore:
+    """Message histories of the chats in use, kept in the shard of each chat."""
+
+    def __init__(self):
+        self.archive = MessageArchive()
+
+    def chat(self, chat_id: UUID) -> ChatMessages:
+        histories = chat_shards.shard(chat_id).messages
+        messages = histories.get(chat_id)
+        if messages is None:
+            messages = histories[chat_id] = self.archive.history(chat_id)
+        return messages
+
+    def find(self, chat_id: UUID) -> Optional[ChatMessages]:
+        """The history of the chat if it is in use, without reading it from the archive."""
+        return chat_shards.shard(chat_id).messages.get(chat_id)
+
+    def last(self, chat_id: UUID) -> Optional[Message]:
+        """The last message of the chat, read on its own if the history is not in use."""
+        messages = chat_shards.shard(chat_id).messages.get(chat_id)
+        return messages.last if messages is not None else self.archive.last(chat_id)
+
+
+message_store = MessageStore()
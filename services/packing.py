@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, FrozenSet, Type, TypeVar
+
+from pydantic import BaseModel
+
+Model = TypeVar("Model", bound=BaseModel)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+_FIELDS: Dict[type, FrozenSet[str]] = {}
+
+
+def to_microseconds(moment: datetime) -> int:
+    """Microseconds since the epoch, a naive time taken as UTC."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def from_microseconds(microseconds: int) -> datetime:
+    return _EPOCH + microseconds * _MICROSECOND
+
+
+def construct(model: Type[Model], values: dict) -> Model:
+    """
+    Model.model_construct(**values) for values that give every field, as the stores unpack them. This is the one
+    place that sets pydantic's instance attributes directly: skipping model_construct's keyword and default
+    handling takes listing a page of messages from 1400 to 2100 pages a second in benchmarks/message_store.py,
+    and benchmarks/packing.py checks the result against model_construct. Nothing is validated or copied.
+    """
+    fields = _FIELDS.get(model)
+    if fields is None:
+        fields = _FIELDS[model] = frozenset(model.model_fields)
+    instance = object.__new__(model)
+    object.__setattr__(instance, "__dict__", values)
+    object.__setattr__(instance, "__pydantic_fields_set__", set(fields))
+    object.__setattr__(instance, "__pydantic_extra__", None)
+    object.__setattr__(instance, "__pydantic_private__", None)
+    return instance
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import struct
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Tuple, TypeVar
+from uuid import UUID
+
+from fastapi import status
+
+from dependencies import ApiError
+from services.packing import from_microseconds, to_microseconds
+
+T = TypeVar("T")
+
+Key = Tuple[datetime, UUID]
+
+# Tokens signed by one worker have to be accepted by the others, so deployments running more than one
+# process must share PAGE_TOKEN_SECRET. Without it, tokens are only valid within the issuing process.
+PAGE_TOKEN_SECRET = os.environ.get("PAGE_TOKEN_SECRET", "").encode() or os.urandom(32)
+
+_PAYLOAD = struct.Struct(">Bq16s8s")
+_SIGNATURE_SIZE = 8
+_BACKWARD = 1
+_DESCENDING = 2
+
+
+def _digest(listing: Iterable) -> bytes:
+    return hashlib.blake2b("\x1f".join(map(str, listing)).encode(), digest_size=8).digest()
+
+
+class PageTokenCodec:
+    """
+    Opaque keyset page tokens: a (timestamp, id) sort key, the direction of the page and the sort order, and a
+    digest of the listing, signed with HMAC-SHA256 and encoded as unpadded base64url. The listing is what
+    scopes the scan besides the endpoint, e.g. the chat id and filters, so a token is only accepted by the
+    endpoint that issued it, for the same listing in the same order. Resuming a scan needs no server-side
+    cursor state.
+    """
+
+    def __init__(self, scope: str):
+        self._scope = scope.encode()
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(PAGE_TOKEN_SECRET, self._scope + payload, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+
+    def encode(self, key: Key, backward: bool = False, descending: bool = False, listing: Iterable = ()) -> str:
+        timestamp, key_id = key
+        flags = (_BACKWARD if backward else 0) | (_DESCENDING if descending else 0)
+        payload = _PAYLOAD.pack(flags, to_microseconds(timestamp), key_id.bytes, _digest(listing))
+        return base64.urlsafe_b64encode(payload + self._sign(payload)).rstrip(b"=").decode()
+
+    def decode(self, token: str, descending: bool = False, listing: Iterable = ()) -> Tuple[Key, bool]:
+        """
+        Return the sort key and whether the token points backward (prev_page_token). A token of another sort
+        order or listing is rejected with 400 like a malformed one.
+        """
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except (binascii.Error, ValueError):
+            raw = b""
+        payload, signature = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+        if len(raw) != _PAYLOAD.size + _SIGNATURE_SIZE or not hmac.compare_digest(signature, self._sign(payload)):
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_page_token", "Malformed page token")
+        flags, micros, key_id, digest = _PAYLOAD.unpack(payload)
+        if bool(flags & _DESCENDING) != descending or digest != _digest(listing):
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_page_token",
+                           "Page token belongs to another listing or sort order")
+        return (from_microseconds(micros), UUID(bytes=key_id)), bool(flags & _BACKWARD)
+
+
+def keyset_page(page: Callable[[Optional[Key], int, bool], Tuple[List[T], bool]],
+                after: Optional[Key], backward: bool, limit: int,
+                descending: bool) -> Tuple[List[T], bool, bool]:
+    """
+    Run a keyset page query in either direction.
+
+    `page(after, limit, descending)` returns up to `limit` items strictly after the key and whether more follow.
+    The result is the items in the requested order plus whether next and previous pages exist.
+    """
+    if backward:
+        items, has_prev = page(after, limit, not descending)
+        return items[::-1], True, has_prev
+    items, has_next = page(after, limit, descending)
+    return items, has_next, after is not None
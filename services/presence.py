@@ -0,0 +1,76 @@
+import os
+from time import monotonic
+from typing import Dict, Iterable, List, Tuple
+from uuid import UUID
+
+from models import CustomerStatusEnum, ProfileBaseWithChatId
+from services.customers import customer_directory
+from services.inbox import customer_of_channel, inbox_channel, inbox_hub
+
+# Seconds a resolved presence is reused before it is evaluated again
+PRESENCE_TTL = float(os.environ.get("PRESENCE_TTL", "5"))
+# Memoized entries kept before the expired ones are swept
+PRESENCE_MEMO_SIZE = 100_000
+
+
+class PresenceIndex:
+    """
+    Presence of customers: a customer is ONLINE while they hold at least one inbox connection, to this process or
+    to another one, which the event bus knows from the inbox channels the other processes announce.
+
+    Batches of customers are resolved in one pass over the index. Resolved entries are memoized for PRESENCE_TTL
+    and dropped early when the customer connects, disconnects or changes privacy settings, or their channel gets
+    its first or loses its last subscriber in the other processes.
+    """
+
+    def __init__(self, ttl: float = PRESENCE_TTL):
+        self.ttl = ttl
+        self._connections: Dict[UUID, int] = {}
+        self._memo: Dict[UUID, Tuple[float, ProfileBaseWithChatId]] = {}
+
+    def connected(self, customer_id: UUID) -> None:
+        self._connections[customer_id] = self._connections.get(customer_id, 0) + 1
+        self._memo.pop(customer_id, None)
+
+    def disconnected(self, customer_id: UUID) -> None:
+        connections = self._connections.get(customer_id, 0) - 1
+        if connections > 0:
+            self._connections[customer_id] = connections
+        else:
+            self._connections.pop(customer_id, None)
+            self._memo.pop(customer_id, None)
+
+    def invalidate(self, customer_id: UUID) -> None:
+        self._memo.pop(customer_id, None)
+
+    def is_online(self, customer_id: UUID) -> bool:
+        return customer_id in self._connections or inbox_hub.listening(inbox_channel(customer_id))
+
+    def resolve(self, customer_ids: Iterable[UUID]) -> List[ProfileBaseWithChatId]:
+        """Presence and privacy of the given customers, de-duplicated, in the order of first appearance."""
+        now = monotonic()
+        memo = self._memo
+        connections = self._connections
+        listening = inbox_hub.listening
+        accept_chat_messages = customer_directory.accept_chat_messages
+        if len(memo) > PRESENCE_MEMO_SIZE:
+            memo = {key: entry for key, entry in memo.items() if entry[0] > now}
+            self._memo = memo = memo if len(memo) <= PRESENCE_MEMO_SIZE // 2 else {}
+        resolved = []
+        for customer_id in dict.fromkeys(customer_ids):
+            entry = memo.get(customer_id)
+            if entry is None or entry[0] <= now:
+                profile = ProfileBaseWithChatId(
+                    customer_id=customer_id,
+                    status=CustomerStatusEnum.ONLINE
+                    if customer_id in connections or listening(inbox_channel(customer_id))
+                    else CustomerStatusEnum.OFFLINE,
+                    accept_chat_messages=accept_chat_messages(customer_id),
+                    chat_id=None)
+                entry = memo[customer_id] = (now + self.ttl, profile)
+            resolved.append(entry[1])
+        return resolved
+
+
+presence_index = PresenceIndex()
+inbox_hub.bus.listening_changed.append(lambda channel: presence_index.invalidate(customer_of_channel(channel)))
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from time import monotonic_ns
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from fastapi import Depends, status
+
+from dependencies import ApiError
+from services.auth import verified_customer
+
+# Token buckets as name=requests/seconds separated by commas. A name is a route, limiting the route alone, or a
+# scope, limiting every route of the scope together. Names without a bucket are not limited.
+RATE_LIMITS = os.environ.get("RATE_LIMITS",
+                             "send_message=30/10,start_chat=10/60,upload_file=20/60,chats:write=300/60")
+# Shared memory segment the uvicorn workers of a host keep the buckets in. By default it is named after the parent
+# process, which the workers of one server share and the workers of another server on the host do not.
+RATE_LIMIT_SEGMENT = os.environ.get("RATE_LIMIT_SEGMENT") or "message-service-rate-limits-%d" % os.getppid()
+# Buckets the segment holds; a bucket takes 16 bytes
+RATE_LIMIT_SLOTS = int(os.environ.get("RATE_LIMIT_SLOTS", str(1 << 20)))
+# Slots searched for a bucket before the least loaded one of them is taken over
+RATE_LIMIT_PROBES = 4
+
+MASK64 = (1 << 64) - 1
+_SLOT = struct.Struct("=Qq")
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimit:
+    """A token bucket of `requests` tokens refilled over `seconds`, identified across processes by its salt."""
+
+    __slots__ = ("name", "requests", "seconds", "interval", "capacity", "salt")
+
+    def __init__(self, name: str, requests: int, seconds: float):
+        self.name = name
+        self.requests = requests
+        self.seconds = seconds
+        self.interval = int(seconds * 1e9 / requests)
+        self.capacity = self.interval * requests
+        self.salt = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
+def parse_rate_limits(value: str) -> Dict[str, RateLimit]:
+    limits = {}
+    for item in value.split(","):
+        if item.strip():
+            name, _, rate = item.partition("=")
+            requests, _, seconds = rate.partition("/")
+            limits[name.strip()] = RateLimit(name.strip(), int(requests), float(seconds))
+    return limits
+
+
+class SharedBuckets:
+    """
+    Token buckets of all customers in a shared memory segment, so every worker process on the host enforces the
+    same limits without a network store.
+
+    A bucket is kept as GCRA does it: one theoretical arrival time in monotonic nanoseconds, which runs ahead of
+    the clock by the tokens already spent. A request is admitted while that stays within the capacity and moves
+    it on by one interval. Slots hold a 64-bit key fingerprint and the arrival time, written with aligned 8-byte
+    stores and no lock between processes: concurrent requests of one customer in different workers may both be
+    admitted on the last token, so a burst overshoots by at most the number of workers. A slot whose arrival
+    time has passed is a full bucket and is free to reuse, so the table never needs cleaning up.
+
+    The worker that created the segment unlinks it when closed; the others only detach.
+    """
+
+    def __init__(self, name: Optional[str] = RATE_LIMIT_SEGMENT, slots: int = RATE_LIMIT_SLOTS,
+                 probes: int = RATE_LIMIT_PROBES):
+        self.name = name
+        self.probes = probes
+        self._segment: Optional[shared_memory.SharedMemory] = None
+        self._created = False
+        self._buffer = None
+        self._slots = slots
+
+    def _attach(self) -> None:
+        size = self._slots * _SLOT.size
+        if self.name is None:
+            self._buffer = memoryview(bytearray(size))
+        else:
+            try:
+                try:
+                    self._segment = shared_memory.SharedMemory(self.name, create=True, size=size)
+                    self._created = True
+                except FileExistsError:
+                    self._segment = shared_memory.SharedMemory(self.name)
+                # Keep the resource tracker from unlinking the segment under the other workers when this one exits;
+                # close() unlinks it in the worker that created it
+                resource_tracker.unregister(self._segment._name, "shared_memory")
+                self._buffer = self._segment.buf
+            except OSError:
+                logger.exception("Rate limit segment %s is not available, limiting per process", self.name)
+                self._buffer = memoryview(bytearray(size))
+        self._slots = len(self._buffer) // _SLOT.size
+        self._buffer = self._buffer[:self._slots * _SLOT.size]
+
+    def acquire(self, customer_id: UUID, limits: List[RateLimit], now: Optional[int] = None) -> float:
+        """
+        Take a token from every bucket of the customer, or from none of them. Returns 0 when admitted, otherwise
+        the seconds until the fullest bucket has a token again.
+        """
+        buffer = self._buffer
+        if buffer is None:
+            self._attach()
+            buffer = self._buffer
+        if now is None:
+            now = monotonic_ns()
+        identity = customer_id.int
+        identity = (identity ^ identity >> 64) & MASK64
+        updates = []
+        wait = 0
+        for limit in limits:
+            key = (identity ^ limit.salt) or 1
+            offset = key % self._slots * _SLOT.size
+            slot_key, arrival = _SLOT.unpack_from(buffer, offset)
+            if slot_key != key:
+                offset, arrival = self._probe(key, offset, now)
+            arrival = (arrival if arrival > now else now) + limit.interval
+            if arrival - now > limit.capacity:
+                wait = max(wait, arrival - now - limit.capacity)
+            updates.append((offset, key, arrival))
+        if wait:
+            return wait / 1e9
+        for offset, key, arrival in updates:
+            _SLOT.pack_into(buffer, offset, key, arrival)
+        return 0
+
+    def _probe(self, key: int, offset: int, now: int) -> Tuple[int, int]:
+        """Slot of the key past its home slot, or the least loaded slot searched to start a full bucket in."""
+        size = len(self._buffer)
+        spare, spare_arrival = offset, _SLOT.unpack_from(self._buffer, offset)[1]
+        for _ in range(self.probes - 1):
+            offset = (offset + _SLOT.size) % size
+            slot_key, arrival = _SLOT.unpack_from(self._buffer, offset)
+            if slot_key == key:
+                return offset, arrival
+            if arrival < spare_arrival:
+                spare, spare_arrival = offset, arrival
+        return spare, now
+
+    def close(self) -> None:
+        if self._segment is not None:
+            self._buffer = None
+            self._segment.close()
+            if self._created:
+                # Registered again for unlink() to unregister
+                resource_tracker.register(self._segment._name, "shared_memory")
+                self._segment.unlink()
+                self._created = False
+            self._segment = None
+
+
+def rate_limit(route: str, scope: str) -> Callable:
+    """
+    Dependency taking a token from the buckets of the route and of its scope for the customer of the request.
+    Rejected requests get 429 with Retry-After.
+    """
+    limits = [rate_limits[name] for name in (route, scope) if name in rate_limits]
+
+    async def check_rate_limit(customer_id: UUID = Depends(verified_customer)) -> None:
+        if limits:
+            wait = shared_buckets.acquire(customer_id, limits)
+            if wait:
+                raise ApiError(status.HTTP_429_TOO_MANY_REQUESTS, "rate_limited",
+                               "Too many requests, retry in %.1f seconds" % wait,
+                               headers={"Retry-After": str(math.ceil(wait))})
+
+    return check_rate_limit
+
+
+rate_limits = parse_rate_limits(RATE_LIMITS)
+shared_buckets = SharedBuckets()
@@ -0,0 +1,73 @@
+from typing import Dict, Generic, Hashable, Set, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+GRAM_SIZE = 3
+# Marks the prefix grams of words so they never collide with trigrams of the text
+_PREFIX = "\0"
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def _grams(text: str) -> Set[str]:
+    grams = {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+    for word in text.split():
+        grams.update(_PREFIX + word[:size] for size in range(1, GRAM_SIZE))
+    return grams
+
+
+class SearchIndex(Generic[K]):
+    """
+    Case-insensitive inverted index of short texts by trigrams.
+
+    A query of three characters or more matches the texts that contain it as a substring: the postings of its
+    trigrams are intersected starting from the rarest one and the few candidates left are verified. Shorter
+    queries match the texts with a word starting with them, which keeps type-ahead useful from the first key.
+    """
+
+    def __init__(self):
+        self._texts: Dict[K, str] = {}
+        self._postings: Dict[str, Set[K]] = {}
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def update(self, key: K, text: str) -> None:
+        text = normalize(text)
+        previous = self._texts.get(key)
+        if previous == text:
+            return
+        if previous is not None:
+            self.remove(key)
+        self._texts[key] = text
+        for gram in _grams(text):
+            self._postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key: K) -> None:
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        for gram in _grams(text):
+            postings = self._postings[gram]
+            postings.discard(key)
+            if not postings:
+                del self._postings[gram]
+
+    def search(self, query: str) -> Set[K]:
+        query = normalize(query)
+        if not query:
+            return set(self._texts)
+        if len(query) < GRAM_SIZE:
+            return set(self._postings.get(_PREFIX + query, ()))
+        postings = [self._postings.get(query[i:i + GRAM_SIZE]) for i in range(len(query) - GRAM_SIZE + 1)]
+        if not all(postings):
+            return set()
+        postings.sort(key=len)
+        rarest, others = postings[0], postings[1:]
+        hits = {key for key in rarest if all(key in other for other in others)}
+        if len(query) > GRAM_SIZE:
+            texts = self._texts
+            hits = {key for key in hits if query in texts[key]}
+        return hits
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+# Shards the chats and their message histories are partitioned into
+CHAT_SHARDS = int(os.environ.get("CHAT_SHARDS", "16"))
+# Points every shard takes on the hash ring; more points even out the shard sizes
+CHAT_SHARD_POINTS = 256
+
+MASK64 = (1 << 64) - 1
+GOLDEN64 = 0x9E3779B97F4A7C15
+
+
+def chat_hash(chat_id: UUID) -> int:
+    """
+    64-bit ring position of a chat: the upper half of the id, which holds the random bits of uuid4 and the
+    fast-moving clock of uuid1, multiplied out over the ring.
+    """
+    return (chat_id.int >> 64) * GOLDEN64 & MASK64
+
+
+class HashRing:
+    """
+    Consistent hashing of 64-bit keys onto shards 0..shards-1. Every shard takes `points` pseudo-random points
+    on the ring and owns the keys up to each of them, so adding or removing a shard only moves the keys next to
+    the points it takes or gives up, about 1/shards of them, where key % shards would move nearly all.
+    """
+
+    def __init__(self, shards: int, points: int = CHAT_SHARD_POINTS):
+        ring = sorted((int.from_bytes(hashlib.blake2b(b"%d:%d" % (shard, point), digest_size=8).digest(), "little"),
+                       shard) for shard in range(shards) for point in range(points))
+        self.shards = shards
+        self.points = points
+        self._points = [point for point, _ in ring]
+        # Keys past the last point wrap around to the first
+        self._owners = [shard for _, shard in ring] + [ring[0][1]]
+
+    def owner(self, key: int) -> int:
+        """Shard owning the key: the shard of the first point at or past it."""
+        return self._owners[bisect_left(self._points, key)]
+
+
+class ChatShard:
+    """Chat records, message histories and log entries of one shard, the unit moved when rebalancing."""
+
+    __slots__ = ("records", "messages", "logs")
+
+    def __init__(self):
+        # ChatRecord, ChatMessages and ChatLogEntry by chat id
+        self.records: Dict[UUID, Any] = {}
+        self.messages: Dict[UUID, Any] = {}
+        self.logs: Dict[UUID, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+class ChatShards:
+    """
+    Chat storage partitioned by chat_id on a consistent hash ring. Every route of a chat reaches its record and
+    history through the shard of its id, so a shard keeps all state keyed by its chats and is the unit a worker
+    owns, and changing the number of shards moves only the chats whose shard changed. The per-customer indexes
+    (chat lists, pairs, names) refer to the records and are not affected by a move.
+    """
+
+    def __init__(self, shards: int = CHAT_SHARDS, points: int = CHAT_SHARD_POINTS):
+        self.points = points
+        # Built on first use, it takes a few milliseconds that would otherwise add to the startup
+        self._ring: Optional[HashRing] = None
+        self._shards = [ChatShard() for _ in range(shards)]
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def shard(self, chat_id: UUID) -> ChatShard:
+        ring = self._ring
+        if ring is None:
+            ring = self._ring = HashRing(len(self._shards), self.points)
+        return self._shards[ring.owner(chat_hash(chat_id))]
+
+    def shards(self) -> List[ChatShard]:
+        return self._shards
+
+    def resize(self, shards: int) -> int:
+        """
+        Rebalance the chats onto the given number of shards in one go, a few microseconds per chat.
+        Returns how many chats moved.
+        """
+        ring = HashRing(shards, self.points)
+        targets = self._shards[:shards] + [ChatShard() for _ in range(len(self._shards), shards)]
+        moved = 0
+        for index, shard in enumerate(self._shards):
+            for chat_id in list(shard.records):
+                target = ring.owner(chat_hash(chat_id))
+                if target != index:
+                    for name in ChatShard.__slots__:
+                        table = getattr(shard, name)
+                        if chat_id in table:
+                            getattr(targets[target], name)[chat_id] = table.pop(chat_id)
+                    moved += 1
+            for name in ChatShard.__slots__[1:]:
+                table = getattr(shard, name)
+                for chat_id in list(table):
+                    if chat_id not in shard.records:
+                        target = ring.owner(chat_hash(chat_id))
+                        if target != index:
+                            getattr(targets[target], name)[chat_id] = table.pop(chat_id)
+        self._ring = ring
+        self._shards = targets
+        return moved
+
+
+chat_shards = ChatShards()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from uuid import UUID, uuid4
+
+from fastapi import status
+from pydantic import ValidationError
+
+from dependencies import ApiError
+from models import Customer, CustomerStatusEnum, Message, MessageStatusEnum, MessageTypeEnum, SystemMessage, \
+    SystemMessageParameters
+from services.chat_log import chat_log
+from services.chats import SYSTEM_ACCOUNT_ID, chat_store
+from services.customers import customer_directory
+from services.inbox import notify_context, notify_message
+
+# System messages accepted but not yet written. Submissions that do not fit are rejected as a whole.
+SYSTEM_QUEUE_SIZE = int(os.environ.get("SYSTEM_QUEUE_SIZE", "100000"))
+SYSTEM_WORKERS = int(os.environ.get("SYSTEM_WORKERS", "2"))
+# Max system messages a worker takes off the queue and writes in one go
+SYSTEM_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+customer_directory.remember(Customer(customer_id=SYSTEM_ACCOUNT_ID, username="system", avatar_url="",
+                                     display_name="System", status=CustomerStatusEnum.ONLINE, country=None))
+
+
+def system_message(message: SystemMessage) -> Message:
+    """The chat message for a system notification, ready to be posted to the SYSTEM chat of its customer."""
+    parameters = None
+    if message.parameters:
+        try:
+            parameters = SystemMessageParameters.model_validate(
+                {name: message.parameters.get(name) for name in SystemMessageParameters.model_fields})
+        except ValidationError:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_parameters", "Malformed system message parameters")
+    return Message(external_request_id=None, message_id=uuid4(), create_time=datetime.now(timezone.utc),
+                   text=message.text, author_id=SYSTEM_ACCOUNT_ID, is_mine=False, status=MessageStatusEnum.SENT,
+                   type=MessageTypeEnum.SYSTEM, parameters=parameters, update_time=None, offer_hash=None,
+                   trade_hash=None, attachments=None, prev_message_id=None)
+
+
+class SystemMessageQueue:
+    """
+    Ingestion of system notifications. Submitting only validates and enqueues; worker tasks take batches off the
+    bounded queue, group them by customer and write every group to the customer's SYSTEM chat as one batch, so
+    the unread counter, chat list position and context notification are updated once per customer and batch.
+
+    A batch is written without yielding to the event loop, so notifications of a customer keep their order
+    whichever worker picks them up, and the worker waits for it to be in the chat log before taking the next.
+    """
+
+    def __init__(self, size: int = SYSTEM_QUEUE_SIZE, workers: int = SYSTEM_WORKERS,
+                 batch_size: int = SYSTEM_BATCH_SIZE):
+        self.size = size
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.accepted = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def submit(self, messages: List[SystemMessage]) -> int:
+        entries = [(message.customer_id, system_message(message)) for message in messages]
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.size)
+            self._tasks = [asyncio.get_running_loop().create_task(self._work()) for _ in range(self.workers)]
+        if self._queue.qsize() + len(entries) > self.size:
+            raise ApiError(status.HTTP_503_SERVICE_UNAVAILABLE, "system_queue_full",
+                           "System message queue is full, retry later")
+        for entry in entries:
+            self._queue.put_nowait(entry)
+        self.accepted += len(entries)
+        return len(entries)
+
+    async def join(self) -> None:
+        """Wait until everything submitted so far is written and in the chat log."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """Write everything accepted so far and stop the workers."""
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queue = None
+        self._tasks = []
+
+    async def _work(self) -> None:
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                self._write(batch)
+                await chat_log.commit()
+            except Exception:
+                self.failed += len(batch)
+                logger.exception("Failed to write %d system messages", len(batch))
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _write(self, batch) -> None:
+        by_customer: Dict[UUID, List[Message]] = {}
+        for customer_id, message in batch:
+            by_customer.setdefault(customer_id, []).append(message)
+        for customer_id, messages in by_customer.items():
+            record = chat_store.system_chat(customer_id)
+            for sent in chat_store.post_messages(record, messages):
+                notify_message(record, sent)
+            notify_context(record, customer_id)
+        self.written += len(batch)
+        self.batches += 1
+
+
+system_message_queue = SystemMessageQueue()
@@ -0,0 +1,51 @@
+import math
+import time
+from typing import Dict, Generic, Hashable, List, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+
+class TimerWheel(Generic[K]):
+    """
+    Hashed timing wheel: keys are hashed into `slots` buckets by their due tick, so scheduling and cancelling
+    are O(1) and advancing the wheel only visits the buckets of the ticks that elapsed. After a stall longer
+    than a full turn every bucket is visited once and everything overdue fires.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 512, now: Optional[float] = None):
+        self.resolution = resolution
+        self._slots: List[Dict[K, int]] = [{} for _ in range(slots)]
+        self._due: Dict[K, int] = {}
+        self._tick = math.floor((time.time() if now is None else now) / resolution)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, key: K, when: float) -> None:
+        """Schedule the key at the `when` timestamp, replacing its previous schedule."""
+        self.cancel(key)
+        due = max(math.ceil(when / self.resolution), self._tick + 1)
+        self._due[key] = due
+        self._slots[due % len(self._slots)][key] = due
+
+    def cancel(self, key: K) -> None:
+        due = self._due.pop(key, None)
+        if due is not None:
+            del self._slots[due % len(self._slots)][key]
+
+    def advance(self, now: float) -> List[K]:
+        """Move the wheel to the `now` timestamp and return the keys that became due."""
+        tick = math.floor(now / self.resolution)
+        fired = []
+        for elapsed in range(self._tick + 1, min(tick, self._tick + len(self._slots)) + 1):
+            slot = self._slots[elapsed % len(self._slots)]
+            for key in [key for key, due in slot.items() if due <= tick]:
+                del slot[key]
+                del self._due[key]
+                fired.append(key)
+        self._tick = max(self._tick, tick)
+        return fired
+
+    def next_delay(self, now: float) -> float:
+        """Seconds until the next tick boundary."""
+        return max(0.0, (self._tick + 1) * self.resolution - now)
@@ -0,0 +1,122 @@
+import heapq
+from bisect import bisect_left
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from models import Trade, TradeStatusEnum
+from services.unread import unread_counters
+
+TradeKey = Tuple[datetime, str]
+
+
+class _TradeEntry:
+    __slots__ = ("trade", "key", "unread_count", "read_epoch")
+
+    def __init__(self, trade: Trade):
+        self.trade = trade
+        self.key: TradeKey = (trade.context.update_time, trade.trade_hash)
+        self.unread_count = 0
+        self.read_epoch = 0
+
+
+class _StatusBucket:
+    """Trades of one status ordered by (update_time, trade_hash)."""
+
+    def __init__(self):
+        self._keys: List[TradeKey] = []
+        self._entries: List[_TradeEntry] = []
+
+    def add(self, entry: _TradeEntry) -> None:
+        if not self._keys or entry.key > self._keys[-1]:
+            self._keys.append(entry.key)
+            self._entries.append(entry)
+        else:
+            position = bisect_left(self._keys, entry.key)
+            self._keys.insert(position, entry.key)
+            self._entries.insert(position, entry)
+
+    def remove(self, entry: _TradeEntry) -> None:
+        position = bisect_left(self._keys, entry.key)
+        del self._keys[position]
+        del self._entries[position]
+
+    def newest(self) -> Iterable[_TradeEntry]:
+        return reversed(self._entries)
+
+
+class CustomerTrades:
+    """
+    Trades of a single customer bucketed by status. A status-filtered list merges only the requested buckets,
+    newest first. Marking all trades as read bumps the read epoch: unread counts recorded under an older epoch
+    are treated as zero, so no trade has to be visited.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[TradeStatusEnum, _StatusBucket] = {}
+        self._entries: Dict[str, _TradeEntry] = {}
+        self.read_epoch = 0
+
+    def get(self, trade_hash: str) -> Optional[_TradeEntry]:
+        return self._entries.get(trade_hash)
+
+    def put(self, trade: Trade) -> None:
+        """Insert or replace the trade and count the update as unread."""
+        entry = self._entries.get(trade.trade_hash)
+        if entry is not None:
+            self._buckets[entry.trade.status].remove(entry)
+            entry.trade = trade
+            entry.key = (trade.context.update_time, trade.trade_hash)
+        else:
+            entry = self._entries[trade.trade_hash] = _TradeEntry(trade)
+        self._buckets.setdefault(trade.status, _StatusBucket()).add(entry)
+        if entry.read_epoch != self.read_epoch:
+            entry.read_epoch, entry.unread_count = self.read_epoch, 0
+        entry.unread_count += 1
+
+    def unread_count(self, entry: _TradeEntry) -> int:
+        return entry.unread_count if entry.read_epoch == self.read_epoch else 0
+
+    def newest(self, statuses: List[TradeStatusEnum], limit: int) -> List[_TradeEntry]:
+        buckets = [self._buckets[trade_status] for trade_status in statuses or self._buckets
+                   if trade_status in self._buckets]
+        merged = heapq.merge(*(bucket.newest() for bucket in buckets), key=lambda entry: entry.key, reverse=True)
+        return list(islice(merged, limit))
+
+
+class TradeStore:
+    def __init__(self):
+        self._customers: Dict[UUID, CustomerTrades] = {}
+
+    def put(self, customer_id: UUID, trade: Trade) -> None:
+        self._customers.setdefault(customer_id, CustomerTrades()).put(trade)
+        unread_counters.add_trades(customer_id, 1)
+
+    def get(self, customer_id: UUID, trade_hash: str) -> Optional[Trade]:
+        trades = self._customers.get(customer_id)
+        entry = trades.get(trade_hash) if trades is not None else None
+        return self._view(trades, entry) if entry is not None else None
+
+    def newest(self, customer_id: UUID, statuses: List[TradeStatusEnum], limit: int) -> List[Trade]:
+        trades = self._customers.get(customer_id)
+        if trades is None:
+            return []
+        return [self._view(trades, entry) for entry in trades.newest(statuses, limit)]
+
+    def read_all(self, customer_id: UUID) -> None:
+        trades = self._customers.get(customer_id)
+        if trades is not None:
+            trades.read_epoch += 1
+        unread_counters.reset_trades(customer_id)
+
+    @staticmethod
+    def _view(trades: CustomerTrades, entry: _TradeEntry) -> Trade:
+        unread_count = trades.unread_count(entry)
+        if entry.trade.context.unread_count == unread_count:
+            return entry.trade
+        context = entry.trade.context.model_copy(update={"unread_count": unread_count})
+        return entry.trade.model_copy(update={"context": context})
+
+
+trade_store = TradeStore()
@@ -0,0 +1,55 @@
+from typing import Dict, Set
+from uuid import UUID
+
+from models import ChatContextStatusEnum, UnreadCounters
+from services.marketing import marketing_store
+
+
+class UnreadCounterStore:
+    """
+    Per-customer unread totals by chat context status, kept up to date on every change of a context
+    unread_count or status, plus the set of chats with unread messages for each status. Reading the counters
+    is O(1) and read-all only has to visit the chats that actually have unread messages.
+    """
+
+    def __init__(self):
+        self._totals: Dict[UUID, Dict[ChatContextStatusEnum, int]] = {}
+        self._unread_chats: Dict[UUID, Dict[ChatContextStatusEnum, Set[UUID]]] = {}
+        self._trades: Dict[UUID, int] = {}
+
+    def update(self, customer_id: UUID, chat_id: UUID, context_status: ChatContextStatusEnum,
+               old_count: int, new_count: int) -> None:
+        totals = self._totals.setdefault(customer_id, {})
+        totals[context_status] = totals.get(context_status, 0) + new_count - old_count
+        unread_chats = self._unread_chats.setdefault(customer_id, {}).setdefault(context_status, set())
+        if new_count:
+            unread_chats.add(chat_id)
+        else:
+            unread_chats.discard(chat_id)
+
+    def move(self, customer_id: UUID, chat_id: UUID, old_status: ChatContextStatusEnum,
+             new_status: ChatContextStatusEnum, count: int) -> None:
+        if count and old_status != new_status:
+            self.update(customer_id, chat_id, old_status, count, 0)
+            self.update(customer_id, chat_id, new_status, 0, count)
+
+    def total(self, customer_id: UUID, context_status: ChatContextStatusEnum) -> int:
+        return self._totals.get(customer_id, {}).get(context_status, 0)
+
+    def unread_chats(self, customer_id: UUID, context_status: ChatContextStatusEnum) -> Set[UUID]:
+        return set(self._unread_chats.get(customer_id, {}).get(context_status, ()))
+
+    def add_trades(self, customer_id: UUID, delta: int) -> None:
+        self._trades[customer_id] = self._trades.get(customer_id, 0) + delta
+
+    def reset_trades(self, customer_id: UUID) -> None:
+        self._trades.pop(customer_id, None)
+
+    def counters(self, customer_id: UUID) -> UnreadCounters:
+        return UnreadCounters(chats_unread_count=self.total(customer_id, ChatContextStatusEnum.ACTIVE),
+                              trades_unread_count=self._trades.get(customer_id, 0),
+                              system_unread_count=self.total(customer_id, ChatContextStatusEnum.SYSTEM),
+                              marketing_unread_count=marketing_store.unread_count(customer_id))
+
+
+unread_counters = UnreadCounterStore()
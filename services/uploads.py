@@ -0,0 +1,174 @@
+import hashlib
+import os
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request, status
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from dependencies import ApiError
+
+UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+# Uploads are spilled here while they stream in; defaults to the system temp dir
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+# Max size of a plain (non-file) form field
+FORM_FIELD_MAX_SIZE = 1024
+
+IMAGE_SIGNATURES = {b"\xff\xd8\xff": ".jpg",
+                    b"\x89PNG\r\n\x1a\n": ".png"}
+_SIGNATURE_SIZE = max(len(signature) for signature in IMAGE_SIGNATURES)
+
+
+class UploadedFile:
+    """An uploaded image spilled to a temporary file, with its size and SHA-256."""
+
+    __slots__ = ("filename", "extension", "size", "sha256", "path")
+
+    def __init__(self, filename: str, extension: str, size: int, sha256: str, path: str):
+        self.filename = filename
+        self.extension = extension
+        self.size = size
+        self.sha256 = sha256
+        self.path = path
+
+    def discard(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _invalid_file(message: str) -> ApiError:
+    return ApiError(status.HTTP_400_BAD_REQUEST, "invalid_file", message)
+
+
+class _FileSink:
+    """Validates, hashes and spills one file part as its chunks arrive."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.extension: Optional[str] = None
+        self.size = 0
+        self._head = b""
+        self._sha256 = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, delete=False)
+
+    def feed(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_SIZE:
+            raise _invalid_file("Files up to %d MB are only allowed" % (UPLOAD_MAX_SIZE // (1024 * 1024)))
+        if self.extension is None:
+            self._head += data[:_SIGNATURE_SIZE]
+            self._check_signature(final=False)
+        self._sha256.update(data)
+
+    def _check_signature(self, final: bool) -> None:
+        for signature, extension in IMAGE_SIGNATURES.items():
+            if self._head.startswith(signature):
+                self.extension = extension
+                return
+        if final or len(self._head) >= _SIGNATURE_SIZE:
+            raise _invalid_file("Supported formats are jpeg, png, jpg")
+
+    def write(self, chunks: List[bytes]) -> None:
+        for chunk in chunks:
+            self._file.write(chunk)
+
+    def finish(self) -> UploadedFile:
+        if self.extension is None:
+            self._check_signature(final=True)
+        self._file.close()
+        return UploadedFile(self.filename, self.extension, self.size, self._sha256.hexdigest(), self._file.name)
+
+    def discard(self) -> None:
+        self._file.close()
+        os.unlink(self._file.name)
+
+
+class _UploadParser:
+    """
+    Multipart parser that streams the file field of the request into a _FileSink instead of buffering the body,
+    so memory per upload is bounded by the size of a body chunk and not by the size of the file.
+    """
+
+    def __init__(self, file_field: str):
+        self.file_field = file_field
+        self.fields: Dict[str, str] = {}
+        self.sink: Optional[_FileSink] = None
+        self.pending: List[bytes] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._field_name = ""
+        self._field_data = b""
+        self._to_sink = False
+
+    def on_part_begin(self) -> None:
+        self._headers = {}
+        self._field_data = b""
+        self._to_sink = False
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._field_name = options.get(b"name", b"").decode("latin-1")
+        filename = options.get(b"filename")
+        if self._field_name == self.file_field and filename is not None:
+            if self.sink is not None:
+                raise _invalid_file("Only one file could be uploaded")
+            self.sink = _FileSink(os.path.basename(filename.decode("utf-8", "replace")))
+            self._to_sink = True
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        if self._to_sink:
+            self.sink.feed(chunk)
+            self.pending.append(chunk)
+            return
+        self._field_data += chunk
+        if len(self._field_data) > FORM_FIELD_MAX_SIZE:
+            raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_form", "Form field %s is too long" % self._field_name)
+
+    def on_part_end(self) -> None:
+        if not self._to_sink:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", "replace")
+
+
+async def receive_upload(request: Request, file_field: str = "file") -> Tuple[UploadedFile, Dict[str, str]]:
+    """Stream a multipart/form-data upload of one image and return it with the other form fields."""
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise ApiError(status.HTTP_400_BAD_REQUEST, "invalid_form", "multipart/form-data body is expected")
+    upload = _UploadParser(file_field)
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": upload.on_part_begin,
+        "on_part_data": upload.on_part_data,
+        "on_part_end": upload.on_part_end,
+        "on_header_field": upload.on_header_field,
+        "on_header_value": upload.on_header_value,
+        "on_header_end": upload.on_header_end,
+        "on_headers_finished": upload.on_headers_finished,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if upload.pending:
+                chunks, upload.pending = upload.pending, []
+                await run_in_threadpool(upload.sink.write, chunks)
+        parser.finalize()
+        if upload.sink is None:
+            raise _invalid_file("File is required")
+        return await run_in_threadpool(upload.sink.finish), upload.fields
+    except BaseException:
+        if upload.sink is not None:
+            upload.sink.discard()
+        raise
+
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+# Bytes a segment file grows to before the log moves on to the next one
+WAL_SEGMENT_BYTES = int(os.environ.get("WAL_SEGMENT_BYTES", str(64 << 20)))
+
+SEGMENT_SUFFIX = ".wal"
+# Payload length, CRC-32 of the kind and payload, kind
+_HEADER = struct.Struct("<IIB")
+
+logger = logging.getLogger(__name__)
+
+_sync_file = getattr(os, "fdatasync", os.fsync)
+
+
+def frame(kind: int, payload: bytes) -> bytes:
+    return _HEADER.pack(len(payload), zlib.crc32(payload, kind), kind) + payload
+
+
+def frames(data, start: int = 0) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Records framed in the buffer from the offset on as (offset, kind, payload), up to the end of the buffer or
+    the first record that is cut short or fails its CRC.
+    """
+    offset = start
+    size = len(data)
+    while offset + _HEADER.size <= size:
+        length, crc, kind = _HEADER.unpack_from(data, offset)
+        end = offset + _HEADER.size + length
+        if end > size:
+            return
+        payload = data[offset + _HEADER.size:end]
+        if zlib.crc32(payload, kind) != crc:
+            return
+        yield offset, kind, payload
+        offset = end
+
+
+def sync_directory(directory: str) -> None:
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of framed records in segment files named after the log position they start at, so a
+    position, e.g. where a record is, stays valid for good.
+
+    append() only buffers the record and makes sure a sync is under way; commit() waits until it is on disk.
+    Syncs run one at a time in a thread, each writing and fsyncing everything appended before it started, so
+    the records appended while one runs share the next fsync (group commit) and the event loop never waits for
+    the disk. A record cut short by a crash at the end of the last segment is dropped when the log is opened.
+    Records are read back through read-only memory maps of the segments.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = WAL_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        # End of the records appended and end of the records on disk
+        self.position = 0
+        self.durable = 0
+        self.syncs = 0
+        self._starts: List[int] = []
+        self._maps: List[Optional[mmap.mmap]] = []
+        self._pending: List[Tuple[int, bytearray]] = []
+        self._file = None
+        self._file_start = -1
+        self._syncing: Optional[asyncio.Task] = None
+        self._waiters: List[Tuple[int, asyncio.Future]] = []
+        self._failure: Optional[BaseException] = None
+
+    def _path(self, start: int) -> str:
+        return os.path.join(self.directory, "%016x%s" % (start, SEGMENT_SUFFIX))
+
+    def open(self, boundary: int = 0) -> None:
+        """
+        Find the segments and continue after the last complete record. The records of the last segment are
+        scanned from the boundary on, a log position known to be where a record starts.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._starts = sorted(int(name[:-len(SEGMENT_SUFFIX)], 16) for name in os.listdir(self.directory)
+                              if name.endswith(SEGMENT_SUFFIX))
+        self._maps = [None] * len(self._starts)
+        if self._starts:
+            start = self._starts[-1]
+            path = self._path(start)
+            with open(path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size
+                end = min(max(0, boundary - start), size)
+                if size > end:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        for offset, _, payload in frames(data, end):
+                            end = offset + _HEADER.size + len(payload)
+            if end < size:
+                logger.warning("Dropping %d bytes of an incomplete record at the end of %s", size - end, path)
+                os.truncate(path, end)
+            self.position = self.durable = start + end
+
+    def records(self, start: int = 0) -> Iterator[Tuple[int, int, bytes]]:
+        """Records on disk from the log position on as (position, kind, payload)."""
+        first = max(0, bisect_right(self._starts, start) - 1)
+        for index in range(first, len(self._starts)):
+            segment_start = self._starts[index]
+            end = self._starts[index + 1] if index + 1 < len(self._starts) else self.durable
+            data = self._map(index, end - segment_start)
+            if data is not None:
+                for offset, kind, payload in frames(data, max(0, start - segment_start)):
+                    yield segment_start + offset, kind, payload
+
+    def read(self, position: int) -> Tuple[int, bytes]:
+        """Kind and payload of the record on disk at the log position."""
+        index = bisect_right(self._starts, position) - 1
+        offset = position - self._starts[index]
+        data = self._map(index, offset + _HEADER.size)
+        length, _, kind = _HEADER.unpack_from(data, offset)
+        if offset + _HEADER.size + length > len(data):
+            data = self._map(index, offset + _HEADER.size + length)
+        return kind, data[offset + _HEADER.size:offset + _HEADER.size + length]
+
+    def _map(self, index: int, size: int) -> Optional[mmap.mmap]:
+        """The segment mapped at least up to the size, remapped if it has grown since."""
+        data = self._maps[index]
+        if data is None or len(data) < size:
+            with open(self._path(self._starts[index]), "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                if data is not None:
+                    data.close()
+                data = self._maps[index] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def append(self, kind: int, payload: bytes) -> int:
+        """Buffer a record and return its log position. Call from the event loop."""
+        if self._failure is not None:
+            raise self._failure
+        record = frame(kind, payload)
+        position = self.position
+        if not self._starts or (position > self._starts[-1] and
+                                position - self._starts[-1] + len(record) > self.segment_bytes):
+            self._starts.append(position)
+            self._maps.append(None)
+        if not self._pending or self._pending[-1][0] != self._starts[-1]:
+            self._pending.append((self._starts[-1], bytearray()))
+        self._pending[-1][1].extend(record)
+        self.position += len(record)
+        if self._syncing is None:
+            self._syncing = asyncio.get_running_loop().create_task(self._sync())
+        return position
+
+    async def commit(self) -> None:
+        """Wait until every record appended so far is on disk."""
+        if self._failure is not None:
+            raise self._failure
+        if self.durable >= self.position:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((self.position, future))
+        await future
+
+    async def _sync(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                pending, self._pending = self._pending, []
+                end = self.position
+                await loop.run_in_executor(None, self._write, pending)
+                self.durable = end
+                self.syncs += 1
+                waiters, self._waiters = self._waiters, []
+                for target, future in waiters:
+                    if target > end:
+                        self._waiters.append((target, future))
+                    elif not future.done():
+                        future.set_result(None)
+        except BaseException as error:
+            # Whatever stopped the sync, the records past `durable` may not be on disk: refuse further writes and
+            # fail the commits waiting for them rather than leave them hanging
+            logger.exception("Write-ahead log %s failed, refusing further writes", self.directory)
+            self._failure = error if isinstance(error, Exception) else RuntimeError(
+                "Write-ahead log %s stopped syncing" % self.directory)
+            for _, future in self._waiters:
+                if not future.done():
+                    future.set_exception(self._failure)
+            self._waiters = []
+            if not isinstance(error, Exception):
+                raise
+        finally:
+            self._syncing = None
+
+    def _write(self, pending: List[Tuple[int, bytearray]]) -> None:
+        """Write the chunks of the segments they belong to and fsync. Runs in a thread."""
+        created = False
+        for start, data in pending:
+            if self._file_start != start:
+                if self._file is not None:
+                    self._file.flush()
+                    _sync_file(self._file.fileno())
+                    self._file.close()
+                created = created or not os.path.exists(self._path(start))
+                self._file = open(self._path(start), "ab")
+                self._file_start = start
+            self._file.write(data)
+        self._file.flush()
+        _sync_file(self._file.fileno())
+        if created:
+            sync_directory(self.directory)
+
+    async def close(self) -> None:
+        """Write out what is still buffered and release the files."""
+        while self._syncing is not None:
+            await self._syncing
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_start = -1
+        for data in self._maps:
+            if data is not None:
+                data.close()
+        self._maps = [None] * len(self._starts)
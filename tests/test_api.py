@@ -0,0 +1,502 @@
+import asyncio
+import io
+from uuid import NAMESPACE_OID, UUID, uuid4, uuid5
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import dependencies
+from dependencies import ApiError
+from main import app
+from models import MessageStatusEnum, SystemMessage
+from services import rate_limits, uploads
+from services.acks import AckCoalescer, ack_coalescer
+from services.auth import TokenClaims, token_cache
+from services.blobs import ThumbnailCache, blob_store
+from services.chats import SYSTEM_ACCOUNT_ID, chat_store
+from services.rate_limits import SharedBuckets
+from services.system_messages import SystemMessageQueue, system_message_queue
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # Buckets of this process only, not the segment shared by the workers of the host
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(rate_limits, "shared_buckets", SharedBuckets(None, slots=1024))
+        # Uploads go to a directory of the run, laid out as BlobStore lays out its own
+        attachments = tmp_path_factory.mktemp("attachments")
+        (attachments / "thumbnails").mkdir()
+        patch.setattr(blob_store, "directory", str(attachments))
+        with TestClient(app) as client:
+            yield client
+
+
+def customer():
+    """A bearer token of a new customer and the customer id it stands for."""
+    token = "customer-%s" % uuid4()
+    return token, uuid5(NAMESPACE_OID, token)
+
+
+def auth(token):
+    return {"Authorization": "Bearer %s" % token}
+
+
+def profile(customer_id, **fields):
+    values = dict(customer_id=str(customer_id), username="someone", avatar_url="", display_name="Someone",
+                  status="ONLINE", country=None)
+    values.update(fields)
+    return values
+
+
+def message(text, **fields):
+    values = dict(external_request_id=None, message_id=str(uuid4()), create_time="2024-01-01T00:00:00Z", text=text,
+                  author_id=str(uuid4()), is_mine=True, status="SENT", type="MESSAGE", parameters=None,
+                  update_time=None, offer_hash=None, trade_hash=None, attachments=None, prev_message_id=None)
+    values.update(fields)
+    return values
+
+
+def start(client, token, partner_id, text=None, **partner_fields):
+    return client.post("/api/v3/chats", headers=auth(token),
+                       json={"partner": profile(partner_id, **partner_fields), "context": None,
+                             "message": message(text) if text else None})
+
+
+def test_chats_are_visible_to_their_members_only(client):
+    token, customer_id = customer()
+    partner_token, partner_id = customer()
+    response = start(client, token, partner_id, "hello")
+    assert response.status_code == 201, response.text
+    chat = response.json()
+    assert chat["me"]["customer_id"] == str(customer_id)
+    assert chat["last_message"]["author_id"] == str(customer_id)
+    again = start(client, token, partner_id)
+    assert (again.status_code, again.json()["chat_id"]) == (200, chat["chat_id"])
+    assert client.get("/api/v3/chats/%s" % chat["chat_id"], headers=auth(partner_token)).status_code == 200
+    stranger, _ = customer()
+    response = client.get("/api/v3/chats/%s" % chat["chat_id"], headers=auth(stranger))
+    assert (response.status_code, response.json()["code"]) == (404, "chat_not_found")
+    assert send(client, stranger, chat["chat_id"], "let me in").status_code == 404
+
+
+def test_partner_profile_sent_to_start_chat_is_not_stored(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    response = start(client, token, partner_id, display_name="Support", username="support")
+    assert response.status_code == 201
+    assert response.json()["partner"]["display_name"] != "Support"
+    assert client.get("/api/v3/profile", headers=auth(partner_token)).json()["display_name"] != "Support"
+    other, _ = customer()
+    assert start(client, other, partner_id).json()["partner"]["username"] != "support"
+
+
+def check_creation(client, customer_id, partner_id):
+    return client.post("/api/v3/internal/chats/check-chat-creation",
+                       json={"customer_id": str(customer_id), "partner_id": str(partner_id)}).json()
+
+
+def test_start_chat_follows_the_pair_and_privacy_decisions(client):
+    token, customer_id = customer()
+    partner_token, partner_id = customer()
+    assert check_creation(client, customer_id, partner_id)["result"] == "COULD_START"
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    again = start(client, token, partner_id)
+    assert (again.status_code, again.json()["chat_id"]) == (200, chat_id)
+    assert check_creation(client, partner_id, customer_id) == {"result": "ALREADY_STARTED", "error_code": None,
+                                                               "chat_id": chat_id}
+
+    assert client.post("/api/v3/chats/%s/block" % chat_id, headers=auth(token)).status_code == 200
+    for caller, callee in ((token, partner_id), (partner_token, customer_id)):
+        response = start(client, caller, callee)
+        assert (response.status_code, response.json()["code"]) == (400, "chat_blocked")
+    assert client.post("/api/v3/chats/%s/unblock" % chat_id, headers=auth(token)).status_code == 200
+    assert start(client, partner_token, customer_id).status_code == 200
+
+    shy_token, shy_id = customer()
+    assert client.patch("/api/v3/profile", headers=auth(shy_token),
+                        json={"accept_chat_messages": "NO"}).status_code == 200
+    response = start(client, token, shy_id)
+    assert (response.status_code, response.json()["code"]) == (400, "privacy_settings")
+    client.patch("/api/v3/profile", headers=auth(shy_token), json={"accept_chat_messages": "YES"})
+    assert start(client, token, shy_id).status_code == 201
+
+
+def test_requests_without_a_token_are_rejected(client):
+    assert client.get("/api/v3/chats").status_code == 401
+    assert client.post("/api/v3/chats", json={}).status_code == 401
+
+
+def test_caller_is_taken_from_the_verified_claims(client, monkeypatch):
+    customer_id, (_, partner_id) = uuid4(), customer()
+    token = "opaque-%s" % uuid4()
+    monkeypatch.setattr(token_cache, "verifier", lambda _: TokenClaims(customer_id, ["chats:*"], float("inf")))
+    response = start(client, token, partner_id, "hello")
+    assert response.status_code == 201, response.text
+    chat = response.json()
+    assert chat["me"]["customer_id"] == chat["last_message"]["author_id"] == str(customer_id)
+    response = send(client, token, chat["chat_id"], "again")
+    assert (response.status_code, response.json()["author_id"]) == (201, str(customer_id))
+
+
+def test_chat_with_yourself_could_not_be_started(client):
+    token, customer_id = customer()
+    response = start(client, token, customer_id)
+    assert (response.status_code, response.json()["code"]) == (400, "could_not_start")
+
+
+def send(client, token, chat_id, text, **fields):
+    return client.post("/api/v3/chats/%s/messages" % chat_id, headers=auth(token), json=message(text, **fields))
+
+
+def test_system_messages_land_in_the_system_chat_in_order(client):
+    token, customer_id = customer()
+    notifications = [{"customer_id": str(customer_id), "text": "notification %d" % number,
+                      "parameters": {"type": "trade_started_receiver", "link": "https://example.com/t"}}
+                     for number in range(5)]
+    for start_at in (0, 3):
+        response = client.post("/api/v3/internal/chats/system-messages", json=notifications[start_at:start_at + 3])
+        assert response.status_code == 202
+    client.portal.call(system_message_queue.join)
+    chats = client.get("/api/v3/chats?statuses=SYSTEM", headers=auth(token)).json()["items"]
+    assert len(chats) == 1 and chats[0]["partner"]["customer_id"] == str(SYSTEM_ACCOUNT_ID)
+    history = client.get("/api/v3/chats/%s/messages?limit=10" % chats[0]["chat_id"], headers=auth(token)).json()
+    assert [item["text"] for item in history["items"]] == ["notification %d" % number for number in range(5)]
+    assert {item["type"] for item in history["items"]} == {"SYSTEM"}
+    assert client.get("/api/v3/profile", headers=auth(token)).json()["system_unread_count"] == 5
+
+
+def test_system_account_could_not_be_a_partner(client):
+    token, customer_id = customer()
+    client.post("/api/v3/internal/chats/system-messages", json=[{"customer_id": str(customer_id), "text": "hi",
+                                                                 "parameters": None}])
+    client.portal.call(system_message_queue.join)
+    response = start(client, token, SYSTEM_ACCOUNT_ID)
+    assert (response.status_code, response.json()["code"]) == (400, "could_not_start")
+    assert check_creation(client, customer_id, SYSTEM_ACCOUNT_ID)["result"] == "COULD_NOT_START"
+    assert len(client.get("/api/v3/chats", headers=auth(token)).json()["items"]) == 1
+
+
+def test_system_queue_rejects_what_does_not_fit():
+    async def run():
+        queue = SystemMessageQueue(size=2, workers=1)
+        customer_id = uuid4()
+        with pytest.raises(ApiError) as raised:
+            queue.submit([SystemMessage(customer_id=customer_id, text="m%d" % number, parameters=None)
+                          for number in range(3)])
+        assert (raised.value.status_code, raised.value.code) == (503, "system_queue_full")
+        assert queue.accepted == 0
+        assert queue.submit([SystemMessage(customer_id=customer_id, text="m", parameters=None)]) == 1
+        await queue.close()
+        assert (queue.written, queue.batches) == (1, 1)
+    asyncio.run(run())
+
+
+def test_repeated_send_is_answered_once_and_a_reused_key_is_refused(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    first = send(client, token, chat_id, "pay now", external_request_id="request-1")
+    assert first.status_code == 201
+    retry = send(client, token, chat_id, "pay now", external_request_id="request-1")
+    assert retry.json()["message_id"] == first.json()["message_id"]
+    # A retry after the partner read the message still gets the message as it was sent
+    client.post("/api/v3/chats/%s/messages/read" % chat_id, headers=auth(partner_token),
+                json={"message_ids": [first.json()["message_id"]]})
+    client.portal.call(ack_coalescer.flush)
+    retry = send(client, token, chat_id, "pay now", external_request_id="request-1")
+    assert retry.json() == first.json() and retry.json()["status"] == "SENT"
+    reused = send(client, token, chat_id, "something else", external_request_id="request-1")
+    assert (reused.status_code, reused.json()["code"]) == (409, "idempotency_key_reused")
+    # The key belongs to its author and chat
+    other = send(client, partner_token, chat_id, "pay now", external_request_id="request-1")
+    assert other.status_code == 201 and other.json()["message_id"] != first.json()["message_id"]
+    items = client.get("/api/v3/chats/%s/messages" % chat_id, headers=auth(token)).json()["items"]
+    assert [item["text"] for item in items] == ["pay now", "pay now"]
+
+
+def texts(response):
+    return [item["text"] for item in response.json()["items"]]
+
+
+def test_message_pages_are_walked_by_their_tokens(client):
+    token, customer_id = customer()
+    _, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    for number in range(7):
+        assert send(client, token, chat_id, "m%d" % number).status_code == 201
+    path = "/api/v3/chats/%s/messages" % chat_id
+    pages = [client.get(path, headers=auth(token), params={"limit": 3})]
+    while pages[-1].json()["next_page_token"]:
+        pages.append(client.get(path, headers=auth(token),
+                                params={"limit": 3, "page_token": pages[-1].json()["next_page_token"]}))
+    assert [texts(page) for page in pages] == [["m0", "m1", "m2"], ["m3", "m4", "m5"], ["m6"]]
+    assert {item["author_id"] for item in pages[0].json()["items"]} == {str(customer_id)}
+    assert pages[0].json()["prev_page_token"] is None
+    back = client.get(path, headers=auth(token), params={"limit": 3, "page_token": pages[2].json()["prev_page_token"]})
+    assert texts(back) == ["m3", "m4", "m5"]
+    newest = client.get(path, headers=auth(token), params={"limit": 2, "order_by": "create_time desc"})
+    assert texts(newest) == ["m6", "m5"]
+    older = client.get(path, headers=auth(token), params={"limit": 2, "order_by": "create_time desc",
+                                                           "page_token": newest.json()["next_page_token"]})
+    assert texts(older) == ["m4", "m3"]
+    forged = client.get(path, headers=auth(token), params={"page_token": "not-a-token"})
+    assert forged.status_code == 400
+    # A token only resumes the listing it was issued for: same chat, filter and order
+    other_chat_id = start(client, token, customer()[1]).json()["chat_id"]
+    descending_token = newest.json()["next_page_token"]
+    for other_path, params in ((path, {"page_token": descending_token}),
+                               (path, {"page_token": descending_token, "order_by": "create_time desc", "q": "m"}),
+                               ("/api/v3/chats/%s/messages" % other_chat_id,
+                                {"page_token": descending_token, "order_by": "create_time desc"})):
+        response = client.get(other_path, headers=auth(token), params=params)
+        assert (response.status_code, response.json()["code"]) == (400, "invalid_page_token")
+
+
+def presence(client, token, customer_id):
+    response = client.post("/api/v3/chats/check-responders", headers=auth(token),
+                           json={"customer_ids": [str(customer_id)]})
+    return response.json()["items"][0]["status"]
+
+
+def test_inbox_delivers_messages_of_the_chats_of_the_subscriber(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    channel = client.post("/api/v3/profile/request-token", headers=auth(partner_token)).json()
+    refused = client.get("/api/v3/inbox/events", params={"channel": channel["inbox_channel"], "token": "1.forged"})
+    assert (refused.status_code, refused.json()["code"]) == (403, "invalid_channel_token")
+    with client.websocket_connect("/api/v3/inbox/ws?channel=%s&token=%s" % (channel["inbox_channel"],
+                                                                            channel["token"])) as websocket:
+        assert presence(client, token, partner_id) == "ONLINE"
+        sent = send(client, token, chat_id, "are you there?").json()
+        events = []
+        while not any(event["type"] == "message" and event["data"]["message_id"] == sent["message_id"]
+                      for event in events):
+            events += websocket.receive_json()
+    assert [(event["chat_id"], event["data"]["is_mine"]) for event in events if event["type"] == "message"] == [
+        (chat_id, False)]
+    assert presence(client, token, partner_id) == "OFFLINE"
+
+
+def counters(client, token):
+    profile = client.get("/api/v3/profile", headers=auth(token)).json()
+    return profile["chats_unread_count"], profile["system_unread_count"]
+
+
+def test_unread_counters_follow_messages_and_reads(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    first = start(client, token, partner_id, "one").json()["chat_id"]
+    send(client, token, first, "two")
+    other_token, _ = customer()
+    second = start(client, other_token, partner_id, "three").json()["chat_id"]
+    assert counters(client, partner_token) == (3, 0)
+    assert counters(client, token) == (0, 0)
+    client.post("/api/v3/chats/%s/messages/read-all" % first, headers=auth(partner_token))
+    assert counters(client, partner_token) == (1, 0)
+    send(client, other_token, second, "four")
+    assert counters(client, partner_token) == (2, 0)
+    response = client.post("/api/v3/profile/read-all-messages", headers=auth(partner_token), json={"status": "ACTIVE"})
+    assert (response.json()["chats_unread_count"], counters(client, partner_token)) == (0, (0, 0))
+    contexts = [client.get("/api/v3/chats/%s" % chat_id, headers=auth(partner_token)).json()["context"]
+                for chat_id in (first, second)]
+    assert [context["unread_count"] for context in contexts] == [0, 0]
+
+
+def test_acknowledgements_are_merged_into_one_context_write(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    chat_id = start(client, token, partner_id, "one").json()["chat_id"]
+    ids = [send(client, token, chat_id, text).json()["message_id"] for text in ("two", "three", "four")]
+    coalescer = AckCoalescer(flush_interval=3600)
+
+    async def acknowledge():
+        record = chat_store.get(UUID(chat_id))
+        views = []
+        for message_id in ids[:2]:
+            acknowledged = [record.messages.get(UUID(message_id))]
+            views += coalescer.acknowledge(record, partner_id, acknowledged, MessageStatusEnum.READ)
+        return views
+    views = client.portal.call(acknowledge)
+    assert [view.status for view in views] == [MessageStatusEnum.READ] * 2
+    context = client.get("/api/v3/chats/%s" % chat_id, headers=auth(partner_token)).json()["context"]
+    assert context["unread_count"] == 4
+    client.portal.call(coalescer.flush)
+    assert coalescer.context_writes == 1 and coalescer.acknowledged == 2
+    context = client.get("/api/v3/chats/%s" % chat_id, headers=auth(partner_token)).json()["context"]
+    assert (context["read_message_id"], context["unread_count"]) == (ids[1], 1)
+    items = client.get("/api/v3/chats/%s/messages" % chat_id, headers=auth(token)).json()["items"]
+    # The acknowledged messages change status, the context moves its read pointer past the ones before them
+    assert [item["status"] for item in items] == ["SENT", "READ", "READ", "SENT"]
+
+
+def test_an_acknowledgement_failing_to_apply_does_not_lose_the_others(client, monkeypatch):
+    token, _ = customer()
+    _, partner_id = customer()
+    chats = [start(client, token, partner_id, "one").json()["chat_id"],
+             start(client, customer()[0], partner_id, "two").json()["chat_id"]]
+    failing = chats[0]
+    acknowledge = chat_store.acknowledge
+
+    def fail_for_the_first_chat(record, *args):
+        if str(record.chat_id) == failing:
+            raise RuntimeError("broken chat")
+        return acknowledge(record, *args)
+    monkeypatch.setattr(chat_store, "acknowledge", fail_for_the_first_chat)
+    coalescer = AckCoalescer(flush_interval=3600)
+
+    async def acknowledge_both():
+        for chat_id in chats:
+            record = chat_store.get(UUID(chat_id))
+            coalescer.acknowledge(record, partner_id, [record.last_message], MessageStatusEnum.READ)
+        await coalescer.flush()
+    client.portal.call(acknowledge_both)
+    assert (coalescer.failed, coalescer.context_writes) == (1, 1)
+
+
+def test_acknowledgement_routes_answer_with_the_acknowledged_messages(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    chat_id = start(client, token, partner_id, "one").json()["chat_id"]
+    message_id = send(client, token, chat_id, "two").json()["message_id"]
+    response = client.post("/api/v3/chats/%s/messages/delivered" % chat_id, headers=auth(partner_token),
+                           json={"message_ids": [message_id]})
+    assert [item["status"] for item in response.json()["items"]] == ["DELIVERED"]
+    response = client.post("/api/v3/chats/%s/messages/read" % chat_id, headers=auth(partner_token),
+                           json={"message_ids": [str(uuid4())]})
+    assert response.status_code == 404
+    client.portal.call(ack_coalescer.flush)
+    context = client.get("/api/v3/chats/%s" % chat_id, headers=auth(partner_token)).json()["context"]
+    assert context["delivered_message_id"] == message_id
+
+
+def png(color):
+    data = io.BytesIO()
+    Image.new("RGB", (400, 300), color).save(data, "PNG")
+    return data.getvalue()
+
+
+def upload(client, token, path, content, filename="picture.png"):
+    return client.post(path, headers=auth(token), files={"file": (filename, content, "image/png")})
+
+
+def test_identical_uploads_are_stored_once(client):
+    token, _ = customer()
+    _, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    content = png((10, 20, 30))
+    before = blob_store.metrics()
+    first = upload(client, token, "/api/v3/chats/%s/messages/upload-file" % chat_id, content)
+    second = upload(client, token, "/api/v3/chats/%s/messages/upload-file" % chat_id, content, "copy.png")
+    assert first.status_code == second.status_code == 201
+    first, second = first.json()["attachments"][0], second.json()["attachments"][0]
+    assert first["uri"] == second["uri"] and second["filename"] == "copy.png"
+    after = blob_store.metrics()
+    assert (after.uploads - before.uploads, after.deduplicated_uploads - before.deduplicated_uploads) == (2, 1)
+    assert client.get(first["uri"]).content == content
+    thumbnail = client.get(first["thumbnail_uri"])
+    assert thumbnail.status_code == 200 and Image.open(io.BytesIO(thumbnail.content)).size[0] < 400
+
+
+def test_closing_the_thumbnail_cache_stops_its_processes(tmp_path):
+    path = tmp_path / "picture.png"
+    path.write_bytes(png((1, 2, 3)))
+    cache = ThumbnailCache()
+
+    async def render_and_close():
+        await cache.render(str(path), ".png")
+        processes = list(cache._pool._processes.values())
+        await cache.close()
+        return processes
+
+    processes = asyncio.run(render_and_close())
+    assert processes and not any(process.is_alive() for process in processes)
+
+
+def test_upload_to_a_message_of_someone_else_stores_nothing(client):
+    token, _ = customer()
+    partner_token, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    theirs = send(client, partner_token, chat_id, "theirs").json()["message_id"]
+    before = blob_store.metrics().uploads
+    for message_id in (theirs, uuid4()):
+        response = upload(client, token, "/api/v3/chats/%s/messages/%s/upload-file" % (chat_id, message_id),
+                          png((1, 2, 3)))
+        assert response.status_code == 404
+    assert blob_store.metrics().uploads == before
+    mine = send(client, token, chat_id, "mine").json()["message_id"]
+    response = upload(client, token, "/api/v3/chats/%s/messages/%s/upload-file" % (chat_id, mine), png((1, 2, 3)))
+    assert response.status_code == 200 and response.json()["attachments"][0]["filename"] == "picture.png"
+
+
+def test_uploads_stream_to_the_spool_and_leave_nothing_behind(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(uploads, "UPLOAD_SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(uploads, "UPLOAD_MAX_SIZE", 64 * 1024)
+    token, _ = customer()
+    _, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    path = "/api/v3/chats/%s/messages/upload-file" % chat_id
+    refused = [upload(client, token, path, b"GIF89a not an image we take"),
+               upload(client, token, path, b"\x89PNG\r\n\x1a\n" + bytes(128 * 1024))]
+    assert [(response.status_code, response.json()["code"]) for response in refused] == [(400, "invalid_file")] * 2
+    response = client.post(path, headers=auth(token), data={"external_request_id": "upload-1"},
+                           files={"file": ("../../etc/picture.png", png((5, 5, 5)), "image/png")})
+    assert response.status_code == 201
+    assert response.json()["external_request_id"] == "upload-1"
+    assert response.json()["attachments"][0]["filename"] == "picture.png"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_responders_are_checked_in_the_order_asked(client):
+    token, _ = customer()
+    _, partner_id = customer()
+    _, stranger_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    path = "/api/v3/chats/check-responders"
+    response = client.post(path, headers=auth(token), json={
+        "customer_ids": [str(stranger_id), str(partner_id), str(stranger_id)], "return_chat_id": True})
+    assert response.status_code == 200
+    assert [(item["customer_id"], item["status"], item["chat_id"]) for item in response.json()["items"]] == [
+        (str(stranger_id), "OFFLINE", None), (str(partner_id), "OFFLINE", chat_id)]
+    refused = [client.post(path, headers=auth(token), json={"customer_ids": ids})
+               for ids in (["not-a-uuid"], [str(uuid4()) for _ in range(1001)])]
+    assert [response.json()["code"] for response in refused] == ["invalid_customer_id", "too_many_customers"]
+
+
+def test_chats_are_listed_by_their_last_activity(client):
+    token, _ = customer()
+    chat_ids = [start(client, token, customer()[1]).json()["chat_id"] for _ in range(3)]
+    assert send(client, token, chat_ids[0], "back on top").status_code == 201
+    path = "/api/v3/chats"
+    first = client.get(path, headers=auth(token), params={"limit": 2})
+    assert [chat["chat_id"] for chat in first.json()["items"]] == [chat_ids[0], chat_ids[2]]
+    rest = client.get(path, headers=auth(token), params={"limit": 2, "page_token": first.json()["next_page_token"]})
+    assert [chat["chat_id"] for chat in rest.json()["items"]] == [chat_ids[1]]
+    assert rest.json()["next_page_token"] is None
+    assert client.post("/api/v3/chats/%s/block" % chat_ids[1], headers=auth(token)).status_code == 200
+    blocked = client.get(path, headers=auth(token), params={"statuses": "BLOCKED"})
+    assert [chat["chat_id"] for chat in blocked.json()["items"]] == [chat_ids[1]]
+
+
+def test_messages_are_searched_by_their_text(client):
+    token, _ = customer()
+    _, partner_id = customer()
+    chat_id = start(client, token, partner_id).json()["chat_id"]
+    for text in ("Payment sent", "waiting", "PAYMENT received, thanks", "ok"):
+        assert send(client, token, chat_id, text).status_code == 201
+    path = "/api/v3/chats/%s/messages" % chat_id
+    found = client.get(path, headers=auth(token), params={"q": "payment"})
+    assert texts(found) == ["Payment sent", "PAYMENT received, thanks"]
+    assert texts(client.get(path, headers=auth(token), params={"q": "refund"})) == []
+
+
+def test_fast_responses_match_the_validated_ones(client, monkeypatch):
+    token, _ = customer()
+    _, partner_id = customer()
+    chat_id = start(client, token, partner_id, "hello").json()["chat_id"]
+    assert send(client, token, chat_id, "second").status_code == 201
+    paths = ["/api/v3/chats", "/api/v3/chats/%s" % chat_id, "/api/v3/chats/%s/messages" % chat_id]
+    fast = [client.get(path, headers=auth(token)).json() for path in paths]
+    monkeypatch.setattr(dependencies, "FAST_RESPONSES", False)
+    assert [client.get(path, headers=auth(token)).json() for path in paths] == fast
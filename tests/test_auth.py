@@ -0,0 +1,111 @@
+import importlib
+import os
+from uuid import uuid4
+
+import pytest
+
+from dependencies import ApiError
+from services import auth
+from services.auth import InvalidToken, TokenCache, TokenClaims, unverified_claims, verified_customer
+
+ROUTERS = sorted(name[:-3] for name in os.listdir(os.path.join(os.path.dirname(os.path.dirname(__file__)), "routers"))
+                 if name.endswith(".py") and name != "__init__.py")
+
+
+class Verifier:
+    """Tokens "<customer>:<scope>,<scope>"; counts the verifications."""
+
+    def __init__(self, expire_time=float("inf")):
+        self.calls = 0
+        self.expire_time = expire_time
+        self.customers = {}
+
+    def __call__(self, token):
+        self.calls += 1
+        if ":" not in token:
+            raise InvalidToken(token)
+        name, _, scopes = token.partition(":")
+        customer_id = self.customers.setdefault(name, uuid4())
+        return TokenClaims(customer_id, scopes.split(","), self.expire_time)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(auth, "time", lambda: now[0])
+    return now
+
+
+def test_verified_claims_are_cached_by_token_hash(clock):
+    verifier = Verifier()
+    cache = TokenCache(verifier, ttl=60)
+    claims = cache.authorize("alice:chats:read", ["chats:read"])
+    assert cache.authorize("alice:chats:read", ["chats:read"]) is claims
+    assert (verifier.calls, cache.hits, cache.misses) == (1, 1, 1)
+    assert all(isinstance(key, bytes) and len(key) == 32 for key in cache._claims)
+
+
+def test_claims_are_verified_again_after_the_ttl_or_the_token_expiry(clock):
+    verifier = Verifier(expire_time=1030.0)
+    cache = TokenCache(verifier, ttl=60)
+    cache.claims("alice:chats:read")
+    clock[0] = 1029.0
+    cache.claims("alice:chats:read")
+    assert verifier.calls == 1
+    clock[0] = 1030.0
+    with pytest.raises(ApiError) as raised:
+        cache.claims("alice:chats:read")
+    assert (raised.value.status_code, raised.value.code) == (401, "invalid_token")
+
+    verifier.expire_time = float("inf")
+    cache.claims("bob:chats:read")
+    clock[0] += 61
+    cache.claims("bob:chats:read")
+    assert verifier.calls == 4
+
+
+def test_invalid_token_is_rejected_and_not_cached(clock):
+    verifier = Verifier()
+    cache = TokenCache(verifier)
+    for _ in range(2):
+        with pytest.raises(ApiError) as raised:
+            cache.claims("forged")
+        assert raised.value.status_code == 401
+    assert verifier.calls == 2 and not cache._claims
+
+
+def test_scopes_are_checked_with_family_wildcards(clock):
+    cache = TokenCache(Verifier())
+    cache.authorize("alice:chats:*", ["chats:read", "chats:write"])
+    with pytest.raises(ApiError) as raised:
+        cache.authorize("alice:chats:*", ["chats:read", "profile:write"])
+    assert (raised.value.status_code, raised.value.code) == (403, "insufficient_scope")
+    assert "profile:write" in raised.value.message
+
+
+def test_least_recently_used_tokens_are_evicted(clock):
+    verifier = Verifier()
+    cache = TokenCache(verifier, max_tokens=2)
+    cache.claims("a:s")
+    cache.claims("b:s")
+    cache.claims("a:s")
+    cache.claims("c:s")
+    assert verifier.calls == 3
+    cache.claims("a:s")
+    assert verifier.calls == 3
+    cache.claims("b:s")
+    assert verifier.calls == 4
+
+
+def verified_scopes(dependant):
+    for dependency in dependant.dependencies:
+        if dependency.call is verified_customer:
+            yield from dependency.security_scopes
+        yield from verified_scopes(dependency)
+
+
+@pytest.mark.parametrize("name", ROUTERS)
+def test_every_scope_a_route_checks_is_granted_to_current_tokens(name):
+    claims = unverified_claims("customer")
+    for route in importlib.import_module("routers.%s" % name).router.routes:
+        assert [scope for scope in verified_scopes(route.dependant) if not claims.grants(scope)] == [], route.path
@@ -0,0 +1,125 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the app on the chat log directory in a process of its own, since the chats live in module-level stores,
+# makes the changes of the phase and prints what every customer sees
+PHASE = textwrap.dedent('''
+    import json, os, sys
+    from uuid import NAMESPACE_OID, uuid4, uuid5
+    from fastapi.testclient import TestClient
+    from main import app
+    from services.acks import ack_coalescer
+    from services.chat_log import chat_log
+    from services.system_messages import system_message_queue
+
+    CUSTOMERS = ("alice", "bob", "carol")
+
+    def headers(name):
+        return {"Authorization": "Bearer %s" % name}
+
+    def message(text):
+        return {"external_request_id": None, "message_id": str(uuid4()), "create_time": "2024-01-01T00:00:00Z",
+                "text": text, "author_id": str(uuid4()), "is_mine": True, "status": "SENT", "type": "MESSAGE",
+                "parameters": None, "update_time": None, "offer_hash": None, "trade_hash": None,
+                "attachments": None, "prev_message_id": None}
+
+    def start(client, name, partner, text):
+        profile = {"customer_id": str(uuid5(NAMESPACE_OID, partner)), "username": partner, "avatar_url": "",
+                   "display_name": partner, "status": "ONLINE", "country": None}
+        response = client.post("/api/v3/chats", headers=headers(name),
+                               json={"partner": profile, "context": None, "message": message(text)})
+        assert response.status_code == 201, response.text
+        return response.json()["chat_id"]
+
+    def send(client, name, chat_id, text):
+        response = client.post("/api/v3/chats/%s/messages" % chat_id, headers=headers(name), json=message(text))
+        assert response.status_code == 201, response.text
+
+    def state(client):
+        seen = {}
+        for name in CUSTOMERS:
+            for chat in client.get("/api/v3/chats?limit=100", headers=headers(name)).json()["items"]:
+                path = "/api/v3/chats/%s" % chat["chat_id"]
+                seen["%s %s" % (name, chat["chat_id"])] = [
+                    chat, client.get(path, headers=headers(name)).json(),
+                    client.get(path + "/messages?limit=100", headers=headers(name)).json()]
+        return seen
+
+    phase = sys.argv[1]
+    client = TestClient(app)
+    client.__enter__()
+    if phase == "write":
+        first = start(client, "alice", "bob", "hello")
+        for number in range(30):
+            send(client, ("alice", "bob")[number % 2], first, "message %d" % number)
+        client.portal.call(chat_log.snapshot)
+        second = start(client, "carol", "alice", "hi")
+        for number in range(5):
+            send(client, "carol", second, "after the snapshot %d" % number)
+        assert client.post("/api/v3/chats/%s/messages/read-all" % first, headers=headers("bob")).status_code == 200
+        assert client.post("/api/v3/chats/%s/block" % second, headers=headers("alice")).status_code == 200
+    elif phase == "background":
+        chat_id = start(client, "alice", "bob", "hello")
+        path = "/api/v3/chats/%s/messages" % chat_id
+        message_id = client.get(path, headers=headers("bob")).json()["items"][0]["message_id"]
+        read = client.post(path + "/read", headers=headers("bob"), json={"message_ids": [message_id]})
+        assert read.status_code == 200
+        notification = {"customer_id": str(uuid5(NAMESPACE_OID, "bob")), "text": "trade paid", "parameters": None}
+        assert client.post("/api/v3/internal/chats/system-messages", json=[notification]).status_code == 202
+        # Once flushed and joined, what the requests answered before it was applied is in the log
+        client.portal.call(system_message_queue.join)
+        client.portal.call(ack_coalescer.flush)
+        print("{}")
+        sys.stdout.flush()
+        os._exit(0)
+    print(json.dumps(state(client)))
+    if phase == "write" and os.environ.get("CRASH"):
+        sys.stdout.flush()
+        os._exit(0)
+    client.__exit__(None, None, None)
+''')
+
+
+def run_phase(directory, phase, **environment):
+    result = subprocess.run([sys.executable, "-c", PHASE, phase], cwd=ROOT, capture_output=True, text=True,
+                            env=dict(os.environ, CHAT_LOG_DIR=directory, RATE_LIMITS="", **environment))
+    assert result.returncode == 0, result.stderr[-3000:]
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def segment(directory):
+    wal = os.path.join(directory, "wal")
+    return os.path.join(wal, sorted(os.listdir(wal))[-1])
+
+
+@pytest.mark.parametrize("crash", [False, True])
+def test_snapshot_and_log_replay_restore_every_chat(tmp_path, crash):
+    directory = str(tmp_path)
+    written = run_phase(directory, "write", CRASH="1" if crash else "")
+    assert len(written) == 4
+    assert [name for name in os.listdir(directory) if name.endswith(".snapshot")]
+    if crash:
+        with open(segment(directory), "ab") as file:
+            file.write(b"\x40\x00\x00\x00torn")
+    assert run_phase(directory, "read") == written
+    # Restoring changes nothing, so the next restart sees the same
+    assert run_phase(directory, "read") == written
+
+
+def test_work_done_after_answering_is_in_the_log(tmp_path):
+    directory = str(tmp_path)
+    run_phase(directory, "background")
+    seen = {key.split()[0] + " " + chat["context"]["status"]: (chat, history)
+            for key, (chat, _, history) in run_phase(directory, "read").items()}
+    assert sorted(seen) == ["alice ACTIVE", "bob ACTIVE", "bob SYSTEM"]
+    assert [item["text"] for item in seen["bob SYSTEM"][1]["items"]] == ["trade paid"]
+    [message] = seen["alice ACTIVE"][1]["items"]
+    assert message["status"] == "READ"
+    assert seen["bob ACTIVE"][0]["context"]["read_message_id"] == message["message_id"]
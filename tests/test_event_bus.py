@@ -0,0 +1,190 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from models import CustomerStatusEnum
+from services import presence
+from services import event_bus as event_bus_module
+from services.event_bus import Broker, BrokerEventBus, EventBus, InProcessBroker, UnixSocketEventBus, event_bus
+from services.inbox import InboxHub, inbox_channel
+
+
+def drain(subscription):
+    events = []
+    while not subscription.queue.empty():
+        events.append(subscription.queue.get_nowait())
+    return events
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0.01)
+
+
+def test_event_bus_setting(tmp_path):
+    assert type(event_bus("local")) is EventBus
+    assert isinstance(event_bus("unix:%s" % tmp_path), UnixSocketEventBus)
+    bus = event_bus("broker:services.event_bus:InProcessBroker")
+    assert isinstance(bus, BrokerEventBus) and isinstance(bus.broker, InProcessBroker)
+    with pytest.raises(ValueError):
+        event_bus("broker:services.event_bus:EventBus")
+    with pytest.raises(ValueError):
+        event_bus("redis://localhost")
+
+
+def test_a_broker_implements_all_of_publish_and_subscribe():
+    class PublishOnly(Broker):
+        def publish(self, topic, payload):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnly()
+
+
+def test_broker_bus_delivers_only_where_there_are_subscribers():
+    async def run():
+        broker = InProcessBroker()
+        first, second = InboxHub(BrokerEventBus(broker)), InboxHub(BrokerEventBus(broker))
+        local = first.subscribe("inbox.a")
+        first.publish("inbox.a", "unheard elsewhere")
+        assert broker.published == 2
+        remote = second.subscribe("inbox.a")
+        assert first.listening("inbox.a") and first.channels() == ["inbox.a"]
+        for number in range(5):
+            first.publish("inbox.a", "event %d" % number)
+        assert drain(remote) == ["event %d" % number for number in range(5)]
+        assert drain(local) == ["unheard elsewhere"] + ["event %d" % number for number in range(5)]
+        second.unsubscribe(remote)
+        assert not first.bus.listening("inbox.a")
+        published = broker.published
+        first.publish("inbox.a", "local only")
+        assert broker.published == published
+    asyncio.run(run())
+
+
+def test_late_process_learns_the_channels_of_the_others():
+    async def run():
+        broker = InProcessBroker()
+        first = InboxHub(BrokerEventBus(broker))
+        first.subscribe("inbox.a")
+        second = InboxHub(BrokerEventBus(broker))
+        assert second.listening("inbox.a")
+    asyncio.run(run())
+
+
+def test_listening_changed_on_first_and_last_remote_listener():
+    async def run():
+        broker = InProcessBroker()
+        first, second, third = (InboxHub(BrokerEventBus(broker)) for _ in range(3))
+        changes = []
+        first.bus.listening_changed.append(changes.append)
+        first.channels()
+        one = second.subscribe("inbox.a")
+        two = third.subscribe("inbox.a")
+        assert changes == ["inbox.a"]
+        second.unsubscribe(one)
+        assert changes == ["inbox.a"]
+        third.unsubscribe(two)
+        assert changes == ["inbox.a", "inbox.a"]
+    asyncio.run(run())
+
+
+def test_unix_socket_bus_between_two_workers(tmp_path):
+    async def run():
+        buses = [UnixSocketEventBus(str(tmp_path)) for _ in range(2)]
+        # Both live in this process, which names the sockets after its pid
+        buses[0].name, buses[1].name = "1.sock", "2.sock"
+        first, second = InboxHub(buses[0]), InboxHub(buses[1])
+        first.channels()
+        subscription = second.subscribe("inbox.a")
+        await settle()
+        assert first.listening("inbox.a")
+        for number in range(100):
+            first.publish("inbox.a", "event %d" % number)
+        await settle()
+        assert drain(subscription) == ["event %d" % number for number in range(100)]
+
+        buses[1].close()
+        first.publish("inbox.a", "to nobody")
+        await settle()
+        assert not first.listening("inbox.a")
+        buses[0].close()
+    asyncio.run(run())
+
+
+def test_datagrams_are_sized_in_encoded_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_bus_module, "EVENT_BUS_DATAGRAM", 1_000)
+    bus = UnixSocketEventBus(str(tmp_path))
+    frames = ["E\u00e9" * 100 for _ in range(10)]
+    datagrams = bus._datagrams(frames)
+    assert all(len(datagram) <= 1_000 for datagram in datagrams)
+    assert b"\n".join(datagram.partition(b"\n")[2] for datagram in datagrams).decode() == "\n".join(frames)
+
+
+def test_a_dropped_datagram_is_followed_by_a_resync(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_bus_module, "EVENT_BUS_RETRY", 0.01)
+
+    async def run():
+        buses = [UnixSocketEventBus(str(tmp_path)) for _ in range(2)]
+        buses[0].name, buses[1].name = "1.sock", "2.sock"
+        first, second = InboxHub(buses[0]), InboxHub(buses[1])
+        first.channels()
+        subscription = second.subscribe("inbox.a")
+        await settle()
+        first.publish("inbox.a", "delivered")
+        await settle()
+        assert drain(subscription) == ["delivered"]
+
+        peer = buses[0]._peers["2.sock"]
+        working = peer.socket
+
+        class Failing:
+            def send(self, datagram):
+                peer.socket = working
+                raise OSError("No buffer space available")
+
+        peer.socket = Failing()
+        first.publish("inbox.a", "dropped")
+        await settle()
+        assert second.shed_count == 1 and drain(subscription) == [None]
+        assert not first.listening("inbox.a")
+        subscription = second.subscribe("inbox.a")
+        await settle()
+        first.publish("inbox.a", "after the resync")
+        await settle()
+        assert drain(subscription) == ["after the resync"]
+        buses[0].close()
+        buses[1].close()
+    asyncio.run(run())
+
+
+def test_shed_when_events_of_another_worker_were_lost():
+    async def run():
+        broker = InProcessBroker()
+        first, second = InboxHub(BrokerEventBus(broker)), InboxHub(BrokerEventBus(broker))
+        first.channels()
+        subscription = second.subscribe("inbox.a")
+        first.bus._announce("L")
+        assert subscription.shed and second.shed_count == 1
+        assert drain(subscription) == [None]
+    asyncio.run(run())
+
+
+def test_presence_counts_connections_to_other_workers(monkeypatch):
+    async def run():
+        broker = InProcessBroker()
+        hub, other = InboxHub(BrokerEventBus(broker)), InboxHub(BrokerEventBus(broker))
+        index = presence.PresenceIndex(ttl=60)
+        monkeypatch.setattr(presence, "inbox_hub", hub)
+        hub.bus.listening_changed.append(lambda channel: index.invalidate(presence.customer_of_channel(channel)))
+        customer_id = uuid4()
+        assert index.resolve([customer_id])[0].status == CustomerStatusEnum.OFFLINE
+        subscription = other.subscribe(inbox_channel(customer_id))
+        assert index.resolve([customer_id])[0].status == CustomerStatusEnum.ONLINE
+        assert index.is_online(customer_id)
+        other.unsubscribe(subscription)
+        assert index.resolve([customer_id])[0].status == CustomerStatusEnum.OFFLINE
+        index.connected(customer_id)
+        assert index.resolve([customer_id, customer_id])[0].status == CustomerStatusEnum.ONLINE
+    asyncio.run(run())
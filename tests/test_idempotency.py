@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from pydantic import BaseModel
+
+from dependencies import ApiError
+from models import MessageStatusEnum
+from services import idempotency
+from services.idempotency import IdempotencyStore, request_fingerprint
+
+TEXT = request_fingerprint("hello", None, None)
+
+
+class Sent(BaseModel):
+    status: MessageStatusEnum
+
+
+def handler(calls, response="created"):
+    async def handle():
+        calls.append(response)
+        return response
+    return handle
+
+
+def run(store, request_id, handle, fingerprint=TEXT, author="alice", route="send_message", target="chat"):
+    return asyncio.run(store.run(author, route, target, request_id, fingerprint, handle))
+
+
+def test_repeated_request_gets_the_stored_response():
+    store, calls = IdempotencyStore(), []
+    assert run(store, "r1", handler(calls, "first")) == "first"
+    assert run(store, "r1", handler(calls, "second")) == "first"
+    assert calls == ["first"] and store.replayed == 1
+
+
+def test_requests_without_a_key_always_run():
+    store, calls = IdempotencyStore(), []
+    run(store, None, handler(calls))
+    run(store, "", handler(calls))
+    assert len(calls) == 2
+
+
+def test_reused_key_with_another_request_is_rejected():
+    store, calls = IdempotencyStore(), []
+    run(store, "r1", handler(calls))
+    with pytest.raises(ApiError) as raised:
+        run(store, "r1", handler(calls), fingerprint=request_fingerprint("something else", None, None))
+    assert (raised.value.status_code, raised.value.code) == (409, "idempotency_key_reused")
+    assert calls == ["created"]
+
+
+@pytest.mark.parametrize("scope", [{"author": "bob"}, {"route": "upload_file"}, {"target": "other chat"}])
+def test_keys_are_scoped_to_author_route_and_target(scope):
+    store, calls = IdempotencyStore(), []
+    run(store, "r1", handler(calls, "first"))
+    assert run(store, "r1", handler(calls, "second"), **scope) == "second"
+
+
+def test_duplicate_in_flight_waits_for_the_first():
+    async def scenario():
+        store = IdempotencyStore()
+        release = asyncio.Event()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await release.wait()
+            return "done"
+        first = asyncio.ensure_future(store.run("alice", "send_message", "chat", "r1", TEXT, slow))
+        second = asyncio.ensure_future(store.run("alice", "send_message", "chat", "r1", TEXT, slow))
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(first, second) == ["done", "done"]
+        assert calls == [1] and store.coalesced == 1
+    asyncio.run(scenario())
+
+
+def test_cancelling_the_first_caller_leaves_the_duplicate_waiting():
+    async def scenario():
+        store = IdempotencyStore()
+        release = asyncio.Event()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await release.wait()
+            return "done"
+        first = asyncio.ensure_future(store.run("alice", "send_message", "chat", "r1", TEXT, slow))
+        second = asyncio.ensure_future(store.run("alice", "send_message", "chat", "r1", TEXT, slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == "done"
+        assert first.cancelled() and calls == [1]
+        assert await store.run("alice", "send_message", "chat", "r1", TEXT, slow) == "done"
+    asyncio.run(scenario())
+
+
+def test_replayed_response_is_the_one_answered():
+    store = IdempotencyStore()
+    response = Sent(status=MessageStatusEnum.SENT)
+
+    async def handle():
+        return response
+    run(store, "r1", handle)
+    # The handler's object changes later, as the last message of a chat does when it is read
+    response.status = MessageStatusEnum.READ
+    assert run(store, "r1", handle).status == MessageStatusEnum.SENT
+
+
+def test_failed_request_is_not_stored():
+    store, calls = IdempotencyStore(), []
+
+    async def fail():
+        calls.append("failed")
+        raise ApiError(400, "bad", "Bad request")
+    with pytest.raises(ApiError):
+        run(store, "r1", fail)
+    assert run(store, "r1", handler(calls)) == "created"
+    assert calls == ["failed", "created"]
+
+
+def test_responses_expire_after_the_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(idempotency, "monotonic", lambda: clock[0])
+    store, calls = IdempotencyStore(ttl=60), []
+    run(store, "r1", handler(calls, "first"))
+    clock[0] += 59
+    assert run(store, "r1", handler(calls, "second")) == "first"
+    clock[0] += 2
+    assert run(store, "r1", handler(calls, "third")) == "third"
+    # Expired entries are dropped as new ones are stored
+    run(store, "r2", handler(calls))
+    clock[0] += 61
+    run(store, "r3", handler(calls))
+    assert list(key[3] for key in store._responses) == ["r3"]
+
+
+def test_oldest_responses_are_evicted_past_the_limit():
+    store, calls = IdempotencyStore(max_keys=3), []
+    for number in range(5):
+        run(store, "r%d" % number, handler(calls, "response %d" % number))
+    assert len(store._responses) == 3
+    assert run(store, "r4", handler(calls, "again")) == "response 4"
+    assert run(store, "r0", handler(calls, "again")) == "again"
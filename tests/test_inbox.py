@@ -0,0 +1,93 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from services import inbox
+from services.inbox import ChannelTokens, InboxHub, encode_batch, inbox_channel
+
+
+def test_channel_tokens_grant_one_channel_until_they_expire(monkeypatch):
+    tokens = ChannelTokens()
+    customer_id = uuid4()
+    issued = tokens.issue(customer_id)
+    assert issued.inbox_channel == inbox_channel(customer_id)
+    assert tokens.verify(issued.inbox_channel, issued.token)
+    assert not tokens.verify(inbox_channel(uuid4()), issued.token)
+    expire, _, signature = issued.token.partition(".")
+    assert not tokens.verify(issued.inbox_channel, "%d.%s" % (int(expire) + 1, signature))
+    assert not tokens.verify(issued.inbox_channel, "garbage")
+    monkeypatch.setattr(inbox.time, "time", lambda: int(expire) + 1)
+    assert not tokens.verify(issued.inbox_channel, issued.token)
+
+
+def test_events_reach_every_subscriber_of_the_channel_in_batches(monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_BATCH_SIZE", 3)
+
+    async def run():
+        hub = InboxHub()
+        first, second, other = hub.subscribe("inbox.a"), hub.subscribe("inbox.a"), hub.subscribe("inbox.b")
+        assert hub.subscriber_count() == 3 and sorted(hub.channels()) == ["inbox.a", "inbox.b"]
+        for number in range(5):
+            hub.publish("inbox.a", '"%d"' % number)
+        assert await first.next_batch() == ['"0"', '"1"', '"2"']
+        assert await first.next_batch() == ['"3"', '"4"']
+        assert encode_batch(await second.next_batch()) == '["0","1","2"]'
+        assert other.queue.empty()
+        hub.unsubscribe(first)
+        hub.unsubscribe(second)
+        assert not hub.listening("inbox.a") and hub.listening("inbox.b")
+    asyncio.run(run())
+
+
+def test_subscriber_falling_behind_is_shed(monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_QUEUE_SIZE", 4)
+
+    async def run():
+        hub = InboxHub()
+        slow, fast = hub.subscribe("inbox.a"), hub.subscribe("inbox.a")
+        for number in range(4):
+            hub.publish("inbox.a", str(number))
+        await fast.next_batch()
+        hub.publish("inbox.a", "4")
+        assert slow.shed and not fast.shed and hub.shed_count == 1
+        assert await slow.next_batch() is None
+        assert await fast.next_batch() == ["4"]
+        assert hub.subscriber_count() == 1
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("count", [0, 3])
+def test_marketing_fan_out_reaches_every_online_channel(monkeypatch, count):
+    monkeypatch.setattr(inbox, "MARKETING_FANOUT_SHARD", 2)
+
+    async def run():
+        hub = InboxHub()
+        monkeypatch.setattr(inbox, "inbox_hub", hub)
+        subscriptions = [hub.subscribe(inbox_channel(uuid4())) for _ in range(count)]
+        await inbox._fan_out("event")
+        assert [subscription.queue.qsize() for subscription in subscriptions] == [1] * count
+    asyncio.run(run())
+
+
+def test_event_stream_subscribes_while_streaming_and_keeps_the_pending_read_across_keepalives(monkeypatch):
+    from routers import inbox as inbox_router
+    from services.presence import PresenceIndex
+
+    hub, presence = InboxHub(), PresenceIndex()
+    monkeypatch.setattr(inbox_router, "inbox_hub", hub)
+    monkeypatch.setattr(inbox_router, "presence_index", presence)
+    monkeypatch.setattr(inbox_router, "SSE_KEEPALIVE_SECONDS", 0.01)
+    customer_id = uuid4()
+    channel = inbox_channel(customer_id)
+
+    async def run():
+        stream = inbox_router._event_stream(channel)
+        assert hub.subscriber_count() == 0
+        assert await stream.__anext__() == ": keepalive\n\n"
+        assert hub.listening(channel) and customer_id in presence._connections
+        hub.publish(channel, '"first"')
+        assert await stream.__anext__() == 'data: ["first"]\n\n'
+        await stream.aclose()
+        assert hub.subscriber_count() == 0 and customer_id not in presence._connections
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+import freeze_openapi
+import main
+from services.auth import verified_customer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_an_event_bus_between_processes_needs_the_token_secrets(monkeypatch):
+    monkeypatch.setattr(main, "INBOX_EVENT_BUS", "unix:/tmp/inbox-bus")
+    monkeypatch.delenv("PAGE_TOKEN_SECRET", raising=False)
+    monkeypatch.setenv("INBOX_TOKEN_SECRET", "secret")
+    with pytest.raises(RuntimeError, match="PAGE_TOKEN_SECRET must be set"):
+        main.check_shared_secrets()
+    monkeypatch.setenv("PAGE_TOKEN_SECRET", "secret")
+    main.check_shared_secrets()
+
+
+def test_more_than_one_worker_is_refused(monkeypatch):
+    monkeypatch.setattr(main, "WEB_CONCURRENCY", 2)
+    monkeypatch.setenv("PAGE_TOKEN_SECRET", "secret")
+    monkeypatch.setenv("INBOX_TOKEN_SECRET", "secret")
+    with pytest.raises(RuntimeError, match="WEB_CONCURRENCY is 2"):
+        main.check_workers()
+    monkeypatch.setattr(main, "WEB_CONCURRENCY", 1)
+    main.check_workers()
+
+
+def test_one_worker_runs_without_the_token_secrets(monkeypatch):
+    monkeypatch.setattr(main, "WEB_CONCURRENCY", 1)
+    monkeypatch.setattr(main, "INBOX_EVENT_BUS", "local")
+    monkeypatch.delenv("PAGE_TOKEN_SECRET", raising=False)
+    monkeypatch.delenv("INBOX_TOKEN_SECRET", raising=False)
+    main.check_workers()
+    main.check_shared_secrets()
+
+
+def test_frozen_openapi_document_is_up_to_date():
+    with open(main.OPENAPI_FILE, encoding="utf-8") as file:
+        assert file.read() == freeze_openapi.render()
+
+
+def test_openapi_document_is_served_from_the_frozen_file(monkeypatch, tmp_path):
+    frozen = tmp_path / "openapi.json"
+    frozen.write_text(json.dumps({"openapi": "3.1.0", "info": {"title": "frozen"}}))
+    monkeypatch.setattr(main, "OPENAPI_FILE", str(frozen))
+    monkeypatch.setattr(main.app, "openapi_schema", None)
+    assert main.app.openapi()["info"]["title"] == "frozen"
+
+
+def test_routers_are_included_at_startup_not_at_import():
+    check = textwrap.dedent("""
+        import sys
+        import main
+        from fastapi.testclient import TestClient
+        assert "routers.chats" not in sys.modules
+        with TestClient(main.app) as client:
+            assert client.get("/api/v3/chats", headers={"Authorization": "Bearer startup"}).status_code == 200
+    """)
+    result = subprocess.run([sys.executable, "-c", check], cwd=ROOT, capture_output=True, text=True,
+                            env=dict(os.environ, RATE_LIMITS="", LAZY_ROUTERS="1"))
+    assert result.returncode == 0, result.stderr[-3000:]
+
+
+def test_dependency_overrides_of_the_app_reach_the_routes():
+    main.app.dependency_overrides[verified_customer] = uuid4
+    try:
+        with TestClient(main.app) as client:
+            assert client.get("/api/v3/chats").status_code == 200
+    finally:
+        del main.app.dependency_overrides[verified_customer]
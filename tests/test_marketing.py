@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+
+from dependencies import ApiError
+from models import MarketingMessage, MarketingMessageStatusEnum, MarketingMessageUpdateReq
+from services.marketing import MarketingStore
+from services.timer_wheel import TimerWheel
+
+
+def test_wheel_fires_keys_at_their_tick():
+    wheel = TimerWheel(resolution=1, slots=8, now=100)
+    wheel.schedule("a", 102.5)
+    wheel.schedule("b", 101)
+    wheel.schedule("c", 150)
+    assert len(wheel) == 3
+    assert wheel.advance(100.9) == []
+    assert wheel.advance(101) == ["b"]
+    assert wheel.advance(102.9) == []
+    assert wheel.advance(103) == ["a"]
+    # Due a few turns of the wheel later, it stays put until then
+    assert wheel.advance(149) == []
+    assert wheel.advance(150) == ["c"]
+    assert len(wheel) == 0
+
+
+def test_wheel_reschedule_cancel_and_past_times():
+    wheel = TimerWheel(resolution=1, slots=8, now=100)
+    wheel.schedule("a", 105)
+    wheel.schedule("a", 103)
+    wheel.schedule("b", 104)
+    wheel.cancel("b")
+    wheel.cancel("missing")
+    wheel.schedule("late", 50)
+    assert wheel.advance(101) == ["late"]
+    assert wheel.advance(110) == ["a"]
+    assert wheel.next_delay(110.25) == pytest.approx(0.75)
+
+
+def test_wheel_fires_everything_overdue_after_a_stall():
+    wheel = TimerWheel(resolution=1, slots=4, now=0)
+    for number in range(1, 20):
+        wheel.schedule(number, number)
+    assert sorted(wheel.advance(1000)) == list(range(1, 20))
+
+
+def broadcast(start_time=None, **fields):
+    values = dict(external_request_id=None, marketing_id=uuid4(), text="New feature", title="Title",
+                  status=MarketingMessageStatusEnum.PENDING, link="https://example.com", link_text="Open",
+                  create_time=datetime.now(timezone.utc), update_time=None, start_time=start_time,
+                  author="marketing@example.com")
+    values.update(fields)
+    return MarketingMessage(**values)
+
+
+def test_unread_count_follows_the_timeline_from_first_sight():
+    async def run():
+        store = MarketingStore()
+        old = store.create(broadcast())
+        assert old.status == MarketingMessageStatusEnum.ACTIVE
+        reader, newcomer = uuid4(), uuid4()
+        assert store.unread_count(reader) == 0
+        second = store.create(broadcast())
+        third = store.create(broadcast())
+        assert store.unread_count(reader) == 2
+        store.update(second.marketing_id, MarketingMessageUpdateReq(status=MarketingMessageStatusEnum.DELETED))
+        assert store.unread_count(reader) == 1
+        store.read_all(reader)
+        assert store.unread_count(reader) == 0
+        assert store.unread_count(newcomer) == 0
+        store.create(broadcast())
+        assert (store.unread_count(reader), store.unread_count(newcomer)) == (1, 1)
+        assert third.marketing_id in {message.marketing_id for message in store.page(None, 10, False, [])[0]}
+    asyncio.run(run())
+
+
+def test_pending_broadcast_activates_when_due():
+    async def run():
+        store = MarketingStore(tick=1)
+        activated = []
+        store.listeners.append(activated.append)
+        due = datetime.now(timezone.utc) + timedelta(hours=1)
+        pending = store.create(broadcast(due))
+        assert pending.status == MarketingMessageStatusEnum.PENDING and activated == []
+        customer_id = uuid4()
+        assert store.unread_count(customer_id) == 0
+        store.activate_due(due.timestamp() - 5)
+        assert store.get(pending.marketing_id).status == MarketingMessageStatusEnum.PENDING
+        store.activate_due(due.timestamp() + 1)
+        assert store.get(pending.marketing_id).status == MarketingMessageStatusEnum.ACTIVE
+        assert [message.marketing_id for message in activated] == [pending.marketing_id]
+        assert store.unread_count(customer_id) == 1
+        store._timer.cancel()
+    asyncio.run(run())
+
+
+def test_update_applies_only_the_fields_sent():
+    async def run():
+        store = MarketingStore()
+        due = datetime.now(timezone.utc) + timedelta(hours=1)
+        created = store.create(broadcast(due))
+        updated = store.update(created.marketing_id, MarketingMessageUpdateReq(text="Changed"))
+        assert (updated.text, updated.title, updated.link, updated.start_time) == ("Changed", "Title",
+                                                                                   "https://example.com", due)
+        assert updated.status == MarketingMessageStatusEnum.PENDING and updated.update_time is not None
+        updated = store.update(created.marketing_id, MarketingMessageUpdateReq(link=None, text=None))
+        assert (updated.text, updated.link) == ("Changed", None)
+        updated = store.update(created.marketing_id, MarketingMessageUpdateReq(status="ACTIVE"))
+        assert updated.status == MarketingMessageStatusEnum.ACTIVE and updated.start_time == due
+        with pytest.raises(ApiError) as raised:
+            store.update(created.marketing_id, MarketingMessageUpdateReq(status="PENDING"))
+        assert raised.value.code == "invalid_status"
+        store.update(created.marketing_id, MarketingMessageUpdateReq(status="DELETED"))
+        with pytest.raises(ApiError) as raised:
+            store.update(created.marketing_id, MarketingMessageUpdateReq(text="Again"))
+        assert raised.value.code == "marketing_message_deleted"
+        store._timer.cancel()
+    asyncio.run(run())
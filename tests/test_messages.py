@@ -0,0 +1,162 @@
+import random
+from datetime import datetime, timedelta, timezone
+from uuid import UUID, uuid4
+
+import pytest
+
+from models import Message, MessageAttachment, MessageStatusEnum, MessageTypeEnum, SystemMessageParameters
+from services import messages
+from services.messages import ChatMessages, message_key
+
+AUTHORS = (uuid4(), uuid4())
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make(number: int, create_time=None, message_id=None, prev_message_id=None) -> Message:
+    system = number % 7 == 0
+    return Message(
+        external_request_id="request %d" % number if number % 3 == 0 else None,
+        message_id=message_id or uuid4(),
+        create_time=create_time or START + timedelta(seconds=number),
+        text="Trade started" if system else "message %d" % number,
+        author_id=AUTHORS[number % 2], is_mine=number % 2 == 0, status=MessageStatusEnum.SENT,
+        type=MessageTypeEnum.SYSTEM if system else MessageTypeEnum.MESSAGE,
+        parameters=SystemMessageParameters(type="trade_started_receiver", link="https://example.com/t",
+                                           link_text="view trade", message="Trade started", title=None,
+                                           chat_id=None, message_placeholders=None) if system else None,
+        update_time=None, offer_hash="offer" if number % 5 == 0 else None, trade_hash=None,
+        attachments=[MessageAttachment(filename="a.png", uri="https://example.com/a.png",
+                                       thumbnail_uri="https://example.com/small_a.png")] if number % 5 == 1 else None,
+        prev_message_id=prev_message_id)
+
+
+def linked(count: int):
+    """Messages each pointing at the one before, in order."""
+    history = []
+    for number in range(count):
+        history.append(make(number, prev_message_id=history[-1].message_id if history else None))
+    return history
+
+
+def dumps(items):
+    return [message.model_dump() for message in items]
+
+
+@pytest.fixture(autouse=True)
+def small_runs(monkeypatch):
+    # Id lookups go through several merged runs and an unindexed tail
+    monkeypatch.setattr(messages, "ID_RUN_SIZE", 8)
+
+
+def test_messages_read_back_as_added():
+    history = linked(50)
+    store = ChatMessages()
+    for message in history:
+        store.add(message)
+    assert len(store) == 50
+    assert dumps(store.page(None, 100)[0]) == dumps(history)
+    assert store.last.model_dump() == history[-1].model_dump()
+    assert store.last_id == history[-1].message_id
+    # Read back through packing.construct, they are what model_construct builds of the same values
+    last = store.last
+    assert last == Message.model_construct(**dict(last)) and last.model_fields_set == set(Message.model_fields)
+
+
+def test_out_of_order_inserts_keep_the_order_and_links():
+    history = linked(200)
+    shuffled = history[:]
+    random.Random(7).shuffle(shuffled)
+    store = ChatMessages()
+    for message in shuffled:
+        store.add(message)
+    assert dumps(store.page(None, 1000)[0]) == dumps(history)
+
+
+def test_insert_between_linked_messages_keeps_the_later_link():
+    history = linked(3)
+    store = ChatMessages()
+    store.add(history[0])
+    store.add(history[2])
+    late = make(1, create_time=history[0].create_time + timedelta(milliseconds=1))
+    store.add(late)
+    items = store.page(None, 10)[0]
+    assert [message.message_id for message in items] == [history[0].message_id, late.message_id,
+                                                        history[2].message_id]
+    assert items[2].prev_message_id == history[1].message_id
+
+
+def test_same_microsecond_is_ordered_by_id():
+    ids = sorted(uuid4() for _ in range(5))
+    store = ChatMessages()
+    for message_id in reversed(ids):
+        store.add(make(1, create_time=START, message_id=message_id))
+    assert [message.message_id for message in store.page(None, 10)[0]] == ids
+    after = store.page((START, ids[1]), 10)[0]
+    assert [message.message_id for message in after] == ids[2:]
+
+
+def test_position_lookup_after_inserts_and_appends():
+    history = linked(100)
+    store = ChatMessages()
+    for message in history[::2] + history[1::2]:
+        store.add(message)
+    for message in linked(30):
+        store.add(message.model_copy(update={"create_time": message.create_time + timedelta(days=1)}))
+    ordered = store.page(None, 1000)[0]
+    for position, message in enumerate(ordered):
+        assert store.position(message.message_id) == position
+        assert store.get(message.message_id).model_dump() == message.model_dump()
+    assert store.position(uuid4()) is None
+
+
+def test_position_lookup_ignores_matches_across_two_ids():
+    first = UUID(bytes=bytes(range(16)))
+    second = UUID(bytes=bytes(range(16, 32)))
+    store = ChatMessages()
+    store.add(make(0, message_id=first))
+    store.add(make(1, message_id=second))
+    assert store.position(UUID(bytes=bytes(range(8, 24)))) is None
+    assert store.position(second) == 1
+
+
+def test_pages_seek_by_key_in_both_directions():
+    history = linked(45)
+    store = ChatMessages()
+    for message in history:
+        store.add(message)
+    items, more = store.page(message_key(history[9]), 20)
+    assert dumps(items) == dumps(history[10:30]) and more
+    items, more = store.page(message_key(history[30]), 20)
+    assert dumps(items) == dumps(history[31:]) and not more
+    items, more = store.page(message_key(history[30]), 20, descending=True)
+    assert dumps(items) == dumps(history[10:30][::-1]) and more
+    items, more = store.page(message_key(history[5]), 20, descending=True)
+    assert dumps(items) == dumps(history[:5][::-1]) and not more
+    assert store.count_after(message_key(history[39])) == 5
+
+
+def test_statuses_and_updates_are_stored():
+    history = linked(20)
+    store = ChatMessages()
+    for message in history:
+        store.add(message)
+    store.set_status(3, MessageStatusEnum.READ)
+    assert store.get(history[3].message_id).status == MessageStatusEnum.READ
+    assert store.statuses()[3] == messages.MESSAGE_STATUSES.index(MessageStatusEnum.READ)
+    edited = history[4].model_copy(update={"text": "edited", "update_time": START, "attachments": None})
+    assert store.update(edited)
+    assert store.get(history[4].message_id).model_dump() == edited.model_dump()
+    assert not store.update(make(99))
+
+
+def test_search_follows_adds_and_inserts():
+    history = linked(20)
+    store = ChatMessages()
+    for message in history[1:]:
+        store.add(message)
+    assert store.search("message 1") == {store.position(message.message_id) for message in history
+                                         if message.text.startswith("message 1")}
+    store.add(history[0])
+    store.add(make(100, create_time=START + timedelta(days=1)))
+    hits = store.search("message 10")
+    assert [message.text for message in store.page_among(hits, None, 10)[0]] == ["message 10", "message 100"]
@@ -0,0 +1,34 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from pydantic import ValidationError
+
+from models import InternalTransferParameters, MessageSimple, SpecialOfferParameters, SystemMessageParameters
+
+TRANSFER = dict(id="1f3d24a1", status="success", crypto_currency="BTC", fiat_currency="USD", crypto_amount="0.005",
+                fiat_amount="100", sender_customer_id=str(uuid4()), crypto_total_amount=None, crypto_fee=None,
+                fiat_total_amount=None, fiat_fee=None)
+
+
+def message(kind, parameters):
+    return dict(external_request_id=None, message_id=uuid4(), create_time=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                text="text", author_id=uuid4(), is_mine=False, status="SENT", type=kind, parameters=parameters,
+                update_time=None, offer_hash=None, trade_hash=None)
+
+
+def test_parameters_are_validated_by_the_model_of_the_message_type():
+    transfer = MessageSimple.model_validate(message("INTERNAL_TRANSFER", TRANSFER))
+    assert type(transfer.parameters) is InternalTransferParameters
+    system = MessageSimple.model_validate(message("SYSTEM", dict(
+        type="trade_started", link=None, link_text=None, message=None, title=None, chat_id=None,
+        message_placeholders=None)))
+    assert type(system.parameters) is SystemMessageParameters
+    assert MessageSimple.model_validate(message("SPECIAL_OFFER", None)).parameters is None
+
+
+def test_parameters_not_matching_the_message_type_are_refused_by_that_model_alone():
+    with pytest.raises(ValidationError) as error:
+        MessageSimple.model_validate(message("SPECIAL_OFFER", TRANSFER))
+    assert {problem["loc"][-1] for problem in error.value.errors()} == \
+        {name for name, field in SpecialOfferParameters.model_fields.items() if field.is_required()} - set(TRANSFER)
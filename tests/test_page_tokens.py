@@ -0,0 +1,77 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+
+from dependencies import ApiError
+from services.page_tokens import PageTokenCodec, keyset_page
+
+KEY = (datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc), uuid4())
+
+
+@pytest.mark.parametrize("backward", [False, True])
+@pytest.mark.parametrize("descending", [False, True])
+def test_token_round_trip(backward, descending):
+    codec = PageTokenCodec("messages")
+    token = codec.encode(KEY, backward, descending, ("chat", "q"))
+    assert "=" not in token
+    assert codec.decode(token, descending, ("chat", "q")) == (KEY, backward)
+
+
+@pytest.mark.parametrize("token", ["", "not a token", "AAAA", "%%%%"])
+def test_malformed_token_is_rejected(token):
+    with pytest.raises(ApiError) as raised:
+        PageTokenCodec("messages").decode(token)
+    assert (raised.value.status_code, raised.value.code) == (400, "invalid_page_token")
+
+
+def test_tampered_or_foreign_token_is_rejected():
+    token = PageTokenCodec("messages").encode(KEY)
+    tampered = token[:3] + ("A" if token[3] != "A" else "B") + token[4:]
+    for codec, value in ((PageTokenCodec("messages"), tampered), (PageTokenCodec("chats"), token)):
+        with pytest.raises(ApiError):
+            codec.decode(value)
+
+
+def test_token_of_another_listing_or_order_is_rejected():
+    codec = PageTokenCodec("messages")
+    token = codec.encode(KEY, False, True, ("chat", ""))
+    for descending, listing in ((False, ("chat", "")), (True, ("other chat", "")), (True, ("chat", "q")),
+                                (True, ())):
+        with pytest.raises(ApiError) as raised:
+            codec.decode(token, descending, listing)
+        assert (raised.value.status_code, raised.value.code) == (400, "invalid_page_token")
+
+
+KEYS = [(datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=number), uuid4()) for number in range(25)]
+
+
+def page(after, limit, descending):
+    if descending:
+        end = bisect_left(KEYS, after) if after is not None else len(KEYS)
+        start = max(0, end - limit)
+        return KEYS[start:end][::-1], start > 0
+    start = bisect_right(KEYS, after) if after is not None else 0
+    return KEYS[start:start + limit], start + limit < len(KEYS)
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_walking_forward_and_back_visits_every_key_once(descending):
+    codec = PageTokenCodec("messages")
+    pages = []
+    after, backward = None, False
+    while True:
+        items, has_next, has_prev = keyset_page(page, after, backward, 10, descending)
+        pages.append(items)
+        if not has_next:
+            break
+        after, backward = codec.decode(codec.encode(items[-1], False, descending), descending)
+    ordered = KEYS[::-1] if descending else KEYS
+    assert [key for items in pages for key in items] == ordered
+    assert [len(items) for items in pages] == [10, 10, 5]
+
+    # prev_page_token of the last page leads back to the page before it
+    after, backward = codec.decode(codec.encode(pages[-1][0], True, descending), descending)
+    items, has_next, has_prev = keyset_page(page, after, backward, 10, descending)
+    assert items == pages[1] and has_next and has_prev
@@ -0,0 +1,117 @@
+import asyncio
+import os
+from multiprocessing import shared_memory
+from uuid import uuid4
+
+import pytest
+
+from dependencies import ApiError
+from services import rate_limits
+from services.rate_limits import RateLimit, SharedBuckets, parse_rate_limits
+
+SECOND = 10 ** 9
+NOW = 1_000 * SECOND
+
+
+def test_parse_rate_limits():
+    limits = parse_rate_limits("send_message=30/10, chats:write=300/60,")
+    assert sorted(limits) == ["chats:write", "send_message"]
+    assert (limits["send_message"].requests, limits["send_message"].seconds) == (30, 10)
+    assert limits["send_message"].interval == SECOND // 3
+    assert parse_rate_limits("") == {}
+
+
+def test_burst_then_refill_one_token_per_interval():
+    buckets = SharedBuckets(None, slots=64)
+    limit = RateLimit("route", 5, 10)
+    customer_id = uuid4()
+    assert [buckets.acquire(customer_id, [limit], NOW) for _ in range(5)] == [0] * 5
+    assert buckets.acquire(customer_id, [limit], NOW) == pytest.approx(2)
+    assert buckets.acquire(customer_id, [limit], NOW + SECOND) == pytest.approx(1)
+    assert buckets.acquire(customer_id, [limit], NOW + 2 * SECOND) == 0
+    assert buckets.acquire(customer_id, [limit], NOW + 2 * SECOND) == pytest.approx(2)
+
+
+def test_bucket_does_not_fill_past_its_capacity():
+    buckets = SharedBuckets(None, slots=64)
+    limit = RateLimit("route", 3, 3)
+    customer_id = uuid4()
+    for _ in range(3):
+        buckets.acquire(customer_id, [limit], NOW)
+    later = NOW + 3600 * SECOND
+    assert [buckets.acquire(customer_id, [limit], later) for _ in range(4)][-1] == pytest.approx(1)
+
+
+def test_rejected_request_takes_no_token_from_any_bucket():
+    buckets = SharedBuckets(None, slots=64)
+    route, scope = RateLimit("route", 2, 10), RateLimit("scope", 10, 10)
+    customer_id = uuid4()
+    assert buckets.acquire(customer_id, [route, scope], NOW) == 0
+    assert buckets.acquire(customer_id, [route, scope], NOW) == 0
+    for _ in range(5):
+        assert buckets.acquire(customer_id, [route, scope], NOW) > 0
+    # The scope bucket was charged for the two admitted requests only
+    assert [buckets.acquire(customer_id, [scope], NOW) for _ in range(8)] == [0] * 8
+    assert buckets.acquire(customer_id, [scope], NOW) > 0
+
+
+def test_customers_and_limits_have_buckets_of_their_own():
+    buckets = SharedBuckets(None, slots=1024)
+    limits = [RateLimit("one", 1, 60), RateLimit("two", 1, 60)]
+    customers = [uuid4() for _ in range(4)]
+    for customer_id in customers:
+        for limit in limits:
+            assert buckets.acquire(customer_id, [limit], NOW) == 0
+    for customer_id in customers:
+        for limit in limits:
+            assert buckets.acquire(customer_id, [limit], NOW) > 0
+
+
+def test_colliding_keys_probe_and_the_least_loaded_slot_is_taken_over():
+    buckets = SharedBuckets(None, slots=2, probes=2)
+    limit = RateLimit("route", 1, 60)
+    first, second, third = uuid4(), uuid4(), uuid4()
+    assert buckets.acquire(first, [limit], NOW) == 0
+    assert buckets.acquire(second, [limit], NOW + SECOND) == 0
+    assert buckets.acquire(first, [limit], NOW) > 0
+    assert buckets.acquire(second, [limit], NOW + SECOND) > 0
+    # The table is full: the third customer starts a full bucket in the slot closest to refilled
+    assert buckets.acquire(third, [limit], NOW + SECOND) == 0
+    assert buckets.acquire(second, [limit], NOW + SECOND) > 0
+
+
+def test_buckets_are_shared_through_the_segment():
+    name = "rate-limit-test-%d" % os.getpid()
+    first, second = SharedBuckets(name, slots=64), SharedBuckets(name, slots=64)
+    limit = RateLimit("route", 2, 10)
+    customer_id = uuid4()
+    try:
+        assert first.acquire(customer_id, [limit], NOW) == 0
+        assert second.acquire(customer_id, [limit], NOW) == 0
+        assert first.acquire(customer_id, [limit], NOW) > 0
+        assert second.acquire(customer_id, [limit], NOW) > 0
+    finally:
+        second.close()
+        first.close()
+    # The creator unlinks the segment, the other worker only detached from it
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name)
+
+
+@pytest.mark.skipif(bool(os.environ.get("RATE_LIMIT_SEGMENT")), reason="segment named by the environment")
+def test_segment_is_named_after_the_parent_process():
+    assert rate_limits.shared_buckets.name == "message-service-rate-limits-%d" % os.getppid()
+
+
+def test_dependency_rejects_with_retry_after(monkeypatch):
+    monkeypatch.setattr(rate_limits, "rate_limits", parse_rate_limits("send_message=1/30"))
+    monkeypatch.setattr(rate_limits, "shared_buckets", SharedBuckets(None, slots=64))
+    check = rate_limits.rate_limit("send_message", "chats:write")
+    customer_id = uuid4()
+    asyncio.run(check(customer_id))
+    with pytest.raises(ApiError) as raised:
+        asyncio.run(check(customer_id))
+    assert raised.value.status_code == 429
+    assert raised.value.code == "rate_limited"
+    assert 29 <= int(raised.value.headers["Retry-After"]) <= 30
+    assert asyncio.run(rate_limits.rate_limit("start_chat", "chats:read")(customer_id)) is None
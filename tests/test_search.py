@@ -0,0 +1,40 @@
+from services.search import SearchIndex
+
+
+def index(texts):
+    search = SearchIndex()
+    for key, text in enumerate(texts):
+        search.update(key, text)
+    return search
+
+
+def test_substring_queries_match_case_insensitively():
+    search = index(["Payment via Bank Transfer", "bank of america", "Tinkoff", "no match here"])
+    assert search.search("bank") == {0, 1}
+    assert search.search("BANK TRANSFER") == {0}
+    assert search.search("ank") == {0, 1}
+    assert search.search("transfer  via") == set()
+    assert search.search("koff") == {2}
+    assert search.search("zzz") == set()
+
+
+def test_short_queries_match_word_prefixes():
+    search = index(["alice", "Bob Alison", "carol"])
+    assert search.search("al") == {0, 1}
+    assert search.search("a") == {0, 1}
+    assert search.search("ol") == set()
+
+
+def test_empty_query_matches_everything():
+    assert index(["a", "b"]).search("  ") == {0, 1}
+
+
+def test_updates_and_removals_replace_the_postings():
+    search = index(["first name", "second"])
+    search.update(0, "renamed")
+    assert search.search("first") == set()
+    assert search.search("renamed") == {0}
+    search.remove(0)
+    search.remove(42)
+    assert search.search("renamed") == set()
+    assert len(search) == 1 and search._postings.keys() == index(["", "second"])._postings.keys()
@@ -0,0 +1,46 @@
+from uuid import uuid1, uuid4
+
+from services.shards import ChatShards, HashRing, chat_hash
+
+
+def test_ring_spreads_keys_evenly():
+    ring = HashRing(8)
+    counts = [0] * 8
+    for _ in range(40_000):
+        counts[ring.owner(chat_hash(uuid4()))] += 1
+    assert min(counts) > 40_000 / 8 * 0.75 and max(counts) < 40_000 / 8 * 1.25
+    # Keys past the last point belong to the owner of the first one
+    assert ring.owner((1 << 64) - 1) == ring.owner(0)
+
+
+def test_sequential_uuid1_ids_spread_too():
+    ring = HashRing(4)
+    assert {ring.owner(chat_hash(uuid1())) for _ in range(200)} == {0, 1, 2, 3}
+
+
+def test_adding_a_shard_moves_only_its_share():
+    before, after = HashRing(8), HashRing(9)
+    keys = [chat_hash(uuid4()) for _ in range(20_000)]
+    moved = [key for key in keys if before.owner(key) != after.owner(key)]
+    assert all(after.owner(key) == 8 for key in moved)
+    assert len(moved) < len(keys) / 9 * 1.5
+
+
+def test_resize_moves_every_table_of_a_chat():
+    shards = ChatShards(4)
+    chat_ids = [uuid4() for _ in range(1000)]
+    for chat_id in chat_ids:
+        shard = shards.shard(chat_id)
+        shard.records[chat_id] = "record"
+        shard.messages[chat_id] = "messages"
+        shard.logs[chat_id] = "log"
+    orphan = uuid4()
+    shards.shard(orphan).logs[orphan] = "log only"
+    moved = shards.resize(6)
+    assert len(shards) == 6 and 0 < moved < 1000 / 6 * 2 * 1.5
+    for chat_id in chat_ids:
+        shard = shards.shard(chat_id)
+        assert (shard.records[chat_id], shard.messages[chat_id], shard.logs[chat_id]) == ("record", "messages",
+                                                                                        "log")
+    assert shards.shard(orphan).logs[orphan] == "log only"
+    assert sum(len(shard) for shard in shards.shards()) == 1000
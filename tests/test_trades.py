@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+from models import Trade, TradeContext, TradeStatusEnum
+from services.trades import CustomerTrades
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def trade(trade_hash, status, minute):
+    return Trade.model_construct(trade_hash=trade_hash, status=status, context=TradeContext(
+        trade_name=trade_hash, unread_count=0, update_time=START + timedelta(minutes=minute)))
+
+
+def hashes(entries):
+    return [entry.trade.trade_hash for entry in entries]
+
+
+def test_trades_are_listed_newest_first_across_the_requested_statuses():
+    trades = CustomerTrades()
+    trades.put(trade("a", TradeStatusEnum.paid, 1))
+    trades.put(trade("b", TradeStatusEnum.released, 3))
+    trades.put(trade("c", TradeStatusEnum.paid, 2))
+    trades.put(trade("d", TradeStatusEnum.active_funded, 0))
+    assert hashes(trades.newest([], 10)) == ["b", "c", "a", "d"]
+    assert hashes(trades.newest([TradeStatusEnum.paid, TradeStatusEnum.active_funded], 10)) == ["c", "a", "d"]
+    assert hashes(trades.newest([TradeStatusEnum.dispute_open], 10)) == []
+    assert hashes(trades.newest([], 2)) == ["b", "c"]
+
+
+def test_an_update_moves_the_trade_to_its_new_status_and_time():
+    trades = CustomerTrades()
+    trades.put(trade("a", TradeStatusEnum.paid, 1))
+    trades.put(trade("b", TradeStatusEnum.paid, 2))
+    trades.put(trade("a", TradeStatusEnum.released, 5))
+    assert hashes(trades.newest([TradeStatusEnum.paid], 10)) == ["b"]
+    assert hashes(trades.newest([], 10)) == ["a", "b"]
+    assert trades.get("a").trade.status == TradeStatusEnum.released
+
+
+def test_read_all_clears_every_unread_count_at_once():
+    trades = CustomerTrades()
+    trades.put(trade("a", TradeStatusEnum.paid, 1))
+    trades.put(trade("a", TradeStatusEnum.paid, 2))
+    trades.put(trade("b", TradeStatusEnum.paid, 3))
+    assert [trades.unread_count(trades.get(trade_hash)) for trade_hash in "ab"] == [2, 1]
+    trades.read_epoch += 1
+    assert [trades.unread_count(trades.get(trade_hash)) for trade_hash in "ab"] == [0, 0]
+    trades.put(trade("b", TradeStatusEnum.released, 4))
+    assert [trades.unread_count(trades.get(trade_hash)) for trade_hash in "ab"] == [0, 1]
@@ -0,0 +1,138 @@
+import asyncio
+import os
+
+import pytest
+
+from services.wal import WriteAheadLog, frame, frames
+
+
+def write(directory, records, segment_bytes=1 << 20):
+    """Append the records, wait for them to be on disk and close the log. Returns their positions."""
+    async def run():
+        wal = WriteAheadLog(directory, segment_bytes)
+        wal.open()
+        positions = [wal.append(kind, payload) for kind, payload in records]
+        await wal.commit()
+        await wal.close()
+        return positions
+    return asyncio.run(run())
+
+
+def reopen(directory, boundary=0, segment_bytes=1 << 20):
+    wal = WriteAheadLog(directory, segment_bytes)
+    wal.open(boundary)
+    return wal
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".wal"))
+
+
+RECORDS = [(1, b"first"), (2, b""), (3, b"x" * 1000), (1, b"last")]
+
+
+def test_frames_stop_at_a_cut_or_damaged_record():
+    data = frame(1, b"one") + frame(2, b"two")
+    assert [(kind, payload) for _, kind, payload in frames(data)] == [(1, b"one"), (2, b"two")]
+    assert [payload for _, _, payload in frames(data[:-1])] == [b"one"]
+    damaged = bytearray(data)
+    damaged[-1] ^= 0xFF
+    assert [payload for _, _, payload in frames(bytes(damaged))] == [b"one"]
+
+
+def test_records_read_back_after_reopen(tmp_path):
+    positions = write(str(tmp_path), RECORDS)
+    wal = reopen(str(tmp_path))
+    assert [(position, kind, bytes(payload)) for position, kind, payload in wal.records()] == [
+        (position, kind, payload) for position, (kind, payload) in zip(positions, RECORDS)]
+    assert wal.position == wal.durable == positions[-1] + len(frame(*RECORDS[-1]))
+    kind, payload = wal.read(positions[2])
+    assert (kind, bytes(payload)) == RECORDS[2]
+    assert [position for position, _, _ in wal.records(positions[2])] == positions[2:]
+    asyncio.run(wal.close())
+
+
+@pytest.mark.parametrize("tail", [frame(5, b"cut short")[:-3], b"\x40\x00\x00\x00torn", b"\x01"])
+def test_torn_record_at_the_end_is_truncated(tmp_path, tail):
+    positions = write(str(tmp_path), RECORDS)
+    path = os.path.join(str(tmp_path), segments(str(tmp_path))[-1])
+    size = os.path.getsize(path)
+    with open(path, "ab") as file:
+        file.write(tail)
+    wal = reopen(str(tmp_path))
+    assert os.path.getsize(path) == size
+    assert [position for position, _, _ in wal.records()] == positions
+    asyncio.run(wal.close())
+
+    # The log goes on right after the last complete record
+    assert write(str(tmp_path), [(6, b"after")]) == [size]
+    wal = reopen(str(tmp_path))
+    assert [(kind, bytes(payload)) for _, kind, payload in wal.records()] == RECORDS + [(6, b"after")]
+    asyncio.run(wal.close())
+
+
+def test_damaged_record_drops_the_rest_of_the_segment(tmp_path):
+    positions = write(str(tmp_path), RECORDS)
+    path = os.path.join(str(tmp_path), segments(str(tmp_path))[-1])
+    with open(path, "r+b") as file:
+        file.seek(positions[2] + 9)
+        file.write(b"y")
+    wal = reopen(str(tmp_path))
+    assert os.path.getsize(path) == positions[2]
+    assert [(kind, bytes(payload)) for _, kind, payload in wal.records()] == RECORDS[:2]
+    asyncio.run(wal.close())
+
+
+def test_scan_for_a_torn_record_starts_at_the_boundary(tmp_path):
+    positions = write(str(tmp_path), RECORDS)
+    path = os.path.join(str(tmp_path), segments(str(tmp_path))[-1])
+    with open(path, "ab") as file:
+        file.write(b"\x40\x00\x00\x00torn")
+    wal = reopen(str(tmp_path), boundary=positions[3])
+    assert wal.position == positions[3] + len(frame(*RECORDS[3]))
+    asyncio.run(wal.close())
+
+
+def test_segments_roll_over_and_positions_stay_valid(tmp_path):
+    records = [(1, bytes([number]) * 100) for number in range(20)]
+    positions = write(str(tmp_path), records, segment_bytes=512)
+    names = segments(str(tmp_path))
+    assert len(names) > 1
+    assert [int(name[:-4], 16) for name in names][0] == 0
+    wal = reopen(str(tmp_path), segment_bytes=512)
+    for position, (kind, payload) in zip(positions, records):
+        assert wal.read(position) == (kind, payload)
+    assert [position for position, _, _ in wal.records(positions[7])] == positions[7:]
+    asyncio.run(wal.close())
+
+
+def test_appends_share_a_sync(tmp_path):
+    async def run():
+        wal = WriteAheadLog(str(tmp_path))
+        wal.open()
+        for number in range(100):
+            wal.append(1, b"%d" % number)
+        await wal.commit()
+        await wal.close()
+        return wal.syncs
+    assert asyncio.run(run()) == 1
+
+
+@pytest.mark.parametrize("error", [OSError("disk full"), ValueError("bad record")])
+def test_failed_sync_fails_the_commit_and_refuses_writes(tmp_path, error):
+    async def run():
+        wal = WriteAheadLog(str(tmp_path))
+        wal.open()
+
+        def fail(pending):
+            raise error
+        wal._write = fail
+        wal.append(1, b"lost")
+        with pytest.raises(type(error)):
+            await wal.commit()
+        with pytest.raises(type(error)):
+            wal.append(1, b"refused")
+        with pytest.raises(type(error)):
+            await wal.commit()
+        assert wal.durable == 0
+    asyncio.run(run())